@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Measure the import time of the compute modules in fresh interpreters, as paid by every
+process-pool worker, and check that no GUI or backend packages are loaded at import time.
+
+Usage:
+    python benchmarks/bench_import.py [--repeat 10] [--max-ms 500]
+                                      [--output results.json] [--compare baseline.json]
+
+Exits with a non-zero status if a module loads a forbidden package, exceeds --max-ms, or is
+slower than the baseline by more than REGRESSION_THRESHOLD.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from bench_utils import git_revision  # noqa: E402
+
+MODULES = ['stir_simind_trace', 'stir_simind_utils', 'stir_simind_analysis', 'stir_simind_report']
+
+# Packages that must only be loaded on first use of the functions needing them
+FORBIDDEN = ['matplotlib', 'sirf_simind_connection', 'stir']
+
+# Relative slow-down reported as a regression by --compare
+REGRESSION_THRESHOLD = 1.2
+
+_PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(elapsed, ','.join(name for name in {forbidden!r} if name in sys.modules))
+"""
+
+
+def import_once(module):
+    """Import module in a fresh interpreter; return the import time (s) and the forbidden packages loaded"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [str(REPO_DIR), os.environ.get('PYTHONPATH')])))
+    result = subprocess.run([sys.executable, '-c', _PROBE.format(module=module, forbidden=FORBIDDEN)],
+                            capture_output=True, text=True, cwd=REPO_DIR, env=env, check=True)
+    elapsed, _, loaded = result.stdout.strip().partition(' ')
+    return float(elapsed), [name for name in loaded.split(',') if name]
+
+
+def run(repeat):
+    """Measure all modules and return the results document"""
+    results = {}
+    for module in MODULES:
+        import_once(module)  # warm-up: page cache and bytecode
+        times, loaded = [], set()
+        for _ in range(repeat):
+            elapsed, forbidden = import_once(module)
+            times.append(elapsed)
+            loaded.update(forbidden)
+        results[module] = {'time_s': float(np.median(times)), 'forbidden_loaded': sorted(loaded)}
+        flag = f"  <-- loads {', '.join(sorted(loaded))}" if loaded else ''
+        print(f"  {module:<40} {results[module]['time_s'] * 1000:10.2f} ms{flag}")
+
+    return {
+        'meta': {'revision': git_revision(), 'python': sys.version.split()[0], 'repeat': repeat},
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--max-ms', type=float, help='fail if a module takes longer than this to import')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare against a previous results JSON file')
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("Import time (fresh interpreter, median)")
+    print("=" * 60)
+    current = run(args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    failures = sum(1 for result in current['results'].values() if result['forbidden_loaded'])
+    if args.max_ms is not None:
+        failures += sum(1 for result in current['results'].values() if result['time_s'] * 1000 > args.max_ms)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"\nComparison against {baseline['meta'].get('revision')}")
+        for module, result in current['results'].items():
+            if module not in baseline['results']:
+                continue
+            ratio = result['time_s'] / baseline['results'][module]['time_s']
+            flag = ''
+            if ratio > REGRESSION_THRESHOLD:
+                flag = '  <-- regression'
+                failures += 1
+            print(f"  {module:<40} time x{ratio:5.2f}{flag}")
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""
+Benchmark the hot paths of stir_simind_utils without STIR or SIMIND installed.
+
+Usage:
+    python benchmarks/bench_utils.py [--sizes lu177 tc99m] [--repeat 3]
+                                     [--output results.json] [--compare baseline.json]
+
+Each benchmark records the median wall time and the peak traced memory of one call.
+Results are stored as JSON so runs from different versions can be compared.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import stir_simind_analysis as analysis  # noqa: E402
+import stir_simind_store as store  # noqa: E402
+import stir_simind_utils as utils  # noqa: E402
+from standins import NumpyAcquisitionData, NumpyImageData  # noqa: E402
+
+# (axial, views, tangential) projection sizes and (z, y, x) image sizes used in the notebook
+SIZES = {
+    'lu177': {'projections': (128, 120, 128), 'image': (128, 128, 128), 'voxel_mm': 4.4154},
+    'tc99m': {'projections': (256, 120, 256), 'image': (256, 256, 256), 'voxel_mm': 2.2077},
+}
+
+# Relative slow-down reported as a regression by --compare
+REGRESSION_THRESHOLD = 1.2
+
+
+def measure(func, repeat):
+    """Return the median wall time (s) and the peak traced memory (MB) of func()"""
+    func()  # warm-up: page cache, imports, first-touch allocations
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'time_s': float(np.median(times)), 'peak_mb': peak / 1024**2}
+
+
+def make_benchmarks(size_name, work_dir):
+    """Build the {name: callable} benchmarks for one data size"""
+    size = SIZES[size_name]
+    rng = np.random.default_rng(0)
+
+    proj_shape = (1,) + size['projections']
+    PP = NumpyAcquisitionData(rng.poisson(20.0, proj_shape), (187.2, 228.8))
+    SC1 = NumpyAcquisitionData(rng.poisson(5.0, proj_shape), (156.4, 183.6))
+    SC2 = NumpyAcquisitionData(rng.poisson(5.0, proj_shape), (229.36, 258.64))
+
+    voxel_size = (size['voxel_mm'],) * 3
+    image = NumpyImageData(rng.random(size['image']), voxel_size)
+    attenuation = NumpyImageData(np.where(rng.random(size['image']) > 0.5, 0.15, 0.0), voxel_size)
+    image_arr = image.as_array()
+    recon_arrs = [rng.random(size['image'], dtype=np.float32) for _ in range(3)]
+
+    hdr_file = REPO_DIR / 'measured_data' / 'lu177' / 'EARL_NEMA_128_EM_en_1_Lu177_EM.hdr'
+    par_file = REPO_DIR / 'par_files' / 'recon_OSEM.par'
+    par_updates = {
+        'input file': 'data.hs',
+        'output filename prefix': 'out',
+        'attenuation map': 'atten.hv',
+        'mask file': 'mask.hv',
+        'number of subsets': 4,
+        'number of subiterations': 24,
+    }
+    header_tags = ['matrix size [1]', 'matrix size [2]', 'number of projections',
+                   'energy window lower level', 'energy window upper level', 'start angle']
+
+    cache_dir = os.path.join(work_dir, f'aux_cache_{size_name}')
+
+    def aux_images_cold():
+        # a cold cache measures the init/attenuation/mask generation of reconstruct_with_osem
+        if os.path.isdir(cache_dir):
+            for name in os.listdir(cache_dir):
+                os.remove(os.path.join(cache_dir, name))
+        utils.get_cached_aux_images(image, attenuation, cache_dir=cache_dir)
+
+    def aux_images_warm():
+        utils.get_cached_aux_images(image, attenuation, cache_dir=cache_dir)
+
+    counts = PP.as_array()
+    ensemble = store.EnsembleStore(os.path.join(work_dir, f'store_{size_name}'))
+    ensemble.put(counts, 'projections', realization=0, encoding='counts')
+
+    return {
+        'DEW_scatter_correction': lambda: utils.DEW_scatter_correction(PP, SC1),
+        'TEW_scatter_correction': lambda: utils.TEW_scatter_correction(PP, SC1, SC2),
+        'add_poisson_noise': lambda: utils.add_poisson_noise(PP, np.random.default_rng(1)),
+        'update_par_file': lambda: utils.update_par_file(
+            str(par_file), os.path.join(work_dir, 'bench.par'), par_updates),
+        'image_to_image2d': lambda: utils.image_to_image2d(image_arr, size['image'][0] // 2, 0),
+        'extract_header_info': lambda: [utils.extract_header_info(str(hdr_file), tag) for tag in header_tags],
+        'aux_images_cold': aux_images_cold,
+        'aux_images_warm': aux_images_warm,
+        'comparison_metrics': lambda: analysis.comparison_metrics(recon_arrs),
+        'store_put_counts': lambda: ensemble.put(counts, 'projections', realization=1, encoding='counts'),
+        'store_read_view': lambda: ensemble.get_plane(60, 'projections', realization=0),
+    }
+
+
+def git_revision():
+    """Return the current git commit of the repository, if available"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def run(size_names, repeat):
+    """Run all benchmarks and return the results document"""
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir, open(os.devnull, 'w') as devnull:
+        for size_name in size_names:
+            for name, func in make_benchmarks(size_name, work_dir).items():
+                key = f'{size_name}/{name}'
+                # the utilities print progress; keep the benchmark output readable
+                stdout, sys.stdout = sys.stdout, devnull
+                try:
+                    results[key] = measure(func, repeat)
+                finally:
+                    sys.stdout = stdout
+                print(f"  {key:<40} {results[key]['time_s'] * 1000:10.2f} ms {results[key]['peak_mb']:10.1f} MB")
+
+    return {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+def compare(current, baseline):
+    """Print the time and memory ratios against a baseline; return the number of regressions"""
+    print(f"\nComparison against {baseline['meta'].get('revision')} ({baseline['meta'].get('timestamp')})")
+    regressions = 0
+    for key, result in current['results'].items():
+        if key not in baseline['results']:
+            continue
+        old = baseline['results'][key]
+        time_ratio = result['time_s'] / old['time_s'] if old['time_s'] > 0 else float('inf')
+        mem_ratio = result['peak_mb'] / old['peak_mb'] if old['peak_mb'] > 0 else float('inf')
+        flag = ''
+        if time_ratio > REGRESSION_THRESHOLD or mem_ratio > REGRESSION_THRESHOLD:
+            flag = '  <-- regression'
+            regressions += 1
+        print(f"  {key:<40} time x{time_ratio:5.2f}  memory x{mem_ratio:5.2f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', choices=sorted(SIZES), default=sorted(SIZES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare against a previous results JSON file')
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("stir_simind_utils benchmarks")
+    print("=" * 60)
+    current = run(args.sizes, args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        return 1 if compare(current, baseline) else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Stand-in for a SIMIND run, used to exercise run_simind_parallel without SIMIND installed.
+
+Usage:
+    python benchmarks/simind_standin.py --output-dir DIR --seed 1234
+                                        [--photon-multiplier 0.25] [--n-windows 3]
+                                        [--shape 120 32 32]
+
+Writes tot_w<n>.hs/.s and sca_w<n>.hs/.s Interfile projections (float32, views first) for
+every window. Counts are Poisson noise around a fixed smooth mean, with a noise level that
+falls with the photon multiplier like a Monte Carlo estimate, so averaging the outputs of
+runs with different seeds converges to the mean.
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+# Mean counts per bin of the total (photopeak) window; window n has 1 / n of it
+PEAK_COUNTS = 50.0
+SCATTER_FRACTION = 0.3
+HISTORIES_PER_MULTIPLIER = 20
+
+
+def mean_projections(shape):
+    """Smooth synthetic (views, axial, tangential) projections with a peak of 1"""
+    views, axial, tangential = shape
+    z = np.linspace(-1, 1, axial)[:, None]
+    t = np.linspace(-1, 1, tangential)[None, :]
+    angle = np.linspace(0, 2 * np.pi, views, endpoint=False)[:, None, None]
+    return np.exp(-(z**2 + (t - 0.3 * np.cos(angle))**2) / 0.2)
+
+
+def write_projections(path, arr, window):
+    """Write arr (views, axial, tangential) as a float32 Interfile projection file"""
+    data_file = os.path.splitext(path)[0] + '.s'
+    arr.astype('<f4').tofile(data_file)
+    views, axial, tangential = arr.shape
+    with open(path, 'wt') as f:
+        f.write('!INTERFILE  :=\n')
+        f.write(f'name of data file := {os.path.basename(data_file)}\n')
+        f.write('!number format := float\n!number of bytes per pixel := 4\n')
+        f.write('imagedata byte order := LITTLEENDIAN\n')
+        f.write(f'!matrix size [1] := {tangential}\n!matrix size [2] := {axial}\n')
+        f.write(f'!number of projections := {views}\n')
+        f.write(f'energy window lower level[1] := {100.0 + 20 * window}\n')
+        f.write(f'energy window upper level[1] := {120.0 + 20 * window}\n')
+        f.write('!END OF INTERFILE :=\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output-dir', required=True)
+    parser.add_argument('--seed', type=int, required=True)
+    parser.add_argument('--photon-multiplier', type=float, default=1.0)
+    parser.add_argument('--n-windows', type=int, default=1)
+    parser.add_argument('--shape', type=int, nargs=3, default=(120, 32, 32))
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    rng = np.random.default_rng(args.seed)
+    # histories per bin; the estimate is rescaled to the mean counts
+    histories = HISTORIES_PER_MULTIPLIER * args.photon_multiplier
+
+    mean = mean_projections(tuple(args.shape))
+    for window in range(1, args.n_windows + 1):
+        total_mean = PEAK_COUNTS / window * mean
+        for name, expected in (('tot', total_mean), ('sca', SCATTER_FRACTION * total_mean)):
+            estimate = rng.poisson(expected * histories) / histories
+            write_projections(os.path.join(args.output_dir, f'{name}_w{window}.hs'), estimate, window)
+
+
+if __name__ == "__main__":
+    main()
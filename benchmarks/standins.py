@@ -0,0 +1,100 @@
+"""
+Lightweight numpy-backed stand-ins for the SIRF-SIMIND-Connection acquisition data and
+STIR image objects, so the utilities can be benchmarked without STIR or SIMIND installed.
+"""
+
+import os
+
+import numpy as np
+
+
+class NumpyAcquisitionData:
+    """Stand-in for AcquisitionDataInterface backed by a float32 array of shape (1, axial, views, tangential)"""
+
+    def __init__(self, arr, energy_window_bounds=(0.0, 1.0)):
+        self._arr = np.asarray(arr, dtype=np.float32)
+        self._bounds = energy_window_bounds
+
+    def clone(self):
+        return NumpyAcquisitionData(self._arr.copy(), self._bounds)
+
+    def as_array(self):
+        # like SIRF/STIR, return a copy of the data
+        return self._arr.copy()
+
+    def fill(self, values):
+        self._arr[...] = values
+
+    def get_energy_window_bounds(self):
+        return self._bounds
+
+    def get_info(self):
+        _, axial, views, tangential = self._arr.shape
+        return (f"Projection data info:\n"
+                f"!matrix size [1] := {tangential}\n"
+                f"!matrix size [2] := {axial}\n"
+                f"!number of projections := {views}\n"
+                f"energy window lower level [1] := {self._bounds[0]}\n"
+                f"energy window upper level [1] := {self._bounds[1]}\n")
+
+    def _binary(self, other, op):
+        other_arr = other._arr if isinstance(other, NumpyAcquisitionData) else other
+        return NumpyAcquisitionData(op(self._arr, other_arr), self._bounds)
+
+    def __add__(self, other):
+        return self._binary(other, np.add)
+
+    def __sub__(self, other):
+        return self._binary(other, np.subtract)
+
+    def __mul__(self, other):
+        return self._binary(other, np.multiply)
+
+    __rmul__ = __mul__
+
+
+class _Coordinate:
+    """Stand-in for STIR's 1-based Float3BasicCoordinate"""
+
+    def __init__(self, values):
+        self._values = tuple(values)
+
+    def __getitem__(self, i):
+        return self._values[i - 1]
+
+
+class NumpyImageData:
+    """Stand-in for stir.FloatVoxelsOnCartesianGrid backed by a float32 (z, y, x) array"""
+
+    def __init__(self, arr, voxel_size=(4.4154, 4.4154, 4.4154)):
+        self._arr = np.asarray(arr, dtype=np.float32)
+        self._voxel_size = tuple(voxel_size)
+
+    def clone(self):
+        return NumpyImageData(self._arr.copy(), self._voxel_size)
+
+    def as_array(self):
+        return self._arr.copy()
+
+    def fill(self, values):
+        self._arr[...] = values
+
+    def get_voxel_size(self):
+        return _Coordinate(self._voxel_size)
+
+    def get_origin(self):
+        return _Coordinate((0.0, 0.0, 0.0))
+
+    def write_to_file(self, filename):
+        data_file = os.path.splitext(filename)[0] + '.v'
+        self._arr.astype('<f4').tofile(data_file)
+        z, y, x = self._arr.shape
+        with open(filename, 'wt') as f:
+            f.write('!INTERFILE  :=\n')
+            f.write(f'name of data file := {os.path.basename(data_file)}\n')
+            f.write('!number format := float\n!number of bytes per pixel := 4\n')
+            f.write('imagedata byte order := LITTLEENDIAN\n')
+            f.write(f'!matrix size [1] := {x}\n!matrix size [2] := {y}\n!matrix size [3] := {z}\n')
+            for i, size in zip((1, 2, 3), reversed(self._voxel_size)):
+                f.write(f'scaling factor (mm/pixel) [{i}] := {size}\n')
+            f.write('!END OF INTERFILE :=\n')
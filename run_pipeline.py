@@ -0,0 +1,512 @@
+#!/usr/bin/env python
+"""
+Run the STIR EARL demo workflow headless, as a graph of stages with incremental rebuilds.
+
+Usage:
+    python run_pipeline.py [--isotopes lu177 tc99m] [--output output/pipeline] [--jobs 4]
+                           [--threads-per-worker 1] [--force STAGE ...] [--dry-run] [--no-measured]
+
+Stages (per isotope): phantom -> simulation -> noise -> scatter_simulated -> recon_* -> analysis/report,
+with the measured-data branch (scatter_measured -> recon_measured) running alongside.
+Every stage is fingerprinted from its code (including the stir_simind_* modules it calls),
+its parameters, the files it reads from the repository (par file, scanner YAML, measured data)
+and the fingerprints and outputs of the stages it depends on. A stage is skipped when its
+fingerprint and output files are unchanged, so only stages downstream of a change are rebuilt.
+Stages whose inputs are ready run concurrently in a pool of worker processes, e.g. the Tc-99m
+and Lu-177 pipelines or the measured and simulated branches.
+"""
+
+import argparse
+import hashlib
+import inspect
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(REPO_DIR))
+
+PAR_FILE = REPO_DIR / 'par_files' / 'recon_OSEM.par'
+
+# Compute module used by most stages; part of their fingerprints
+UTILS = 'stir_simind_utils.py'
+
+# Phantom, scanner and acquisition settings of the notebook, per isotope
+ISOTOPES = {
+    'lu177': {
+        'matrix_size': (128, 128, 128),
+        'voxel_size': (4.4154, 4.4154, 4.4154),
+        'phantom': {
+            "mu_values": {"perspex_mu_value": 0.15, "fill_mu_value": 0.14, "lung_mu_value": 0.043},
+            "activity_concentration_background": 0.0,
+            "include_lung_insert": False,
+            "sphere_dict": {
+                "ring_R": 57,
+                "ring_z": -37,
+                "spheres": {
+                    "diametre_mm": [13, 17, 22, 28, 37, 60],
+                    "angle_loc": [270, 150, 30, 90, 330, 210],
+                    "act_conc_MBq_ml": [1.611, 1.611, 1.611, 1.611, 1.611, 1.611],
+                },
+            },
+            "center_offset_mm": (37.0, 55.0, -4.0),
+        },
+        'config_file': 'Discovery670_lu177.yaml',
+        'source_type': 'lu177',
+        'window_lower': [187.2, 156.4, 229.36],
+        'window_upper': [228.8, 183.6, 258.64],
+        'photopeak_energy': 208,
+        'time_per_proj': 43,
+        'photopeak_window': 1,
+        'scatter_windows': [2, 3],
+        'measured_peak': 'measured_data/lu177/EARL_NEMA_128_EM_en_1_Lu177_EM.hdr',
+        'measured_scatter': ['measured_data/lu177/EARL_NEMA_128_SC1_en_1_Lu177_SC.hdr',
+                             'measured_data/lu177/EARL_NEMA_128_SC2_en_1_Lu177_SC.hdr'],
+    },
+    'tc99m': {
+        'matrix_size': (256, 256, 256),
+        'voxel_size': (2.2077, 2.2077, 2.2077),
+        'phantom': {
+            "mu_values": {"perspex_mu_value": 0.175, "fill_mu_value": 0.154, "lung_mu_value": 0.046},
+            "activity_concentration_background": 0.0,
+            "include_lung_insert": False,
+            "sphere_dict": {
+                "ring_R": 57,
+                "ring_z": -37,
+                "spheres": {
+                    "diametre_mm": [13, 17, 22, 28, 37, 60],
+                    "angle_loc": [270, 150, 30, 90, 330, 210],
+                    "act_conc_MBq_ml": [1.013, 1.013, 1.013, 1.013, 1.013, 1.013],
+                },
+            },
+            "center_offset_mm": (37.0, 50.0, -4.0),
+        },
+        'config_file': 'Discovery670_tc99m.yaml',
+        'source_type': 'tc99m',
+        'window_lower': [114.0, 126.45],
+        'window_upper': [126.0, 154.55],
+        'photopeak_energy': 140,
+        'time_per_proj': 30,
+        'photopeak_window': 2,
+        'scatter_windows': [1],
+        'measured_peak': 'measured_data/tc99m/earl_tc99m_em_en_1_Tc99m_EM.hdr',
+        'measured_scatter': ['measured_data/tc99m/earl_tc99m_sc_en_1_Tc99m_SC.hdr'],
+    },
+}
+
+COLLIMATOR = 'GI-MEGP'
+NUM_PROJECTIONS = 120
+
+
+# ============================================================================
+# Stage functions: (params, inputs, out_dir) -> {output name: file path}
+# inputs maps each dependency stage (without the isotope prefix) to its outputs
+# ============================================================================
+
+def _stir_image(arr, voxel_size):
+    """Create a STIR image (as in the notebook) holding arr"""
+    from sirf_simind_connection.utils.stir_utils import create_stir_image
+
+    image = create_stir_image(arr.shape, voxel_size)
+    image.fill(arr)
+    return image
+
+
+def _read_image(hv_file, voxel_size):
+    """Read an .hv file into a STIR image created as in the notebook"""
+    import numpy as np
+    from stir_simind_utils import open_volume
+
+    return _stir_image(np.array(open_volume(hv_file)), voxel_size)
+
+
+def build_phantom(params, inputs, out_dir):
+    """Generate the EARL NEMA activity and attenuation images"""
+    import phantomgen as phantom
+
+    act_arr, ctac_arr = phantom.create_nema(matrix_size=tuple(params['matrix_size']),
+                                            voxel_size_mm=tuple(params['voxel_size']),
+                                            nema_dict=params['phantom'], supersample=4)
+    outputs = {}
+    for name, arr in (('activity', act_arr), ('attenuation', ctac_arr)):
+        image = _stir_image(arr, tuple(params['voxel_size']))
+        outputs[name] = str(out_dir / f'{name}.hv')
+        getattr(image, 'native_object', image).write_to_file(outputs[name])
+    return outputs
+
+
+def simulate(params, inputs, out_dir):
+    """Run (or restore from the cache) the SIMIND simulation of the phantom"""
+    import numpy as np
+    from stir_simind_utils import open_volume, run_simind_cached
+
+    phantom = inputs['phantom']
+    voxel_size = tuple(params['voxel_size'])
+    source_activity = float(np.sum(open_volume(phantom['activity']))) * params['time_per_proj']
+
+    outputs = run_simind_cached(
+        str(REPO_DIR / params['config_file']), str(out_dir), params['isotope'],
+        _read_image(phantom['activity'], voxel_size), _read_image(phantom['attenuation'], voxel_size),
+        params['window_lower'], params['window_upper'],
+        runtime_switches={'FI': params['source_type'], 'CC': COLLIMATOR},
+        config_values={1: params['photopeak_energy'], 25: source_activity, 29: NUM_PROJECTIONS},
+        cache_dir=params['simind_cache'])
+
+    files = {}
+    for window in outputs.windows:
+        files[f'total_w{window}'] = outputs.total_file(window)
+        files[f'scatter_w{window}'] = outputs.scatter_file(window)
+    return files
+
+
+def add_noise(params, inputs, out_dir):
+    """Add Poisson noise to the simulated windows and form the unscattered ground truth"""
+    import numpy as np
+    from sirf_simind_connection.backends import create_acquisition_data
+    from stir_simind_utils import add_poisson_noise
+
+    simulation = inputs['simulation']
+    rng = np.random.default_rng(params['seed'])
+    peak = params['photopeak_window']
+
+    outputs = {}
+    for window in [peak] + params['scatter_windows']:
+        noisy = add_poisson_noise(create_acquisition_data(simulation[f'total_w{window}']), rng)
+        outputs[f'total_w{window}'] = str(out_dir / f'noisy_total_w{window}.hs')
+        noisy.write(outputs[f'total_w{window}'])
+
+    unscattered = (add_poisson_noise(create_acquisition_data(simulation[f'total_w{peak}']), rng)
+                   - add_poisson_noise(create_acquisition_data(simulation[f'scatter_w{peak}']), rng))
+    outputs['unscattered'] = str(out_dir / 'unscattered.hs')
+    unscattered.write(outputs['unscattered'])
+    return outputs
+
+
+def correct_simulated(params, inputs, out_dir):
+    """DEW/TEW scatter correction of the noisy simulated windows"""
+    from stir_simind_utils import stream_scatter_correction
+
+    noise = inputs['noise']
+    corrected = stream_scatter_correction(
+        noise[f"total_w{params['photopeak_window']}"],
+        [noise[f'total_w{window}'] for window in params['scatter_windows']],
+        str(out_dir / 'simind_corrected.hs'))
+    return {'corrected': corrected}
+
+
+def correct_measured(params, inputs, out_dir):
+    """DEW/TEW scatter correction of the measured data, streamed from the Interfile files"""
+    from stir_simind_utils import stream_scatter_correction
+
+    corrected = stream_scatter_correction(
+        str(REPO_DIR / params['measured_peak']),
+        [str(REPO_DIR / hdr) for hdr in params['measured_scatter']],
+        str(out_dir / 'measured_corrected.hs'))
+    return {'corrected': corrected}
+
+
+def reconstruct(params, inputs, out_dir):
+    """OSEM reconstruction with reconstruct_with_osem"""
+    from stir_simind_utils import reconstruct_with_osem
+
+    data_stage, data_output = params['data']
+    reconstruct_with_osem(inputs[data_stage][data_output], params['prefix'], str(PAR_FILE),
+                          inputs['phantom']['activity'], inputs['phantom']['attenuation'],
+                          num_subsets=params['num_subsets'], num_subiterations=params['num_subiterations'],
+                          temp_dir=str(out_dir), cache_dir=params['aux_cache'])
+    return {'image': str(out_dir / f"{params['prefix']}.hv")}
+
+
+def analyse(params, inputs, out_dir):
+    """Pairwise comparison metrics and sphere statistics of the reconstructions"""
+    import numpy as np
+    from stir_simind_analysis import build_earl_vois, comparison_metrics, voi_statistics
+    from stir_simind_utils import open_volume
+
+    images = {name: inputs[name]['image'] for name in params['recons']}
+    metrics = comparison_metrics(images)
+
+    attenuation = np.asarray(open_volume(inputs['phantom']['attenuation']))
+    vois = build_earl_vois(params['matrix_size'], params['voxel_size'], params['phantom'],
+                           background_mask=attenuation > 0)
+    stats = voi_statistics([np.asarray(open_volume(image)) for image in images.values()], vois)
+
+    report = {
+        'metrics': {f'{a} vs {b}': values for (a, b), values in metrics.items()},
+        'spheres': {name: {key: stats[key][i].tolist() for key in ('mean', 'max', 'peak')}
+                    for i, name in enumerate(images)},
+        'diametre_mm': vois['diametre_mm'],
+    }
+    output = out_dir / 'analysis.json'
+    with open(output, 'wt') as f:
+        json.dump(report, f, indent=1, default=float)
+    return {'report': str(output)}
+
+
+def report(params, inputs, out_dir):
+    """Static HTML report of the reconstructions"""
+    from stir_simind_report import generate_report
+
+    images = {name: inputs[name]['image'] for name in params['recons']}
+    report_file = generate_report({f"{params['isotope']} reconstructions": images}, str(out_dir), planes=(0, 1, 2),
+                                  max_workers=params['report_workers'], title=f"STIR EARL demo ({params['isotope']})")
+    return {'report': report_file}
+
+
+# ============================================================================
+# Stage graph
+# ============================================================================
+
+class Stage:
+    """A node of the pipeline graph"""
+
+    def __init__(self, name, func, deps=(), params=None, files=(), modules=(), helpers=()):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.params = params or {}
+        # repository files read by the stage, part of its fingerprint
+        self.files = list(files)
+        # repository modules and helper functions of this script the stage calls, hashed by content
+        self.modules = list(modules)
+        self.helpers = list(helpers)
+
+
+def build_graph(isotopes, output_dir, num_subsets=4, num_subiterations=24, seed=0, measured=True):
+    """Declare the stages of every isotope pipeline; returns {stage name: Stage}"""
+    from stir_simind_utils import _interfile_data_path, read_interfile_header
+
+    stages = {}
+    for isotope in isotopes:
+        config = dict(ISOTOPES[isotope], isotope=isotope)
+        measured_headers = [config['measured_peak']] + config['measured_scatter']
+        measured_files = list(measured_headers)
+        for hdr in measured_headers:
+            hdr_path = str(REPO_DIR / hdr)
+            if os.path.exists(hdr_path):
+                measured_files.append(_interfile_data_path(hdr_path, read_interfile_header(hdr_path)))
+
+        recon_params = dict(num_subsets=num_subsets, num_subiterations=num_subiterations,
+                            aux_cache=str(Path(output_dir) / 'aux_cache'))
+        recons = {
+            'recon_simind_corrected': ('scatter_simulated', 'corrected'),
+            'recon_simind_unscattered': ('noise', 'unscattered'),
+        }
+        if measured:
+            recons['recon_measured_corrected'] = ('scatter_measured', 'corrected')
+
+        declared = [
+            Stage('phantom', build_phantom, params=config, helpers=[_stir_image]),
+            Stage('simulation', simulate, ['phantom'],
+                  dict(config, simind_cache=str(Path(output_dir) / 'simind_cache')),
+                  files=[config['config_file']], modules=[UTILS], helpers=[_read_image, _stir_image]),
+            Stage('noise', add_noise, ['simulation'], dict(config, seed=seed), modules=[UTILS]),
+            Stage('scatter_simulated', correct_simulated, ['noise'], config, modules=[UTILS]),
+        ]
+        if measured:
+            declared.append(Stage('scatter_measured', correct_measured, [], config, files=measured_files,
+                                  modules=[UTILS]))
+        for name, (data_stage, data_output) in recons.items():
+            declared.append(Stage(name, reconstruct, ['phantom', data_stage],
+                                  dict(recon_params, data=[data_stage, data_output], prefix=name[len('recon_'):]),
+                                  files=[str(PAR_FILE.relative_to(REPO_DIR))], modules=[UTILS]))
+        declared.append(Stage('analysis', analyse, ['phantom'] + list(recons), dict(config, recons=list(recons)),
+                              modules=[UTILS, 'stir_simind_analysis.py']))
+        declared.append(Stage('report', report, list(recons), dict(config, recons=list(recons), report_workers=2),
+                              modules=[UTILS, 'stir_simind_report.py']))
+
+        for stage_def in declared:
+            stage_def.name = f'{isotope}/{stage_def.name}'
+            stage_def.deps = [f'{isotope}/{dep}' for dep in stage_def.deps]
+            stages[stage_def.name] = stage_def
+
+    return stages
+
+
+# ============================================================================
+# Fingerprints and state
+# ============================================================================
+
+def _file_signature(path):
+    """Cheap signature of a file: size and modification time"""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _module_digest(path):
+    """Content hash of a repository module (mtime alone changes on every checkout)"""
+    with open(REPO_DIR / path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def fingerprint(stage_def, dep_fingerprints, dep_outputs):
+    """
+    Hash the stage code (its function, the helpers and the repository modules it calls), parameters,
+    repository input files, upstream fingerprints and upstream outputs
+    """
+    h = hashlib.sha256()
+    h.update(stage_def.name.encode())
+    for func in [stage_def.func] + stage_def.helpers:
+        h.update(inspect.getsource(func).encode())
+    for path in stage_def.modules:
+        h.update(f'{path}:{_module_digest(path)}'.encode())
+    h.update(json.dumps(stage_def.params, sort_keys=True, default=str).encode())
+    for path in stage_def.files:
+        full_path = REPO_DIR / path
+        signature = _file_signature(full_path) if full_path.exists() else None
+        h.update(f'{path}:{signature}'.encode())
+    for dep_fingerprint in dep_fingerprints:
+        h.update(dep_fingerprint.encode())
+    # a rebuilt upstream stage (e.g. with --force) invalidates its dependents
+    for outputs in dep_outputs:
+        h.update(json.dumps({path: _file_signature(path) for path in sorted(outputs.values())}).encode())
+    return h.hexdigest()[:24]
+
+
+def _state_file(output_dir, name):
+    return Path(output_dir) / '.pipeline' / (name.replace('/', '__') + '.json')
+
+
+def load_up_to_date(output_dir, name, stage_fingerprint):
+    """Return the recorded outputs if the stage was built with this fingerprint and its outputs are unchanged"""
+    state_file = _state_file(output_dir, name)
+    if not state_file.exists():
+        return None
+    with open(state_file, 'rt') as f:
+        state = json.load(f)
+    if state['fingerprint'] != stage_fingerprint:
+        return None
+    for path, signature in state['signatures'].items():
+        if not os.path.exists(path) or _file_signature(path) != signature:
+            return None
+    return state['outputs']
+
+
+def save_state(output_dir, name, stage_fingerprint, outputs, wall_s):
+    state_file = _state_file(output_dir, name)
+    state_file.parent.mkdir(parents=True, exist_ok=True)
+    state = {
+        'fingerprint': stage_fingerprint,
+        'outputs': outputs,
+        'signatures': {path: _file_signature(path) for path in outputs.values()},
+        'wall_s': wall_s,
+    }
+    with open(state_file, 'wt') as f:
+        json.dump(state, f, indent=1)
+
+
+def _run_stage(func, params, inputs, out_dir):
+    """Worker entry point: run one stage function and time it"""
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    outputs = func(params, inputs, out_dir)
+    return outputs, time.perf_counter() - start
+
+
+def run_graph(stages, output_dir, jobs=1, threads_per_worker=1, force=(), dry_run=False, verbosity=0):
+    """
+    Build the stages in dependency order, skipping up-to-date ones and running ready stages
+    concurrently. Returns {stage name: 'built' | 'up to date' | 'failed' | 'skipped' | 'stale'}.
+    """
+    from stir_simind_utils import _init_recon_worker, worker_thread_limits
+
+    status = {}
+    fingerprints = {}
+    outputs = {}
+    pending = dict(stages)
+    running = {}
+
+    context = multiprocessing.get_context('spawn')
+    with worker_thread_limits(threads_per_worker), \
+            ProcessPoolExecutor(max_workers=jobs, mp_context=context, initializer=_init_recon_worker,
+                                initargs=(threads_per_worker, verbosity)) as executor:
+        while pending or running:
+            for name, stage_def in list(pending.items()):
+                if any(status.get(dep) in ('failed', 'skipped', 'stale') for dep in stage_def.deps):
+                    status[name] = 'stale' if dry_run else 'skipped'
+                    del pending[name]
+                    continue
+                if not all(status.get(dep) in ('built', 'up to date') for dep in stage_def.deps):
+                    continue
+
+                del pending[name]
+                fingerprints[name] = fingerprint(stage_def, [fingerprints[dep] for dep in stage_def.deps],
+                                                 [outputs[dep] for dep in stage_def.deps])
+                recorded = None if name in force else load_up_to_date(output_dir, name, fingerprints[name])
+                if recorded is not None:
+                    outputs[name] = recorded
+                    status[name] = 'up to date'
+                    print(f'  {name:<40} up to date')
+                elif dry_run:
+                    status[name] = 'stale'
+                    print(f'  {name:<40} would be rebuilt')
+                else:
+                    isotope = name.split('/')[0]
+                    inputs = {dep.split('/', 1)[1]: outputs[dep] for dep in stage_def.deps}
+                    future = executor.submit(_run_stage, stage_def.func, stage_def.params, inputs,
+                                             str(Path(output_dir) / isotope / name.split('/', 1)[1]))
+                    running[future] = name
+                    print(f'  {name:<40} started')
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    outputs[name], wall_s = future.result()
+                except Exception as e:
+                    status[name] = 'failed'
+                    print(f'  {name:<40} FAILED: {e}')
+                    continue
+                save_state(output_dir, name, fingerprints[name], outputs[name], wall_s)
+                status[name] = 'built'
+                print(f'  {name:<40} built in {wall_s:.1f} s')
+
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--isotopes', nargs='+', choices=sorted(ISOTOPES), default=['lu177'])
+    parser.add_argument('--output', default='output/pipeline', help='output directory (default: output/pipeline)')
+    parser.add_argument('--jobs', type=int, default=max(1, (os.cpu_count() or 1) // 2),
+                        help='number of stages run concurrently')
+    parser.add_argument('--threads-per-worker', type=int, default=1)
+    parser.add_argument('--num-subsets', type=int, default=4)
+    parser.add_argument('--num-subiterations', type=int, default=24)
+    parser.add_argument('--seed', type=int, default=0, help='seed of the Poisson noise')
+    parser.add_argument('--force', nargs='*', default=[], metavar='STAGE',
+                        help="rebuild these stages even if up to date (e.g. lu177/noise)")
+    parser.add_argument('--dry-run', action='store_true', help='only report which stages would be rebuilt')
+    parser.add_argument('--no-measured', action='store_true', help='leave out the measured-data branch')
+    parser.add_argument('--verbosity', type=int, default=0, help='verbosity of the stage functions (default: 0)')
+    args = parser.parse_args()
+
+    stages = build_graph(args.isotopes, args.output, args.num_subsets, args.num_subiterations, args.seed,
+                         measured=not args.no_measured)
+    unknown = [name for name in args.force if name not in stages]
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(unknown)} (known: {', '.join(stages)})")
+
+    print("=" * 60)
+    print(f"STIR EARL pipeline: {', '.join(args.isotopes)}")
+    print("=" * 60)
+    start = time.perf_counter()
+    status = run_graph(stages, args.output, args.jobs, args.threads_per_worker, set(args.force), args.dry_run,
+                       args.verbosity)
+
+    counts = {value: sum(1 for s in status.values() if s == value) for value in sorted(set(status.values()))}
+    print(f"\nDone in {time.perf_counter() - start:.1f} s: " + ', '.join(f'{n} {value}' for value, n in counts.items()))
+
+    return 1 if any(s in ('failed', 'skipped') for s in status.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,330 @@
+import itertools
+import os
+
+import numpy as np
+
+
+def _as_numpy(image) -> np.ndarray:
+    '''
+    Return the voxel values of a STIR image (or an ndarray, unchanged).
+    '''
+    if isinstance(image, np.ndarray):
+        return image
+    return image.as_array()
+
+
+def sphere_centers_mm(phantom_dict: dict) -> list:
+    '''
+    Compute the centres of the EARL NEMA spheres from the phantom definition used in the notebook.
+    Spheres lie on a ring of radius ring_R (mm) at axial position ring_z (mm), at the angles in
+    angle_loc (degrees), and the whole phantom is shifted by center_offset_mm = (x, y, z).
+
+    Parameters:
+    phantom_dict (dict): The phantom definition (e.g. earl_nema_dict_lu177 in the notebook).
+
+    Returns (list of tuple): The (z, y, x) centre of each sphere in mm, relative to the image centre.
+    '''
+    sphere_dict = phantom_dict['sphere_dict']
+    offset_x, offset_y, offset_z = phantom_dict.get('center_offset_mm', (0.0, 0.0, 0.0))
+    ring_R = sphere_dict['ring_R']
+    ring_z = sphere_dict['ring_z']
+
+    centers = []
+    for angle in sphere_dict['spheres']['angle_loc']:
+        theta = np.deg2rad(angle)
+        centers.append((offset_z + ring_z,
+                        offset_y + ring_R * np.sin(theta),
+                        offset_x + ring_R * np.cos(theta)))
+    return centers
+
+
+def _voxel_coordinates_mm(matrix_size: tuple, voxel_size: tuple) -> list:
+    '''
+    Return the (z, y, x) voxel centre coordinates in mm along each axis, relative to the image centre.
+    '''
+    return [(np.arange(n) - (n - 1) / 2) * size for n, size in zip(matrix_size, voxel_size)]
+
+
+def _ball_offsets(radius_mm: float, voxel_size: tuple) -> np.ndarray:
+    '''
+    Return the (k, 3) integer voxel offsets of a ball of the given radius.
+    '''
+    half = [int(np.ceil(radius_mm / size)) for size in voxel_size]
+    grids = np.meshgrid(*[np.arange(-h, h + 1) for h in half], indexing='ij')
+    offsets = np.stack([g.ravel() for g in grids], axis=1)
+    dist2 = sum((offsets[:, i] * voxel_size[i]) ** 2 for i in range(3))
+    return offsets[dist2 <= radius_mm ** 2]
+
+
+def build_earl_vois(matrix_size: tuple, voxel_size: tuple, phantom_dict: dict,
+                    background_mask: np.ndarray = None, background_margin_mm: float = 10.0,
+                    peak_volume_ml: float = 1.0) -> dict:
+    '''
+    Precompute flat voxel indices of the EARL spheres and of the background region for one
+    phantom geometry. The result is reused for every reconstruction on that grid.
+
+    Parameters:
+    matrix_size (tuple): Image shape (z, y, x).
+    voxel_size (tuple): Voxel size (z, y, x) in mm.
+    phantom_dict (dict): The phantom definition with sphere_dict and center_offset_mm.
+    background_mask (ndarray, optional): Boolean mask of the phantom body (e.g. attenuation map > 0).
+                                         If None, there is no background VOI.
+    background_margin_mm (float, optional): Distance kept between the background VOI and the
+                                            sphere surfaces (default is 10 mm).
+    peak_volume_ml (float, optional): Volume of the sphere used for peak values (default is 1 mL).
+
+    Returns (dict): {'matrix_size', 'diametre_mm': list, 'spheres': list of flat index arrays,
+                     'peak': list of (n_voxels, n_kernel) flat index arrays, 'background': flat index array or None}.
+    '''
+    matrix_size = tuple(int(n) for n in matrix_size)
+    voxel_size = tuple(float(size) for size in voxel_size)
+    z_mm, y_mm, x_mm = _voxel_coordinates_mm(matrix_size, voxel_size)
+
+    diametres = phantom_dict['sphere_dict']['spheres']['diametre_mm']
+    centers = sphere_centers_mm(phantom_dict)
+
+    peak_radius_mm = (3 * peak_volume_ml * 1000 / (4 * np.pi)) ** (1 / 3)
+    peak_offsets = _ball_offsets(peak_radius_mm, voxel_size)
+
+    spheres, peaks = [], []
+    near_spheres = np.zeros(matrix_size, dtype=bool)
+    for diametre, (cz, cy, cx) in zip(diametres, centers):
+        radius = diametre / 2
+        dist2 = ((z_mm[:, None, None] - cz) ** 2
+                 + (y_mm[None, :, None] - cy) ** 2
+                 + (x_mm[None, None, :] - cx) ** 2)
+
+        sphere_voxels = np.argwhere(dist2 <= radius ** 2)
+        spheres.append(np.ravel_multi_index(sphere_voxels.T, matrix_size))
+
+        # every voxel of the sphere is a candidate centre of the peak VOI
+        neighbours = sphere_voxels[:, None, :] + peak_offsets[None, :, :]
+        for axis, n in enumerate(matrix_size):
+            np.clip(neighbours[..., axis], 0, n - 1, out=neighbours[..., axis])
+        peaks.append(np.ravel_multi_index(np.moveaxis(neighbours, -1, 0), matrix_size))
+
+        near_spheres |= dist2 <= (radius + background_margin_mm) ** 2
+
+    background = None
+    if background_mask is not None:
+        background = np.flatnonzero(np.asarray(background_mask, dtype=bool) & ~near_spheres)
+
+    return {
+        'matrix_size': matrix_size,
+        'diametre_mm': list(diametres),
+        'spheres': spheres,
+        'peak': peaks,
+        'background': background,
+    }
+
+
+def voi_statistics(images, vois: dict) -> dict:
+    '''
+    Compute mean, max and peak values in every sphere (and the background mean) for many images
+    with one indexed gather per VOI.
+
+    Parameters:
+    images (ndarray or list): A stack of shape (M, z, y, x), or a list of STIR images/ndarrays, e.g.
+                              several reconstructions or the estimates of one reconstruction at
+                              successive subiterations.
+    vois (dict): The output of build_earl_vois for the image grid.
+
+    Returns (dict): 'mean', 'max' and 'peak' arrays of shape (M, n_spheres), and 'background_mean'
+                    of shape (M,) (NaN without a background VOI).
+    '''
+    if isinstance(images, np.ndarray):
+        stack = images
+    else:
+        stack = np.stack([_as_numpy(image) for image in images])
+
+    if stack.shape[1:] != vois['matrix_size']:
+        raise ValueError(f"Image shape {stack.shape[1:]} does not match VOI grid {vois['matrix_size']}")
+
+    flat = stack.reshape(stack.shape[0], -1)
+
+    means = np.stack([flat[:, idx].mean(axis=1) for idx in vois['spheres']], axis=1)
+    maxima = np.stack([flat[:, idx].max(axis=1) for idx in vois['spheres']], axis=1)
+    peaks = np.stack([flat[:, idx].mean(axis=2).max(axis=1) for idx in vois['peak']], axis=1)
+
+    if vois['background'] is not None and len(vois['background']) > 0:
+        background_mean = flat[:, vois['background']].mean(axis=1)
+    else:
+        background_mean = np.full(stack.shape[0], np.nan)
+
+    return {'mean': means, 'max': maxima, 'peak': peaks, 'background_mean': background_mean}
+
+
+def recovery_coefficients(images, vois: dict, reference) -> dict:
+    '''
+    Compute mean, max and peak recovery coefficients of the EARL spheres for many images.
+
+    Parameters:
+    images (ndarray or list): A stack of shape (M, z, y, x), or a list of STIR images/ndarrays.
+    vois (dict): The output of build_earl_vois for the image grid.
+    reference (float, sequence or image): The true activity concentration in image units, either a
+                                          scalar, one value per sphere, or a reference image
+                                          (e.g. the phantom) whose sphere means are used.
+
+    Returns (dict): The voi_statistics output plus 'rc_mean', 'rc_max' and 'rc_peak' of shape (M, n_spheres).
+    '''
+    stats = voi_statistics(images, vois)
+
+    if np.ndim(reference) >= 3 or not isinstance(reference, (int, float, list, tuple, np.ndarray)):
+        reference_flat = _as_numpy(reference).reshape(-1)
+        true_values = np.array([reference_flat[idx].mean() for idx in vois['spheres']])
+    else:
+        true_values = np.broadcast_to(np.asarray(reference, dtype=float), (len(vois['spheres']),))
+
+    for key in ('mean', 'max', 'peak'):
+        stats[f'rc_{key}'] = stats[key] / true_values[None, :]
+
+    return stats
+
+
+# Voxels per slab of the chunked metrics (bounds the temporaries to a few MB)
+METRICS_CHUNK_SIZE = 1 << 20
+
+
+def _open_volume(image) -> np.ndarray:
+    '''
+    Return array access to an image without copying where possible: ndarrays (and memmaps) as they
+    are, Interfile headers memory-mapped, STIR/SIRF images through as_array().
+    '''
+    if isinstance(image, (str, os.PathLike)):
+        from stir_simind_utils import open_volume
+        return open_volume(str(image))
+    return _as_numpy(image)
+
+
+def _slabs(shape: tuple, chunk_size: int):
+    '''
+    Yield slices along the first axis covering about chunk_size voxels each.
+    '''
+    per_slice = int(np.prod(shape[1:])) or 1
+    step = max(1, chunk_size // per_slice)
+    for start in range(0, shape[0], step):
+        yield slice(start, min(start + step, shape[0]))
+
+
+def comparison_metrics(images, names=None, reference=None, chunk_size: int = METRICS_CHUNK_SIZE) -> dict:
+    '''
+    Compare reconstructions in one pass over slabs of the volumes: RMSE, NRMSE, maximum absolute
+    difference, bias and Pearson correlation for every pair of images, or of every image against
+    a reference. Memory use is bounded by a few slabs, whatever the number of images.
+
+    Parameters:
+    images (list or dict): STIR images, ndarrays or .hv paths, all of the same shape. With a dict
+                           the keys are used as names.
+    names (list of str, optional): Image names (default is the dict keys or '0', '1', ...).
+    reference (optional): Image (or .hv path) every image is compared with. If None, all pairs are compared.
+    chunk_size (int, optional): Voxels per slab (default is METRICS_CHUNK_SIZE).
+
+    Returns (dict): {(name_a, name_b): {'rmse', 'nrmse', 'max_abs', 'bias', 'correlation'}}, with
+                    bias = mean(a - b) and NRMSE = RMSE / (max(b) - min(b)); b is 'reference'
+                    when comparing against a reference.
+    '''
+    if isinstance(images, dict):
+        names = list(images.keys()) if names is None else list(names)
+        images = list(images.values())
+    volumes = [_open_volume(image) for image in images]
+    names = [str(i) for i in range(len(volumes))] if names is None else list(names)
+
+    if reference is not None:
+        volumes.append(_open_volume(reference))
+        names.append('reference')
+        ref = len(volumes) - 1
+        pairs = [(i, ref) for i in range(ref)]
+    else:
+        pairs = list(itertools.combinations(range(len(volumes)), 2))
+
+    shape = volumes[0].shape
+    for name, volume in zip(names, volumes):
+        if volume.shape != shape:
+            raise ValueError(f'Image {name} has shape {volume.shape}, expected {shape}')
+
+    n_voxels = int(np.prod(shape))
+    # per image: sum, sum of squares, min, max; per pair: sum of differences, of squared
+    # differences and of products, and the maximum absolute difference
+    image_sums = np.zeros((len(volumes), 2))
+    image_min = np.full(len(volumes), np.inf)
+    image_max = np.full(len(volumes), -np.inf)
+    pair_sums = np.zeros((len(pairs), 3))
+    pair_max_abs = np.zeros(len(pairs))
+
+    for slab in _slabs(shape, chunk_size):
+        slab_arrays = [np.asarray(volume[slab], dtype=np.float64).ravel() for volume in volumes]
+        for i, arr in enumerate(slab_arrays):
+            image_sums[i] += (arr.sum(), np.dot(arr, arr))
+            image_min[i] = min(image_min[i], arr.min())
+            image_max[i] = max(image_max[i], arr.max())
+        diff = np.empty_like(slab_arrays[0])
+        for k, (i, j) in enumerate(pairs):
+            np.subtract(slab_arrays[i], slab_arrays[j], out=diff)
+            pair_sums[k] += (diff.sum(), np.dot(diff, diff), np.dot(slab_arrays[i], slab_arrays[j]))
+            pair_max_abs[k] = max(pair_max_abs[k], np.abs(diff, out=diff).max())
+
+    means = image_sums[:, 0] / n_voxels
+    variances = np.maximum(image_sums[:, 1] / n_voxels - means ** 2, 0.0)
+
+    metrics = {}
+    for k, (i, j) in enumerate(pairs):
+        rmse = np.sqrt(pair_sums[k, 1] / n_voxels)
+        value_range = image_max[j] - image_min[j]
+        covariance = pair_sums[k, 2] / n_voxels - means[i] * means[j]
+        denominator = np.sqrt(variances[i] * variances[j])
+        metrics[(names[i], names[j])] = {
+            'rmse': float(rmse),
+            'nrmse': float(rmse / value_range) if value_range > 0 else float('nan'),
+            'max_abs': float(pair_max_abs[k]),
+            'bias': float(pair_sums[k, 0] / n_voxels),
+            'correlation': float(covariance / denominator) if denominator > 0 else float('nan'),
+        }
+
+    return metrics
+
+
+def _welford_update(n: int, x: np.ndarray, mean: np.ndarray, m2: np.ndarray):
+    '''
+    Add realization number n (1-based) to the running mean and sum of squared deviations, in place.
+    '''
+    delta = x - mean
+    mean += delta / n
+    m2 += delta * (x - mean)
+
+
+def voxelwise_mean_variance(realizations, ddof: int = 1, chunk_size: int = METRICS_CHUNK_SIZE) -> dict:
+    '''
+    Voxelwise mean and variance over noise realizations with Welford updates (numerically stable,
+    one pass, without keeping the realizations).
+
+    Parameters:
+    realizations: A stack of shape (M, z, y, x) (ndarray or memmap, processed slab by slab), or an
+                  iterable of STIR images/ndarrays/.hv paths (e.g. a generator of reconstructions,
+                  processed one realization at a time).
+    ddof (int, optional): Delta degrees of freedom of the variance (default is 1, the sample variance).
+    chunk_size (int, optional): Voxels per slab for stacked input (default is METRICS_CHUNK_SIZE).
+
+    Returns (dict): 'mean' and 'variance' arrays of the image shape and the number of realizations 'n'.
+    '''
+    if isinstance(realizations, np.ndarray) and realizations.ndim == 4:
+        n = realizations.shape[0]
+        mean = np.zeros(realizations.shape[1:])
+        m2 = np.zeros(realizations.shape[1:])
+        for slab in _slabs(realizations.shape[1:], chunk_size):
+            for k in range(n):
+                _welford_update(k + 1, realizations[k, slab], mean[slab], m2[slab])
+    else:
+        n, mean, m2 = 0, None, None
+        for realization in realizations:
+            arr = _open_volume(realization)
+            if mean is None:
+                mean, m2 = np.zeros(arr.shape), np.zeros(arr.shape)
+            elif arr.shape != mean.shape:
+                raise ValueError(f'Realization {n} has shape {arr.shape}, expected {mean.shape}')
+            n += 1
+            _welford_update(n, arr, mean, m2)
+        if n == 0:
+            raise ValueError('No realizations given')
+
+    variance = m2 / (n - ddof) if n > ddof else np.full(mean.shape, np.nan)
+    return {'mean': mean, 'variance': variance, 'n': n}
@@ -0,0 +1,143 @@
+import os
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+from stir_simind_utils import image_to_image2d, open_volume
+
+
+def display(images, slc=0, plane=0, cmap='inferno', _min=0, _max=0):
+    '''
+    Display images/acquisition data for a specific slice/projection and plane.
+
+    Parameters:
+    images (list of ImageData or AcquisitionData or ndarray or str): The input image data. Paths to
+                                                                  Interfile headers are memory-mapped and
+                                                                  only the displayed plane is read.
+    slc (int, optional): The slice/projection to be displayed (default is 0).
+    plane (int, optional): The plane to be displayed (0: transverse, 1: coronal, 2: sagittal, default is 0).
+    cmap (str, optional): The colormap for the displayed images (default is 'inferno').
+    _min (float, optional): The minimum value to be displayed (default is 0 which displays the image's own minimum).
+    _max (float, optional): The maximum value to be displayed (default is 0 which displays the image's own maximum).
+        
+    Returns: --
+    '''
+    # a path, an array or a STIR/SIRF object is one image, not a sequence of images
+    if isinstance(images, (str, os.PathLike, np.ndarray)) or hasattr(images, 'as_array'):
+        images = [images]
+    n_plots = len(images)
+
+    if n_plots == 1:
+        im_arr = image_to_image2d(images[0], slc, plane)
+        if (_min, _max) == (0, 0):
+            _min, _max = np.amin(im_arr), np.amax(im_arr)
+    else:
+        im_arr = [image_to_image2d(im, slc, plane) for im in images]
+        if (_min, _max) == (0, 0):
+            # window from the displayed slices only, without stacking them into a new array
+            _min = min(np.amin(arr) for arr in im_arr)
+            _max = max(np.amax(arr) for arr in im_arr)
+    
+    fig, axes = plt.subplots(1, n_plots)
+    fig.set_figheight(6)
+    fig.set_figwidth(18)
+
+    fig.suptitle(f'Display slice/projection [{slc}]', color='black', weight='bold', fontsize=20)
+    if n_plots == 1:
+        ax_im = axes.imshow(im_arr, cmap=cmap, vmin=_min, vmax=_max)
+        fig.colorbar(ax_im)
+    else:
+        for i, ax in enumerate(axes.flat):
+            ax_im = ax.imshow(im_arr[i], cmap=cmap, vmin=_min, vmax=_max)
+            fig.colorbar(ax_im)
+
+
+def compare_reconstructions(recon_dict: dict, slice_idx: int = None, cmap: str = 'hot',
+                           vmin: float = None, vmax: float = None):
+    '''
+    Compare multiple reconstructed images side by side.
+
+    Parameters:
+    recon_dict (dict): Dictionary of {name: image} pairs, where an image is a stir.FloatVoxelsOnCartesianGrid,
+                       an ndarray or the path of an .hv file.
+    slice_idx (int, optional): Slice index to display. If None, uses middle slice.
+    cmap (str): Colormap for display (default: 'hot').
+    vmin (float, optional): Minimum value for color scale.
+    vmax (float, optional): Maximum value for color scale.
+
+    Returns: matplotlib figure and axes objects.
+    '''
+    n_images = len(recon_dict)
+    fig, axes = plt.subplots(1, n_images, figsize=(6*n_images, 5))
+
+    if n_images == 1:
+        axes = [axes]
+
+    # Only the displayed slice of each image is extracted (views/memmaps where possible)
+    volumes = [open_volume(img) for img in recon_dict.values()]
+
+    # Determine slice index if not provided
+    if slice_idx is None:
+        slice_idx = volumes[0].shape[0] // 2
+
+    slices = [np.asarray(vol[slice_idx, :, :]) for vol in volumes]
+
+    # Determine color scale if not provided
+    if vmin is None:
+        vmin = min(np.min(slc) for slc in slices)
+    if vmax is None:
+        vmax = max(np.max(slc) for slc in slices)
+
+    # Plot each image
+    for idx, name in enumerate(recon_dict):
+        im = axes[idx].imshow(slices[idx], cmap=cmap, vmin=vmin, vmax=vmax)
+        axes[idx].set_title(name, fontsize=14, fontweight='bold')
+        axes[idx].axis('off')
+        plt.colorbar(im, ax=axes[idx], fraction=0.046, pad=0.04)
+
+    fig.suptitle(f'Reconstruction Comparison (Slice {slice_idx})', fontsize=16, fontweight='bold')
+    plt.tight_layout()
+
+    return fig, axes
+
+
+def display_montage(images, slices, plane: int = 0, cmap: str = 'inferno', vmin: float = None,
+                    vmax: float = None, titles=None):
+    '''
+    Display a montage of several slices (columns) of several images (rows) with one shared window.
+    Only the displayed planes are extracted, so paths to Interfile files are never fully read.
+
+    Parameters:
+    images (list of ImageData or ndarray or str): The images (or paths of their .hv files).
+    slices (list of int): The slices to display (same convention as display).
+    plane (int, optional): The plane to be displayed (0: transverse, 1: coronal, 2: sagittal, default is 0).
+    cmap (str, optional): The colormap (default is 'inferno').
+    vmin (float, optional): Minimum of the color scale (default is the minimum of the displayed slices).
+    vmax (float, optional): Maximum of the color scale (default is the maximum of the displayed slices).
+    titles (list of str, optional): Row titles.
+
+    Returns: matplotlib figure and axes objects.
+    '''
+    volumes = [open_volume(img) for img in images]
+    planes = [[image_to_image2d(vol, slc, plane) for slc in slices] for vol in volumes]
+
+    if vmin is None:
+        vmin = min(np.amin(arr) for row in planes for arr in row)
+    if vmax is None:
+        vmax = max(np.amax(arr) for row in planes for arr in row)
+
+    fig, axes = plt.subplots(len(volumes), len(slices), squeeze=False,
+                             figsize=(2 * len(slices), 2 * len(volumes)))
+    for i, row in enumerate(planes):
+        for j, arr in enumerate(row):
+            axes[i, j].imshow(arr, cmap=cmap, vmin=vmin, vmax=vmax)
+            axes[i, j].set_xticks([])
+            axes[i, j].set_yticks([])
+            if i == 0:
+                axes[i, j].set_title(f'[{slices[j]}]')
+        if titles is not None:
+            axes[i, 0].set_ylabel(titles[i])
+
+    plt.tight_layout()
+
+    return fig, axes
@@ -0,0 +1,323 @@
+import html
+import os
+import time
+
+import numpy as np
+
+from stir_simind_trace import log, stage
+
+
+# Voxels per slab when computing image statistics
+STATS_CHUNK_SIZE = 1 << 20
+
+_PLANE_NAMES = {0: 'transverse', 1: 'coronal', 2: 'sagittal'}
+
+
+def _init_report_worker():
+    '''
+    Select the non-interactive Agg backend in a report worker, before any figure is made.
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def _share_report_images(sets: dict, data_dir: str) -> dict:
+    '''
+    Images that are not paths (ndarrays, STIR images) cannot be memory-mapped by the workers:
+    write each one once to data_dir as .npy and return the sets with paths only.
+    '''
+    written = {}
+    shared = {}
+    for set_name, images in sets.items():
+        shared[set_name] = {}
+        for name, image in images.items():
+            if isinstance(image, (str, os.PathLike)):
+                shared[set_name][name] = str(image)
+                continue
+            if id(image) not in written:
+                os.makedirs(data_dir, exist_ok=True)
+                data_file = os.path.join(data_dir, f'image_{len(written)}.npy')
+                arr = image if isinstance(image, np.ndarray) else image.as_array()
+                np.save(data_file, np.asarray(arr, dtype=np.float32))
+                written[id(image)] = data_file
+            shared[set_name][name] = written[id(image)]
+    return shared
+
+
+def _load_volume(path: str) -> np.ndarray:
+    '''
+    Memory-map a shared .npy file or an Interfile header.
+    '''
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    from stir_simind_utils import open_volume
+    return open_volume(path)
+
+
+def image_statistics(image, chunk_size: int = STATS_CHUNK_SIZE) -> dict:
+    '''
+    Compute shape, min, max, mean and standard deviation of an image or projections in one pass
+    over slabs, so Interfile files are never fully loaded.
+
+    Parameters:
+    image (ImageData or AcquisitionData or ndarray or str): The image, or the path of its Interfile
+                                                            header or of a .npy file.
+    chunk_size (int, optional): Voxels per slab (default is STATS_CHUNK_SIZE).
+
+    Returns (dict): 'shape' (as open_volume), 'min', 'max', 'mean' and 'std' (population standard deviation).
+    '''
+    if isinstance(image, (str, os.PathLike)):
+        vol = _load_volume(str(image))
+    else:
+        from stir_simind_utils import open_volume
+        vol = open_volume(image)
+    shape = tuple(int(s) for s in vol.shape)
+    # projections (1, axial, views, tangential) are reduced over the same voxels as (axial, views, tangential)
+    vol = vol.reshape(vol.shape[1:]) if vol.ndim == 4 and vol.shape[0] == 1 else vol
+
+    n, mean, m2 = 0, 0.0, 0.0
+    _min, _max = np.inf, -np.inf
+    per_slice = int(np.prod(vol.shape[1:])) or 1
+    step = max(1, chunk_size // per_slice)
+    for start in range(0, vol.shape[0], step):
+        slab = np.asarray(vol[start:start + step], dtype=np.float64)
+        if not slab.size:
+            continue
+        # combine the slab's mean and sum of squared deviations with the running ones (Chan et al.)
+        slab_mean = slab.mean()
+        slab_m2 = float(np.square(slab - slab_mean).sum())
+        total = n + slab.size
+        delta = slab_mean - mean
+        mean += delta * slab.size / total
+        m2 += slab_m2 + delta * delta * n * slab.size / total
+        n = total
+        _min = min(_min, float(slab.min()))
+        _max = max(_max, float(slab.max()))
+
+    return {
+        'shape': shape,
+        'min': _min,
+        'max': _max,
+        'mean': float(mean),
+        'std': float(np.sqrt(m2 / n)) if n else float('nan'),
+    }
+
+
+def _default_slices(shape: tuple, planes) -> dict:
+    '''
+    The middle slice of every plane, or the middle view of projections (same 1-based convention as display).
+    '''
+    if len(shape) == 4:
+        return {0: [shape[2] // 2 + 1]}
+    return {plane: [shape[plane] // 2 + 1] for plane in planes}
+
+
+def _render_tiles(tiles: list) -> list:
+    '''
+    Write color-mapped PNG tiles of single slices/views, without axes or text (names, slice numbers
+    and the color bar are laid out by the HTML report), which is much faster than drawing figures.
+
+    Parameters:
+    tiles (list of dict): 'path', 'slice', 'plane', 'window', 'cmap' and 'output' of every tile.
+
+    Returns (list): The paths of the tiles.
+    '''
+    from matplotlib.image import imsave
+
+    from stir_simind_utils import image_to_image2d
+
+    for tile in tiles:
+        arr = image_to_image2d(_load_volume(tile['path']), tile['slice'], tile['plane'])
+        vmin, vmax = tile['window']
+        imsave(tile['output'], arr, cmap=tile['cmap'], vmin=vmin, vmax=vmax)
+    return [tile['output'] for tile in tiles]
+
+
+def _render_colorbar(task: dict) -> str:
+    '''
+    Write the color bar of a set as a vertical PNG strip, maximum at the top.
+    '''
+    from matplotlib.image import imsave
+
+    vmin, vmax = task['window']
+    strip = np.repeat(np.linspace(vmax, vmin, 128)[:, None], 8, axis=1)
+    imsave(task['output'], strip, cmap=task['cmap'], vmin=vmin, vmax=vmax)
+    return task['output']
+
+
+def _render_profile(task: dict) -> str:
+    '''
+    Render the line profiles of every image of a set through the central row of a transverse slice.
+    '''
+    from matplotlib.figure import Figure
+
+    from stir_simind_utils import image_to_image2d
+
+    fig = Figure(figsize=(6, 3.2))
+    ax = fig.subplots()
+    for name, path in task['images'].items():
+        arr = image_to_image2d(_load_volume(path), task['slice'], 0)
+        ax.plot(arr[arr.shape[0] // 2, :], label=name, linewidth=1)
+    if task['window'][1] > task['window'][0]:
+        ax.set_ylim(*task['window'])
+    ax.set_xlabel('Voxel')
+    ax.set_ylabel('Value')
+    ax.set_title(f"Line profile, transverse [{task['slice']}]", fontsize=10)
+    ax.legend(fontsize=7)
+    ax.grid(alpha=0.3)
+    fig.tight_layout()
+    fig.savefig(task['output'], dpi=task['dpi'])
+    return task['output']
+
+
+def _html_report(title: str, sections: list, elapsed_s: float, tile_width: int) -> str:
+    '''
+    Build the HTML document of the report.
+    '''
+    parts = [
+        '<!DOCTYPE html>',
+        '<html><head><meta charset="utf-8">',
+        f'<title>{html.escape(title)}</title>',
+        '<style>body{font-family:sans-serif;margin:2em}table{border-collapse:collapse;margin-bottom:1em}'
+        'td,th{border:1px solid #ccc;padding:2px 8px;text-align:right}td:first-child{text-align:left}'
+        '.row{display:flex;flex-wrap:wrap;align-items:flex-end;gap:6px;margin-bottom:1em}'
+        'figure{margin:0;text-align:center;font-size:small}'
+        f'.tile{{width:{tile_width}px;image-rendering:pixelated}}'
+        f'.colorbar{{width:12px;height:{tile_width}px;image-rendering:pixelated}}</style>',
+        '</head><body>',
+        f'<h1>{html.escape(title)}</h1>',
+        f'<p>Generated {time.strftime("%Y-%m-%d %H:%M:%S")} in {elapsed_s:.1f} s.</p>',
+    ]
+    for section in sections:
+        vmin, vmax = section['window']
+        parts.append(f"<h2>{html.escape(section['name'])}</h2>")
+        parts.append('<table><tr><th>Image</th><th>Shape</th><th>Min</th><th>Max</th><th>Mean</th><th>Std</th></tr>')
+        for name, stats in section['stats'].items():
+            shape = ' &times; '.join(str(s) for s in stats['shape'])
+            parts.append(f"<tr><td>{html.escape(name)}</td><td>{shape}</td><td>{stats['min']:.4g}</td>"
+                         f"<td>{stats['max']:.4g}</td><td>{stats['mean']:.4g}</td><td>{stats['std']:.4g}</td></tr>")
+        parts.append('</table>')
+
+        colorbar = (f'<figure><figcaption>{vmax:.4g}</figcaption>'
+                    f'<img class="colorbar" src="{html.escape(section["colorbar"])}" alt="color bar">'
+                    f'<figcaption>{vmin:.4g}</figcaption></figure>')
+        for label, tiles in section['rows']:
+            parts.append(f'<h3>{html.escape(label)}</h3><div class="row">')
+            for name, tile in tiles:
+                parts.append(f'<figure><img class="tile" src="{html.escape(tile)}" alt="{html.escape(name)}">'
+                             f'<figcaption>{html.escape(name)}</figcaption></figure>')
+            parts.append(colorbar + '</div>')
+        if section['profile']:
+            parts.append(f'<img src="{html.escape(section["profile"])}" alt="line profile">')
+    parts.append('</body></html>')
+    return '\n'.join(parts) + '\n'
+
+
+def generate_report(sets: dict, output_dir: str, planes=(0,), slices=None, windows: dict = None,
+                    cmap: str = 'hot', profile: bool = True, tile_width: int = 192, dpi: int = 80,
+                    max_workers: int = None, title: str = 'STIR EARL report') -> str:
+    '''
+    Render slices of sets of images (e.g. the reconstructions of a comparison or of a sweep) to PNG
+    with the Agg backend in a pool of worker processes, and assemble them with a statistics table
+    per set into a static HTML report. Every set gets one color window, computed once from the
+    statistics of all its images and shared by all its slices and its line profile.
+
+    Parameters:
+    sets (dict): {set name: {image name: image}}, where an image is a STIR image, an ndarray or the path
+                 of an Interfile header. All images of a set must have the same shape.
+    output_dir (str): Directory of the report (index.html and figures/).
+    planes (tuple of int, optional): Planes rendered (0: transverse, 1: coronal, 2: sagittal,
+                                     default is transverse only). Projections are rendered as views.
+    slices (list of int or dict, optional): Slices rendered in every plane (same 1-based convention as
+                                            display), or a {plane: slices} dict (default is the middle
+                                            slice of each plane).
+    windows (dict, optional): {set name: (vmin, vmax)} overriding the color window of some sets.
+    cmap (str, optional): The colormap (default is 'hot').
+    profile (bool, optional): Also plot line profiles through the first transverse slice (default is True).
+    tile_width (int, optional): Displayed width of the slices in pixels (default is 192).
+    dpi (int, optional): Resolution of the line profile plots (default is 80).
+    max_workers (int, optional): Number of worker processes (default is the number of CPUs).
+    title (str, optional): Title of the report.
+
+    Returns (str): The path of the HTML report.
+    '''
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    start = time.perf_counter()
+    figures_dir = os.path.join(output_dir, 'figures')
+    os.makedirs(figures_dir, exist_ok=True)
+    shared = _share_report_images(sets, os.path.join(output_dir, 'data'))
+
+    paths = [path for images in shared.values() for path in images.values()]
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = max(1, min(max_workers, len(paths)))
+
+    context = multiprocessing.get_context('spawn')
+    with stage('report', sets=len(sets), images=len(paths), workers=max_workers), \
+            ProcessPoolExecutor(max_workers=max_workers, mp_context=context,
+                                initializer=_init_report_worker) as executor:
+        # one statistics pass per distinct image; the set windows follow from them
+        unique_paths = list(dict.fromkeys(paths))
+        chunksize = max(1, len(unique_paths) // (4 * max_workers))
+        stats = dict(zip(unique_paths, executor.map(image_statistics, unique_paths, chunksize=chunksize)))
+
+        sections, tiles, figure_tasks = [], [], []
+        for i, (set_name, images) in enumerate(shared.items()):
+            set_stats = {name: stats[path] for name, path in images.items()}
+            if windows and set_name in windows:
+                window = tuple(windows[set_name])
+            else:
+                window = (min(s['min'] for s in set_stats.values()), max(s['max'] for s in set_stats.values()))
+
+            shape = next(iter(set_stats.values()))['shape']
+            # projections (1, axial, views, tangential) are rendered as views
+            set_planes = list(planes) if len(shape) == 3 else [0]
+            if slices is None:
+                set_slices = _default_slices(shape, set_planes)
+            elif isinstance(slices, dict):
+                set_slices = {plane: list(slices.get(plane, [])) for plane in set_planes}
+            else:
+                set_slices = {plane: list(slices) for plane in set_planes}
+
+            rows = []
+            for plane in set_planes:
+                for slc in set_slices[plane]:
+                    row = []
+                    for j, (name, path) in enumerate(images.items()):
+                        tile = f'set{i:03d}_p{plane}_s{slc}_{j:04d}.png'
+                        tiles.append({'path': path, 'slice': slc, 'plane': plane, 'window': window,
+                                      'cmap': cmap, 'output': os.path.join(figures_dir, tile)})
+                        row.append((name, f'figures/{tile}'))
+                    label = f"{_PLANE_NAMES[plane]} [{slc}]" if len(shape) == 3 else f'view [{slc}]'
+                    rows.append((label, row))
+
+            colorbar = f'set{i:03d}_colorbar.png'
+            figure_tasks.append((_render_colorbar, {'window': window, 'cmap': cmap,
+                                                    'output': os.path.join(figures_dir, colorbar)}))
+            profile_figure = None
+            if profile and len(shape) == 3 and set_slices.get(0):
+                profile_figure = f'set{i:03d}_profile.png'
+                figure_tasks.append((_render_profile, {'images': images, 'slice': set_slices[0][0],
+                                                       'window': window, 'dpi': dpi,
+                                                       'output': os.path.join(figures_dir, profile_figure)}))
+                profile_figure = f'figures/{profile_figure}'
+
+            sections.append({'name': set_name, 'window': window, 'stats': set_stats, 'rows': rows,
+                             'colorbar': f'figures/{colorbar}', 'profile': profile_figure})
+
+        # tiles in batches, a few per worker, to amortize the task overhead
+        batch = max(1, -(-len(tiles) // (4 * max_workers)))
+        futures = [executor.submit(func, task) for func, task in figure_tasks]
+        futures += [executor.submit(_render_tiles, tiles[k:k + batch]) for k in range(0, len(tiles), batch)]
+        for future in futures:
+            future.result()
+
+    elapsed = time.perf_counter() - start
+    report_file = os.path.join(output_dir, 'index.html')
+    with open(report_file, 'wt') as f:
+        f.write(_html_report(title, sections, elapsed, tile_width))
+    log(f'Report of {len(sets)} sets ({len(tiles)} slices) written to {report_file} in {elapsed:.1f} s')
+
+    return report_file
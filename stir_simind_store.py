@@ -0,0 +1,261 @@
+import json
+import os
+import zlib
+
+import numpy as np
+
+
+# Leading-axis planes (views of projections, slices of images) per compressed chunk
+CHUNK_SLICES = 8
+
+ENCODINGS = ('raw', 'zlib', 'counts')
+
+
+def _entry_key(kind: str, realization: int = None, window: int = None, subiteration: int = None) -> str:
+    '''
+    Build the key of a store entry, e.g. 'projections/r0003/w1' or 'image/r0003/s24'.
+    '''
+    if kind not in ('projections', 'image'):
+        raise ValueError(f"Unknown kind: {kind}. Choose 'projections' or 'image'")
+    parts = [kind]
+    if realization is not None:
+        parts.append(f'r{int(realization):04d}')
+    if window is not None:
+        parts.append(f'w{int(window)}')
+    if subiteration is not None:
+        parts.append(f's{int(subiteration)}')
+    return '/'.join(parts)
+
+
+def _counts_dtype(arr: np.ndarray) -> np.dtype:
+    '''
+    Return the smallest unsigned integer dtype holding arr exactly, or raise ValueError if arr
+    does not contain non-negative integer counts.
+    '''
+    if arr.size and (arr.min() < 0 or not np.array_equal(arr, np.rint(arr))):
+        raise ValueError("The 'counts' encoding needs non-negative integer values (e.g. Poisson data)")
+    maximum = arr.max() if arr.size else 0
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if maximum <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def _as_stored_array(data, kind: str) -> np.ndarray:
+    '''
+    Return data as the stored array: projections as (views, axial, tangential), like the Interfile
+    data file, so single views are contiguous; images as (z, y, x).
+    '''
+    if isinstance(data, (str, os.PathLike)):
+        from stir_simind_utils import memmap_interfile_image, memmap_interfile_projections
+        if kind == 'projections':
+            return memmap_interfile_projections(str(data))
+        return memmap_interfile_image(str(data))
+
+    arr = data if isinstance(data, np.ndarray) else data.as_array()
+    if kind == 'projections' and arr.ndim == 4:
+        # as_array() order (1, axial, views, tangential)
+        arr = arr[0].transpose(1, 0, 2)
+    if arr.ndim != 3:
+        raise ValueError(f'Expected a 3D {kind} array, got shape {arr.shape}')
+    return arr
+
+
+class EnsembleStore:
+    '''
+    Chunked, optionally compressed container for stacks of projections and images (noise
+    realizations, energy windows, subiterations) in one directory: a single append-only data file,
+    a JSON index and the Interfile header templates used for export.
+
+    Encodings:
+    'raw': float32, uncompressed; any view or slice is read straight from a memory map.
+    'zlib': float32, losslessly compressed in chunks of CHUNK_SLICES planes.
+    'counts': integer counts (e.g. Poisson realizations) in the smallest unsigned integer type,
+              compressed in chunks; lossless for integer data.
+
+    Single views/slices are read by decompressing only the chunk that holds them, from a memory
+    map of the data file.
+    '''
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        os.makedirs(os.path.join(self.path, 'headers'), exist_ok=True)
+        self._index_file = os.path.join(self.path, 'index.json')
+        self._data_file = os.path.join(self.path, 'data.bin')
+        self._mm = None
+        if os.path.exists(self._index_file):
+            with open(self._index_file, 'rt') as f:
+                self.index = json.load(f)
+        else:
+            self.index = {}
+        if not os.path.exists(self._data_file):
+            open(self._data_file, 'wb').close()
+
+    def keys(self) -> list:
+        return list(self.index.keys())
+
+    def __contains__(self, key) -> bool:
+        return key in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _key(self, kind, realization, window, subiteration) -> str:
+        key = _entry_key(kind, realization, window, subiteration)
+        if key not in self.index:
+            raise KeyError(f'No entry {key} in {self.path}')
+        return key
+
+    def _write_index(self):
+        # written to a temporary file and moved into place, so the index is never partially written
+        tmp_file = self._index_file + '.tmp'
+        with open(tmp_file, 'wt') as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(tmp_file, self._index_file)
+
+    def _data(self) -> np.memmap:
+        # (re)map the data file when it has grown since it was last mapped
+        size = os.path.getsize(self._data_file)
+        if self._mm is None or len(self._mm) != size:
+            self._mm = np.memmap(self._data_file, dtype=np.uint8, mode='r') if size else np.zeros(0, np.uint8)
+        return self._mm
+
+    def put(self, data, kind: str, realization: int = None, window: int = None, subiteration: int = None,
+            encoding: str = 'zlib', header: str = None, level: int = 1) -> str:
+        '''
+        Append projections or an image to the store, replacing any entry with the same key
+        (the space of a replaced entry is not reclaimed).
+
+        Parameters:
+        data: Acquisition data/STIR image, ndarray (projections as (1, axial, views, tangential) or
+              (views, axial, tangential), images as (z, y, x)) or path of an Interfile header.
+        kind (str): 'projections' or 'image'.
+        realization, window, subiteration (int, optional): Index of the entry.
+        encoding (str, optional): 'raw', 'zlib' or 'counts' (default is 'zlib').
+        header (str, optional): Interfile header of the same geometry, kept for export_interfile
+                                (default is data itself when it is a path).
+        level (int, optional): zlib compression level (default is 1, fastest).
+
+        Returns (str): The entry key.
+        '''
+        if encoding not in ENCODINGS:
+            raise ValueError(f'Unknown encoding: {encoding}. Choose one of {ENCODINGS}')
+        key = _entry_key(kind, realization, window, subiteration)
+        if header is None and isinstance(data, (str, os.PathLike)):
+            header = str(data)
+
+        arr = _as_stored_array(data, kind)
+        if encoding == 'counts':
+            stored_dtype = _counts_dtype(np.asarray(arr))
+        else:
+            stored_dtype = np.dtype('<f4')
+
+        entry = {
+            'kind': kind,
+            'shape': list(arr.shape),
+            'encoding': encoding,
+            'dtype': stored_dtype.str,
+            'chunk_slices': CHUNK_SLICES,
+            'chunks': [],
+            'header': None,
+        }
+
+        with open(self._data_file, 'ab') as f:
+            offset = f.tell()
+            if encoding == 'raw':
+                f.write(np.ascontiguousarray(arr, dtype=stored_dtype).tobytes())
+                entry['chunks'].append([offset, f.tell() - offset])
+            else:
+                for start in range(0, arr.shape[0], CHUNK_SLICES):
+                    chunk = np.ascontiguousarray(arr[start:start + CHUNK_SLICES], dtype=stored_dtype)
+                    compressed = zlib.compress(chunk.tobytes(), level)
+                    entry['chunks'].append([f.tell(), len(compressed)])
+                    f.write(compressed)
+
+        if header is not None:
+            header_file = os.path.join('headers', key.replace('/', '_') + os.path.splitext(header)[1])
+            with open(header, 'rt') as src, open(os.path.join(self.path, header_file), 'wt') as dst:
+                dst.write(src.read())
+            entry['header'] = header_file
+
+        self.index[key] = entry
+        self._write_index()
+        return key
+
+    def _read_chunk(self, entry: dict, i: int) -> np.ndarray:
+        offset, length = entry['chunks'][i]
+        n_planes = min(entry['chunk_slices'], entry['shape'][0] - i * entry['chunk_slices'])
+        raw = zlib.decompress(self._data()[offset:offset + length])
+        return np.frombuffer(raw, dtype=entry['dtype']).reshape([n_planes] + entry['shape'][1:])
+
+    def get(self, kind: str, realization: int = None, window: int = None, subiteration: int = None) -> np.ndarray:
+        '''
+        Read an entry: projections as (views, axial, tangential), images as (z, y, x).
+        Raw entries are returned as read-only memory maps; others are decompressed to float32.
+        '''
+        entry = self.index[self._key(kind, realization, window, subiteration)]
+        if entry['encoding'] == 'raw':
+            offset, length = entry['chunks'][0]
+            return self._data()[offset:offset + length].view(entry['dtype']).reshape(entry['shape'])
+
+        out = np.empty(entry['shape'], dtype=np.float32)
+        for i in range(len(entry['chunks'])):
+            start = i * entry['chunk_slices']
+            out[start:start + entry['chunk_slices']] = self._read_chunk(entry, i)
+        return out
+
+    def get_plane(self, index: int, kind: str, realization: int = None, window: int = None,
+                  subiteration: int = None) -> np.ndarray:
+        '''
+        Read a single view (projections) or transverse slice (image), 0-based, touching only
+        the chunk that holds it.
+        '''
+        entry = self.index[self._key(kind, realization, window, subiteration)]
+        if not 0 <= index < entry['shape'][0]:
+            raise IndexError(f"Plane {index} out of range for shape {entry['shape']}")
+        if entry['encoding'] == 'raw':
+            return self.get(kind, realization, window, subiteration)[index]
+
+        chunk, position = divmod(index, entry['chunk_slices'])
+        return self._read_chunk(entry, chunk)[position].astype(np.float32)
+
+    def export_interfile(self, output_header: str, kind: str, realization: int = None, window: int = None,
+                         subiteration: int = None, header: str = None) -> str:
+        '''
+        Write an entry as a float32 Interfile pair that STIR can read.
+
+        Parameters:
+        output_header (str): Path of the output header (.hs for projections, .hv for images).
+        kind, realization, window, subiteration: Index of the entry.
+        header (str, optional): Interfile header of the same geometry to use instead of the one
+                                stored with the entry.
+
+        Returns (str): The output header path.
+        '''
+        from stir_simind_utils import _write_float_interfile_header
+
+        key = self._key(kind, realization, window, subiteration)
+        entry = self.index[key]
+        template = header or (os.path.join(self.path, entry['header']) if entry['header'] else None)
+        if template is None:
+            raise ValueError(f'Entry {key} has no header template; pass header=')
+
+        output_data = os.path.splitext(output_header)[0] + ('.s' if kind == 'projections' else '.v')
+        with open(output_data, 'wb') as f:
+            for i in range(0, entry['shape'][0], entry['chunk_slices']):
+                if entry['encoding'] == 'raw':
+                    block = self.get(kind, realization, window, subiteration)[i:i + entry['chunk_slices']]
+                else:
+                    block = self._read_chunk(entry, i // entry['chunk_slices'])
+                f.write(np.ascontiguousarray(block, dtype='<f4').tobytes())
+        _write_float_interfile_header(template, output_header, os.path.basename(output_data))
+
+        return output_header
+
+    def nbytes(self) -> dict:
+        '''
+        Return the stored and the uncompressed float32 size of all entries, in bytes.
+        '''
+        stored = sum(length for entry in self.index.values() for _, length in entry['chunks'])
+        uncompressed = sum(4 * int(np.prod(entry['shape'])) for entry in self.index.values())
+        return {'stored': stored, 'uncompressed': uncompressed}
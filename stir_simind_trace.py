@@ -0,0 +1,231 @@
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+# 0: silent, 1: progress messages (default), 2: detailed messages
+VERBOSITY = int(os.environ.get('STIR_SIMIND_VERBOSITY', 1))
+
+_lock = threading.Lock()
+_events = []
+_local = threading.local()
+_t0 = time.perf_counter()
+# wall-clock time of _t0, to place the events of worker processes on this process's timeline
+_t0_epoch = time.time()
+
+
+def set_verbosity(level: int):
+    '''
+    Set the verbosity of the progress messages of the demo utilities.
+
+    Parameters:
+    level (int): 0 silences all messages, 1 prints progress (default), 2 prints details.
+    '''
+    global VERBOSITY
+    VERBOSITY = int(level)
+
+
+def log(message: str, level: int = 1):
+    '''
+    Print a progress message if the verbosity is at least level.
+    '''
+    if VERBOSITY >= level:
+        print(message)
+
+
+def _peak_rss_bytes():
+    '''
+    Peak resident set size of the process so far, or None if unavailable.
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _bytes_written():
+    '''
+    Bytes written by the process so far (Linux /proc/self/io), or None if unavailable.
+    '''
+    try:
+        with open('/proc/self/io', 'rt') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+@contextmanager
+def stage(name: str, **args):
+    '''
+    Record a stage of the workflow: wall time, CPU time, peak RSS at the end of the stage
+    and bytes written during it. Stages can be nested and used from several threads.
+    CPU time is that of the calling thread only, so concurrent stages in other threads (e.g.
+    background I/O) are not counted. Bytes written are process-wide, as /proc/self/io has no
+    per-thread counter: they include the writes of other threads during the stage.
+
+    Parameters:
+    name (str): The stage name, e.g. 'scatter correction'.
+    args: Extra values stored with the event (e.g. prefix='simind_corrected').
+    '''
+    depth = getattr(_local, 'depth', 0)
+    _local.depth = depth + 1
+
+    written_start = _bytes_written()
+    cpu_start = time.thread_time()
+    wall_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall_end = time.perf_counter()
+        cpu_end = time.thread_time()
+        written_end = _bytes_written()
+        _local.depth = depth
+
+        event = {
+            'name': name,
+            'start_s': wall_start - _t0,
+            'wall_s': wall_end - wall_start,
+            'cpu_s': cpu_end - cpu_start,
+            'peak_rss_bytes': _peak_rss_bytes(),
+            'bytes_written': None if written_start is None else written_end - written_start,
+            'depth': depth,
+            'pid': os.getpid(),
+            'thread': threading.get_ident(),
+            'args': args,
+        }
+        with _lock:
+            _events.append(event)
+        log(f'[{name}] {event["wall_s"]:.3f} s wall, {event["cpu_s"]:.3f} s CPU', level=2)
+
+
+def traced(name: str = None):
+    '''
+    Decorator recording every call of a function as a stage (default name is the function name).
+    '''
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def get_trace() -> list:
+    '''
+    Return a copy of the recorded stage events, in completion order.
+    '''
+    with _lock:
+        return [dict(event) for event in _events]
+
+
+def export_trace() -> dict:
+    '''
+    Return the recorded events with the origin of their timeline, to be sent from a worker
+    process to the parent and merged there with merge_trace.
+    '''
+    return {'origin_epoch_s': _t0_epoch, 'events': get_trace()}
+
+
+def merge_trace(exported: dict):
+    '''
+    Add the events of another process (the output of export_trace there) to this process's
+    trace, shifted onto its timeline. The events keep the pid and thread of the worker.
+    '''
+    shift = exported['origin_epoch_s'] - _t0_epoch
+    with _lock:
+        for event in exported['events']:
+            _events.append(dict(event, start_s=event['start_s'] + shift))
+
+
+def reset_trace():
+    '''
+    Discard all recorded stage events.
+    '''
+    with _lock:
+        _events.clear()
+
+
+def summarize_trace() -> dict:
+    '''
+    Aggregate the recorded events by stage name.
+
+    Returns (dict): {name: {'calls', 'wall_s', 'cpu_s', 'bytes_written', 'peak_rss_bytes'}}.
+    '''
+    summary = {}
+    for event in get_trace():
+        entry = summary.setdefault(event['name'], {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+                                                   'bytes_written': 0, 'peak_rss_bytes': 0})
+        entry['calls'] += 1
+        entry['wall_s'] += event['wall_s']
+        entry['cpu_s'] += event['cpu_s']
+        entry['bytes_written'] += event['bytes_written'] or 0
+        entry['peak_rss_bytes'] = max(entry['peak_rss_bytes'], event['peak_rss_bytes'] or 0)
+    return summary
+
+
+def print_trace_summary():
+    '''
+    Print the per-stage totals, slowest first. Nested stages are included in their parents' totals.
+    '''
+    summary = summarize_trace()
+    print(f"{'Stage':<32} {'Calls':>5} {'Wall (s)':>10} {'CPU (s)':>10} {'Written* (MB)':>13} {'Peak RSS* (MB)':>14}")
+    print('-' * 89)
+    for name, entry in sorted(summary.items(), key=lambda item: -item[1]['wall_s']):
+        print(f"{name:<32} {entry['calls']:>5} {entry['wall_s']:>10.3f} {entry['cpu_s']:>10.3f} "
+              f"{entry['bytes_written'] / 1024**2:>13.1f} {entry['peak_rss_bytes'] / 1024**2:>14.1f}")
+    print('CPU: thread of the stage only. *Process-wide: includes other threads running during the stage.')
+
+
+def write_trace(path: str, chrome: bool = None) -> str:
+    '''
+    Write the recorded events to a JSON file.
+
+    Parameters:
+    path (str): Output file.
+    chrome (bool, optional): Write the Chrome trace event format (viewable in chrome://tracing or
+                             Perfetto) instead of the plain event list. Default is True for
+                             paths ending in '.trace.json'.
+
+    Returns (str): The output path.
+    '''
+    if chrome is None:
+        chrome = path.endswith('.trace.json')
+
+    events = get_trace()
+    if chrome:
+        pid = os.getpid()
+        document = {'traceEvents': [{
+            'name': event['name'],
+            'ph': 'X',
+            'ts': event['start_s'] * 1e6,
+            'dur': event['wall_s'] * 1e6,
+            'pid': event.get('pid', pid),
+            'tid': event['thread'],
+            'args': dict(event['args'], cpu_s=event['cpu_s'], peak_rss_bytes=event['peak_rss_bytes'],
+                         bytes_written=event['bytes_written']),
+        } for event in events], 'displayTimeUnit': 'ms'}
+    else:
+        document = {'events': events, 'summary': summarize_trace()}
+
+    with open(path, 'wt') as f:
+        json.dump(document, f, indent=1, default=str)
+
+    return path
@@ -1,54 +1,37 @@
-import matplotlib.pyplot as plt
+from __future__ import annotations
+
 import os
 import shutil
-from sirf_simind_connection.backends import AcquisitionDataInterface
 import numpy as np
 import sys
 import math as m
+import re
+import hashlib
+import itertools
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Optional
+from typing import Optional, TYPE_CHECKING
 
+import stir_simind_trace
+from stir_simind_trace import log, stage, traced
 
-def display(images, slc=0, plane=0, cmap='inferno', _min=0, _max=0):
-    '''
-    Display images/acquisition data for a specific slice/projection and plane.
+if TYPE_CHECKING:
+    # only used in annotations, so the compute functions work with any object implementing the interface
+    from sirf_simind_connection.backends import AcquisitionDataInterface
 
-    Parameters:
-    images (list of ImageData or AcquisitionData or ndarray): The input image data.
-    row (int, optional): The row to be displayed (default is 0).
-    cmap (str, optional): The colormap for the displayed images (default is 'inferno').
-    _min (float, optional): The minimum value to be displayed (default is 0 which displays the image's own minimum).
-    _max (float, optional): The maximum value to be displayed (default is 0 which displays the image's own maximum).
-        
-    Returns: --
-    '''
-    try:
-        n_plots = len(images)
-    except TypeError:
-        n_plots = 1
-
-    if n_plots == 1:
-        im_arr = image_to_image2d(images, slc, plane)
-        if (_min, _max) == (0, 0):
-            _min, _max = np.amin(im_arr), np.amax(im_arr)
-    else:
-        im_arr = [image_to_image2d(im, slc, plane) for im in images]
-        if (_min, _max) == (0, 0):
-            combined_data = np.array(im_arr)
-            _min, _max = np.amin(combined_data), np.amax(combined_data)
-    
-    fig, axes = plt.subplots(1, n_plots)
-    fig.set_figheight(6)
-    fig.set_figwidth(18)
-
-    fig.suptitle(f'Display slice/projection [{slc}]', color='black', weight='bold', fontsize=20)
-    if n_plots == 1:
-        ax_im = axes.imshow(im_arr, cmap=cmap, vmin=_min, vmax=_max)
-        fig.colorbar(ax_im)
-    else:
-        for i, ax in enumerate(axes.flat):
-            ax_im = ax.imshow(im_arr[i], cmap=cmap, vmin=_min, vmax=_max)
-            fig.colorbar(ax_im)
+
+# The plotting functions live in stir_simind_plotting and are imported on first use, so importing
+# the compute functions (e.g. in every process-pool worker) never loads matplotlib
+_PLOTTING_FUNCTIONS = ('display', 'compare_reconstructions', 'display_montage')
+
+
+def __getattr__(name):
+    if name in _PLOTTING_FUNCTIONS:
+        import stir_simind_plotting
+        return getattr(stir_simind_plotting, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 def image_to_image2d(img_acq, slc_or_proj:int=0, plane:int=0) -> np.array:
@@ -56,16 +39,15 @@ def image_to_image2d(img_acq, slc_or_proj:int=0, plane:int=0) -> np.array:
     Generate a 2D array from an image/acquisition data given a slice/projection and a plane. 
 
     Parameters:
-    img_acq (ImageData or AcquisitionData or ndarray): The input image or projections.
+    img_acq (ImageData or AcquisitionData or ndarray or str): The input image or projections, or the path
+                                                            of an Interfile header (.hv/.hs).
     slc_or_proj (int, optional): The slice or projection to be displayed (default is 0).
     plane (int, optional): The plane to be displayed (0: transverse, 1: coronal, 2: sagittal, default is 0).
     
-    Returns (2D ndarray): Array to be displayed.
+    Returns (2D ndarray): Array to be displayed. This is a view for ndarray input; for Interfile
+                          files only the requested plane is read.
     '''
-    if type(img_acq) is np.ndarray:
-        img_acq_arr = img_acq.copy()
-    else:        
-        img_acq_arr = img_acq.as_array()        
+    img_acq_arr = open_volume(img_acq)
 
     image_data = False
     if img_acq_arr.ndim == 3:
@@ -80,10 +62,10 @@ def image_to_image2d(img_acq, slc_or_proj:int=0, plane:int=0) -> np.array:
 
         if plane not in orientation:
             plane = 0
-            print('Display plane does not exist. Defaulting to transverse!')
+            log('Display plane does not exist. Defaulting to transverse!')
 
         if slc_or_proj > img_acq_arr.shape[plane]:
-            print(f'Total number of {orientation[plane]} slices in image is: {img_acq_arr.shape[plane]}')
+            log(f'Total number of {orientation[plane]} slices in image is: {img_acq_arr.shape[plane]}')
             slc_or_proj = img_acq_arr.shape[plane]      
 
         if plane == 0:
@@ -95,20 +77,26 @@ def image_to_image2d(img_acq, slc_or_proj:int=0, plane:int=0) -> np.array:
 
     else:
         if plane != 0:
-            print('This is acquisition data. There are no planes to display!')
+            log('This is acquisition data. There are no planes to display!')
 
         if slc_or_proj > img_acq_arr.shape[2]:
-            print(f'Total projections of dataset is: {img_acq_arr.shape[2]}')
+            log(f'Total projections of dataset is: {img_acq_arr.shape[2]}')
             slc_or_proj = img_acq_arr.shape[2]
 
         image2D = img_acq_arr[0,:,slc_or_proj-1,:]
 
+    if isinstance(image2D, np.memmap):
+        # read just this plane from the file
+        image2D = np.array(image2D)
+
     return image2D
 
 
 def extract_header_info(hdr, tag_str:str) -> str:
     '''
     Extracts the information from header of image/acquisition data for a given tag.
+    Header files are parsed once and memoized (see read_interfile_header); the tag is matched
+    on its normalized key first and by substring otherwise.
 
     Parameters:
     hdr (ImageData or AcquisitionData or str): The ImageData, AcquisitionData or filepath of the header file.
@@ -116,90 +104,467 @@ def extract_header_info(hdr, tag_str:str) -> str:
     
     Returns (str): The value of the tag.
     ''' 
-    tag_value = None
-    
     if type(hdr) is str:
-        lines = open(hdr, 'rt')
-        for line in lines:
-            if line.find(tag_str) != -1:
-                tag_value = line.split('= ')[1]
-        lines.close()
-
+        header = read_interfile_header(hdr)
     else:
-        header = hdr.get_info()
-        lines = header.split('\n')
-        for line in lines:
-            if line.find(tag_str) != -1:
-                if len(line.split(':= ')) == 2:
-                    tag_value = line.split(':= ')[1]
-                elif len(line.split(': ')) == 2:
-                    tag_value = line.split(': ')[1]
+        header = InterfileHeader.from_text(hdr.get_info())
+
+    tag_value = header.get(tag_str)
+    if tag_value is None:
+        # fall back to substring matching of the tag, keeping the last match
+        tag_key = _normalize_interfile_key(tag_str)
+        for key in header.keys():
+            if tag_key in key:
+                tag_value = header.get(key)
     
     if not tag_value:
-        print(f'Tag {tag_str} not found!')
+        log(f'Tag {tag_str} not found!')
         tag_value = 'no_value'
     
     return tag_value
 
 
-def DEW_scatter_correction(PP: AcquisitionDataInterface, SC: AcquisitionDataInterface,
-                           PP_bounds=None, SC_bounds=None) -> AcquisitionDataInterface:
+_INTERFILE_INDEX_RE = re.compile(r'\s*\[\s*(\d+)\s*\]')
+
+_INTERFILE_NUMBER_FORMATS = {
+    ('float', 4): 'f4',
+    ('float', 8): 'f8',
+    ('short float', 4): 'f4',
+    ('long float', 8): 'f8',
+    ('unsigned integer', 1): 'u1',
+    ('unsigned integer', 2): 'u2',
+    ('unsigned integer', 4): 'u4',
+    ('signed integer', 1): 'i1',
+    ('signed integer', 2): 'i2',
+    ('signed integer', 4): 'i4',
+}
+
+
+def _normalize_interfile_key(key: str) -> str:
     '''
-    Performs scatter correction with the Dual Energy Window method. Negative values
-    are clipped after the operation.
+    Normalize an Interfile key: drop the '!' prefix, lower-case, collapse whitespace
+    and write indices as 'key [n]'.
+    '''
+    key = key.strip().lstrip('!').strip().lower()
+    key = ' '.join(key.split())
+    return _INTERFILE_INDEX_RE.sub(r' [\1]', key)
+
+
+class InterfileHeader:
+    '''
+    Interfile header parsed once into an index of normalized keys. Keys are matched without
+    the '!' prefix, case-insensitively and with indices written as 'key [n]', so
+    '!matrix size [1]', 'matrix size[1]' and 'Matrix Size [1]' all refer to the same entry.
+    When a key appears more than once the last value is kept.
+
+    Parameters:
+    entries (dict): {normalized key: raw value} pairs.
+    '''
+
+    def __init__(self, entries: dict):
+        self._index = entries
+
+    @classmethod
+    def from_text(cls, text: str) -> 'InterfileHeader':
+        '''
+        Parse header text with 'key := value' lines (or 'key: value' lines, as in STIR's get_info()).
+        '''
+        entries = {}
+        for line in text.splitlines():
+            if ':=' in line:
+                key, value = line.split(':=', 1)
+            elif ': ' in line:
+                key, value = line.split(': ', 1)
+            else:
+                continue
+            entries[_normalize_interfile_key(key)] = value.strip()
+        return cls(entries)
+
+    @classmethod
+    def from_file(cls, hdr_path: str) -> 'InterfileHeader':
+        with open(hdr_path, 'rt') as f:
+            return cls.from_text(f.read())
+
+    def __getitem__(self, key: str) -> str:
+        return self._index[_normalize_interfile_key(key)]
+
+    def __contains__(self, key: str) -> bool:
+        return _normalize_interfile_key(key) in self._index
+
+    def keys(self):
+        return self._index.keys()
+
+    def get(self, key: str, default=None):
+        return self._index.get(_normalize_interfile_key(key), default)
+
+    def get_int(self, key: str, default: int = None) -> int:
+        value = self.get(key)
+        return default if value is None else int(float(value))
+
+    def get_float(self, key: str, default: float = None) -> float:
+        value = self.get(key)
+        return default if value is None else float(value)
+
+    def get_list(self, key: str, default: list = None) -> list:
+        '''
+        Get a '{a, b, c}' list value as a list of floats.
+        '''
+        value = self.get(key)
+        if value is None:
+            return default
+        return [float(item) for item in value.strip('{} ').split(',') if item.strip()]
+
+    def get_many(self, keys, default=None) -> dict:
+        '''
+        Look up many keys at once and return a {key: value} dictionary.
+        '''
+        return {key: self.get(key, default) for key in keys}
+
+
+# Parsed headers by absolute path, with the (mtime, size) they were parsed at
+_INTERFILE_HEADER_CACHE = {}
+
+
+def read_interfile_header(hdr_path: str) -> InterfileHeader:
+    '''
+    Read and parse an Interfile header (.hs/.hdr/.hv/.h00). Parsed headers are memoized by
+    path and modification time, so repeated lookups do not touch the file again.
+
+    Parameters:
+    hdr_path (str): Path of the header file.
+
+    Returns (InterfileHeader): The parsed header.
+    '''
+    hdr_path = os.path.abspath(hdr_path)
+    stat = os.stat(hdr_path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+
+    cached = _INTERFILE_HEADER_CACHE.get(hdr_path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    header = InterfileHeader.from_file(hdr_path)
+    _INTERFILE_HEADER_CACHE[hdr_path] = (stamp, header)
+    return header
+
+
+def _interfile_dtype(header: InterfileHeader) -> np.dtype:
+    '''
+    Get the numpy dtype of the raw data described by a parsed Interfile header.
+    '''
+    number_format = header.get('number format', 'float').lower()
+    n_bytes = int(header.get('number of bytes per pixel', 4))
+    try:
+        type_code = _INTERFILE_NUMBER_FORMATS[(number_format, n_bytes)]
+    except KeyError:
+        raise ValueError(f'Unsupported Interfile number format: {number_format} ({n_bytes} bytes)')
+
+    byte_order = header.get('imagedata byte order', 'LITTLEENDIAN').upper()
+    return np.dtype(('<' if byte_order == 'LITTLEENDIAN' else '>') + type_code)
+
+
+def _interfile_data_path(hdr_path: str, header: InterfileHeader) -> str:
+    '''
+    Get the path of the raw data file, relative paths being resolved against the header location.
+    '''
+    data_file = header['name of data file']
+    if not os.path.isabs(data_file):
+        data_file = os.path.join(os.path.dirname(os.path.abspath(hdr_path)), data_file)
+    return data_file
+
+
+def memmap_interfile_projections(hdr_path: str, mode: str = 'r') -> np.memmap:
+    '''
+    Memory-map the raw SPECT projection data described by an Interfile header (.hs/.hdr).
+
+    Parameters:
+    hdr_path (str): Path of the Interfile header.
+    mode (str, optional): The numpy.memmap mode (default is 'r').
+
+    Returns (np.memmap): The projections with shape (views, axial rows, tangential bins).
+    '''
+    header = read_interfile_header(hdr_path)
+    shape = (int(header['number of projections']),
+             int(header['matrix size [2]']),
+             int(header['matrix size [1]']))
+
+    return np.memmap(_interfile_data_path(hdr_path, header), dtype=_interfile_dtype(header),
+                     mode=mode, offset=int(header.get('data offset in bytes', 0)), shape=shape)
+
+
+def memmap_interfile_image(hdr_path: str, mode: str = 'r') -> np.memmap:
+    '''
+    Memory-map the raw image data described by an Interfile image header (.hv).
+
+    Parameters:
+    hdr_path (str): Path of the Interfile header.
+    mode (str, optional): The numpy.memmap mode (default is 'r').
+
+    Returns (np.memmap): The image with shape (z, y, x).
+    '''
+    header = read_interfile_header(hdr_path)
+    shape = (header.get_int('matrix size [3]'),
+             header.get_int('matrix size [2]'),
+             header.get_int('matrix size [1]'))
+
+    return np.memmap(_interfile_data_path(hdr_path, header), dtype=_interfile_dtype(header),
+                     mode=mode, offset=header.get_int('data offset in bytes', 0), shape=shape)
+
+
+def open_volume(img_acq) -> np.ndarray:
+    '''
+    Get array access to an image or projections with as little copying as possible.
+    ndarrays are returned as they are, Interfile headers are memory-mapped (nothing is read until
+    indexed) and STIR/SIRF objects are converted with as_array().
+
+    Parameters:
+    img_acq (ImageData or AcquisitionData or ndarray or str): The image or projections, or the path
+                                                            of an Interfile header (.hv/.hs/.hdr).
+
+    Returns (ndarray): Images as (z, y, x), projections as (1, axial, views, tangential) like as_array().
+    '''
+    if isinstance(img_acq, np.ndarray):
+        return img_acq
+
+    if isinstance(img_acq, (str, os.PathLike)):
+        header = read_interfile_header(str(img_acq))
+        if 'matrix size [3]' in header:
+            return memmap_interfile_image(str(img_acq))
+        # the file stores views first; present it with the as_array() axis order, as a view
+        return memmap_interfile_projections(str(img_acq)).transpose(1, 0, 2)[np.newaxis]
+
+    return img_acq.as_array()
+
+
+def _interfile_energy_window_bounds(hdr_path: str) -> tuple:
+    '''
+    Read the (lower, upper) bounds of the first energy window from an Interfile header.
+    '''
+    header = read_interfile_header(hdr_path)
+    try:
+        return (float(header['energy window lower level [1]']),
+                float(header['energy window upper level [1]']))
+    except KeyError:
+        raise ValueError(f'No energy window bounds in {hdr_path}, pass them explicitly')
+
+
+def _write_float_interfile_header(template_hdr_path: str, output_hdr_path: str, data_file: str,
+                                  overrides: dict = None):
+    '''
+    Write a header for little-endian float32 data by copying a template header and
+    replacing the data file and number format keys, plus any {key: value} overrides.
+    '''
+    replacements = {
+        'name of data file': data_file,
+        'data offset in bytes': '0',
+        'imagedata byte order': 'LITTLEENDIAN',
+        'number format': 'float',
+        'number of bytes per pixel': '4',
+    }
+    if overrides:
+        replacements.update({_normalize_interfile_key(key): str(value) for key, value in overrides.items()})
+
+    lines = []
+    with open(template_hdr_path, 'rt') as f:
+        for line in f:
+            if ':=' in line:
+                key = line.split(':=', 1)[0]
+                normalized_key = _normalize_interfile_key(key)
+                if normalized_key in replacements:
+                    line = f'{key.rstrip()} := {replacements.pop(normalized_key)}\n'
+            lines.append(line)
+
+    # keys missing from the template go right after the first line (!INTERFILE :=)
+    missing = [f'{key} := {value}\n' for key, value in replacements.items()]
+    lines[1:1] = missing
+
+    with open(output_hdr_path, 'wt') as f:
+        f.writelines(lines)
+
+
+# Number of elements processed per block by scatter_correct_array. Keeps the
+# scratch buffer small (4 MB of float32) while staying well vectorized.
+SCATTER_CHUNK_SIZE = 1 << 20
+
+
+def scatter_window_weights(PP_bounds, SC_bounds_list) -> list:
+    '''
+    Compute the scatter window weights for DEW/TEW-style corrections.
+    The scatter under the photopeak is estimated as sum_i (SC_i / width_SC_i) * width_PP / 2,
+    i.e. weight_i = width_PP / (2 * width_SC_i). With one window this is the DEW estimate,
+    with two windows the TEW estimate.
+
+    Parameters:
+    PP_bounds (tuple): (lower, upper) energy bounds of the photopeak window in keV.
+    SC_bounds_list (list of tuple): (lower, upper) energy bounds of each scatter window in keV.
+
+    Returns (list of float): The weight of each scatter window.
+    '''
+    lo_PP, hi_PP = PP_bounds
+    window_width_PP = hi_PP - lo_PP
+
+    weights = []
+    for lo_SC, hi_SC in SC_bounds_list:
+        window_width_SC = hi_SC - lo_SC
+        if window_width_SC <= 0:
+            raise ValueError(f'Invalid scatter window bounds: ({lo_SC}, {hi_SC})')
+        weights.append(window_width_PP / (2 * window_width_SC))
+
+    return weights
+
+
+def scatter_correct_array(PP_arr: np.ndarray, SC_arrs, weights, out: np.ndarray = None,
+                          chunk_size: int = SCATTER_CHUNK_SIZE) -> np.ndarray:
+    '''
+    Compute max(PP - sum_i w_i * SC_i, 0) in a single blocked pass over the data.
+    Only a scratch buffer of chunk_size elements is allocated besides the output,
+    and out may alias PP_arr to correct the photopeak data in place.
+
+    Parameters:
+    PP_arr (ndarray): Photopeak counts, any shape.
+    SC_arrs (list of ndarray): Scatter window counts, same shape as PP_arr.
+    weights (list of float): The weight of each scatter window.
+    out (ndarray, optional): C-contiguous output buffer with the shape of PP_arr. If None a new
+                             float array is allocated.
+    chunk_size (int, optional): Number of elements per block (default is SCATTER_CHUNK_SIZE).
+
+    Returns (ndarray): The scatter corrected counts (out, if it was given).
+    '''
+    PP_arr = np.asarray(PP_arr)
+    SC_arrs = [np.asarray(SC_arr) for SC_arr in SC_arrs]
+
+    if len(SC_arrs) != len(weights):
+        raise ValueError(f'Got {len(SC_arrs)} scatter windows but {len(weights)} weights')
+    for SC_arr in SC_arrs:
+        if SC_arr.shape != PP_arr.shape:
+            raise ValueError(f'Scatter window shape {SC_arr.shape} does not match photopeak shape {PP_arr.shape}')
+
+    if out is None:
+        out = np.empty(PP_arr.shape, dtype=np.result_type(PP_arr.dtype, np.float32))
+    elif out.shape != PP_arr.shape:
+        raise ValueError(f'Output shape {out.shape} does not match photopeak shape {PP_arr.shape}')
+    elif not out.flags.c_contiguous:
+        raise ValueError('Output buffer must be C-contiguous')
+
+    out_flat = out.reshape(-1)
+    PP_flat = PP_arr.reshape(-1)
+    SC_flats = [SC_arr.reshape(-1) for SC_arr in SC_arrs]
+
+    n_elements = out_flat.size
+    scratch = np.empty(min(chunk_size, n_elements), dtype=out.dtype)
+
+    for start in range(0, n_elements, chunk_size):
+        stop = min(start + chunk_size, n_elements)
+        out_block = out_flat[start:stop]
+        tmp = scratch[:stop - start]
+
+        np.copyto(out_block, PP_flat[start:stop], casting='unsafe')
+        for SC_flat, weight in zip(SC_flats, weights):
+            np.multiply(SC_flat[start:stop], weight, out=tmp, casting='unsafe')
+            np.subtract(out_block, tmp, out=out_block)
+        np.maximum(out_block, 0, out=out_block)
+
+    return out
+
+
+def scatter_correct_batch(PP_stack: np.ndarray, SC_stacks, weights,
+                          out: np.ndarray = None) -> np.ndarray:
+    '''
+    Scatter correct many realizations stacked along a leading axis.
+
+    Parameters:
+    PP_stack (ndarray): Photopeak counts of shape (N, ...).
+    SC_stacks (list of ndarray): Scatter window counts, each of shape (N, ...).
+    weights (list of float): The weight of each scatter window, shared by all realizations.
+    out (ndarray, optional): C-contiguous output buffer of shape (N, ...). May alias PP_stack.
+
+    Returns (ndarray): The scatter corrected stack of shape (N, ...).
+    '''
+    PP_stack = np.asarray(PP_stack)
+    if PP_stack.ndim < 2:
+        raise ValueError('Expected a stack of realizations with a leading realization axis')
+
+    return scatter_correct_array(PP_stack, SC_stacks, weights, out=out)
+
+
+@traced('scatter correction')
+def multi_window_scatter_correction(PP: AcquisitionDataInterface, SC_list, weights=None,
+                                    PP_bounds=None, SC_bounds_list=None, out=None):
+    '''
+    Performs scatter correction with an arbitrary set of weighted scatter windows,
+    PP - sum_i w_i * SC_i, clipping negative values in the same pass.
 
     Parameters:
     PP (AcquisitionDataInterface): The acquisition data of the photopeak window.
-    SC (AcquisitionDataInterface): The acquisition data of the scatter window.
+    SC_list (list of AcquisitionDataInterface): The acquisition data of the scatter windows.
+    weights (list of float, optional): The weight of each scatter window. If None, the DEW/TEW
+                                       weights are computed from the energy window bounds.
     PP_bounds (tuple, optional): (lower, upper) energy bounds for PP window in keV.
                                  If None, will extract from PP acquisition data.
-    SC_bounds (tuple, optional): (lower, upper) energy bounds for SC window in keV.
-                                 If None, will extract from SC acquisition data.
+    SC_bounds_list (list of tuple, optional): (lower, upper) energy bounds for each scatter window in keV.
+                                              Entries that are None are extracted from the acquisition data.
+    out (AcquisitionDataInterface or ndarray, optional): Where to write the result. An ndarray
+                                                         must have the shape of PP.as_array().
 
-    Returns (AcquisitionDataInterface): The scatter corrected projections.
+    Returns (AcquisitionDataInterface or ndarray): The scatter corrected projections. This is out
+                                                   if it was given, otherwise a new acquisition object.
     '''
+    if weights is None:
+        if PP_bounds is None:
+            PP_bounds = PP.get_energy_window_bounds()
+        if SC_bounds_list is None:
+            SC_bounds_list = [None] * len(SC_list)
+        SC_bounds_list = [SC.get_energy_window_bounds() if bounds is None else bounds
+                          for SC, bounds in zip(SC_list, SC_bounds_list)]
 
-    acq_data_PP = PP.clone()
-    acq_data_SC = SC.clone()
+        log(f'PP window width: {str(round(PP_bounds[1] - PP_bounds[0], 2))}')
+        weights = scatter_window_weights(PP_bounds, SC_bounds_list)
+        for i, (bounds, weight) in enumerate(zip(SC_bounds_list, weights), start=1):
+            log(f'SC{i} window width: {str(round(bounds[1] - bounds[0], 2))}, '
+                f'scatter fraction: {str(round(weight, 2))}')
 
-    # Get energy window bounds - either from parameters or from acquisition data
-    if PP_bounds is None:
-        lo_PP, hi_PP = acq_data_PP.get_energy_window_bounds()
-    else:
-        lo_PP, hi_PP = PP_bounds
-    window_width_PP = hi_PP - lo_PP
-    print(f'PP window width: {str(round(window_width_PP, 2))}')
+    # as_array() already returns a private copy, so the photopeak copy doubles as the output
+    PP_arr = PP.as_array()
+    SC_arrs = [SC.as_array() for SC in SC_list]
 
-    if SC_bounds is None:
-        lo_SC, hi_SC = acq_data_SC.get_energy_window_bounds()
-    else:
-        lo_SC, hi_SC = SC_bounds
-    window_width_SC = hi_SC - lo_SC
-    print(f'SC window width: {str(round(window_width_SC, 2))}')
+    if isinstance(out, np.ndarray):
+        return scatter_correct_array(PP_arr, SC_arrs, weights, out=out)
 
-    # Calculate scatter fraction
-    scatter_fraction = (window_width_PP / window_width_SC) / 2
-    print(f'Scatter fraction: {str(round(scatter_fraction, 2))}')
+    corr_arr = scatter_correct_array(PP_arr, SC_arrs, weights, out=PP_arr)
+    del SC_arrs
 
-    # Estimate scatter under photopeak with DEW method using AcquisitionData operations
-    # Formula: scatter = (SC / window_width_SC) * window_width_PP / 2
-    acq_data_scatter = acq_data_SC * scatter_fraction
+    if out is None:
+        out = PP.clone()
+    out.fill(corr_arr)
+
+    return out
 
-    # Scatter corrected data using AcquisitionData subtraction
-    acq_data_corr = acq_data_PP - acq_data_scatter
 
-    # Set negative values to zero using numpy array operations
-    acq_data_corr_arr = acq_data_corr.as_array()
-    acq_data_corr_arr[acq_data_corr_arr < 0] = 0
-    acq_data_corr.fill(acq_data_corr_arr)
+def DEW_scatter_correction(PP: AcquisitionDataInterface, SC: AcquisitionDataInterface,
+                           PP_bounds=None, SC_bounds=None, out=None) -> AcquisitionDataInterface:
+    '''
+    Performs scatter correction with the Dual Energy Window method. Negative values
+    are clipped after the operation.
+
+    Parameters:
+    PP (AcquisitionDataInterface): The acquisition data of the photopeak window.
+    SC (AcquisitionDataInterface): The acquisition data of the scatter window.
+    PP_bounds (tuple, optional): (lower, upper) energy bounds for PP window in keV.
+                                 If None, will extract from PP acquisition data.
+    SC_bounds (tuple, optional): (lower, upper) energy bounds for SC window in keV.
+                                 If None, will extract from SC acquisition data.
+    out (AcquisitionDataInterface or ndarray, optional): Where to write the result (default is a new object).
 
-    # return scatter corrected data
-    return acq_data_corr
+    Returns (AcquisitionDataInterface): The scatter corrected projections.
+    '''
+    # Formula: scatter = (SC / window_width_SC) * window_width_PP / 2
+    return multi_window_scatter_correction(PP, [SC], PP_bounds=PP_bounds,
+                                           SC_bounds_list=[SC_bounds], out=out)
 
 
 def TEW_scatter_correction(PP: AcquisitionDataInterface, SC1: AcquisitionDataInterface,
                            SC2: AcquisitionDataInterface, PP_bounds=None, SC1_bounds=None,
-                           SC2_bounds=None) -> AcquisitionDataInterface:
+                           SC2_bounds=None, out=None) -> AcquisitionDataInterface:
     '''
     Performs scatter correction with the Triple Energy Window method. Negative values
     are clipped after the operation.
@@ -214,55 +579,127 @@ def TEW_scatter_correction(PP: AcquisitionDataInterface, SC1: AcquisitionDataInt
                                   If None, will extract from SC1 acquisition data.
     SC2_bounds (tuple, optional): (lower, upper) energy bounds for SC2 window in keV.
                                   If None, will extract from SC2 acquisition data.
+    out (AcquisitionDataInterface or ndarray, optional): Where to write the result (default is a new object).
 
     Returns (AcquisitionDataInterface): The scatter corrected projections.
     '''
+    # Formula: scatter = ((SC1 / width_SC1) + (SC2 / width_SC2)) * width_PP / 2
+    return multi_window_scatter_correction(PP, [SC1, SC2], PP_bounds=PP_bounds,
+                                           SC_bounds_list=[SC1_bounds, SC2_bounds], out=out)
+
+
+@traced('scatter correction')
+def stream_scatter_correction(PP_hdr: str, SC_hdrs, output_hs: str, weights=None,
+                              PP_bounds=None, SC_bounds_list=None, views_per_chunk: int = 8,
+                              max_workers: int = 1) -> str:
+    '''
+    Performs multi-window scatter correction directly on Interfile projection files.
+    The raw data are memory-mapped and processed in chunks of views, so memory use is
+    independent of the dataset size. The result is written as a float32 .hs/.s pair.
 
-    acq_data_PP = PP.clone()
-    acq_data_SC1 = SC1.clone()
-    acq_data_SC2 = SC2.clone()
+    Parameters:
+    PP_hdr (str): Interfile header (.hs/.hdr) of the photopeak window.
+    SC_hdrs (list of str): Interfile headers of the scatter windows.
+    output_hs (str): Path of the output header. The data file gets the same name with a .s extension.
+    weights (list of float, optional): The weight of each scatter window. If None, the DEW/TEW
+                                       weights are computed from the energy window bounds.
+    PP_bounds (tuple, optional): (lower, upper) energy bounds for PP window in keV.
+                                 If None, will extract from the PP header.
+    SC_bounds_list (list of tuple, optional): (lower, upper) energy bounds for each scatter window in keV.
+                                              Entries that are None are extracted from the headers.
+    views_per_chunk (int, optional): Number of views processed per chunk (default is 8).
+    max_workers (int, optional): Number of threads processing chunks concurrently (default is 1).
 
-    # Get energy window bounds - either from parameters or from acquisition data
-    if PP_bounds is None:
-        lo_PP, hi_PP = acq_data_PP.get_energy_window_bounds()
+    Returns (str): Path of the output header.
+    '''
+    if weights is None:
+        if PP_bounds is None:
+            PP_bounds = _interfile_energy_window_bounds(PP_hdr)
+        if SC_bounds_list is None:
+            SC_bounds_list = [None] * len(SC_hdrs)
+        SC_bounds_list = [_interfile_energy_window_bounds(hdr) if bounds is None else bounds
+                          for hdr, bounds in zip(SC_hdrs, SC_bounds_list)]
+        weights = scatter_window_weights(PP_bounds, SC_bounds_list)
+
+    PP_mm = memmap_interfile_projections(PP_hdr)
+    SC_mms = [memmap_interfile_projections(hdr) for hdr in SC_hdrs]
+
+    output_data = os.path.splitext(output_hs)[0] + '.s'
+    out_mm = np.memmap(output_data, dtype='<f4', mode='w+', shape=PP_mm.shape)
+
+    def correct_views(start):
+        stop = min(start + views_per_chunk, PP_mm.shape[0])
+        scatter_correct_array(PP_mm[start:stop], [SC_mm[start:stop] for SC_mm in SC_mms],
+                              weights, out=out_mm[start:stop])
+
+    chunk_starts = range(0, PP_mm.shape[0], views_per_chunk)
+    if max_workers > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # consume the iterator to surface exceptions from the workers
+            list(executor.map(correct_views, chunk_starts))
     else:
-        lo_PP, hi_PP = PP_bounds
-    window_width_PP = hi_PP - lo_PP
-    print(f'PP window width: {str(round(window_width_PP, 2))}')
+        for start in chunk_starts:
+            correct_views(start)
 
-    if SC1_bounds is None:
-        lo_SC1, hi_SC1 = acq_data_SC1.get_energy_window_bounds()
-    else:
-        lo_SC1, hi_SC1 = SC1_bounds
-    window_width_SC1 = hi_SC1 - lo_SC1
-    print(f'SC1 window width: {str(round(window_width_SC1, 2))}')
+    out_mm.flush()
 
-    if SC2_bounds is None:
-        lo_SC2, hi_SC2 = acq_data_SC2.get_energy_window_bounds()
-    else:
-        lo_SC2, hi_SC2 = SC2_bounds
-    window_width_SC2 = hi_SC2 - lo_SC2
-    print(f'SC2 window width: {str(round(window_width_SC2, 2))}')
+    _write_float_interfile_header(PP_hdr, output_hs, os.path.basename(output_data))
 
-    # Estimate scatter under photopeak with TEW method using AcquisitionData operations
-    # Formula: scatter = ((SC1 / width_SC1) + (SC2 / width_SC2)) * width_PP / 2
-    scatter_fraction_1 = window_width_PP / (2 * window_width_SC1)
-    scatter_fraction_2 = window_width_PP / (2 * window_width_SC2)
+    return output_hs
 
-    acq_data_scatter = acq_data_SC1 * scatter_fraction_1 + acq_data_SC2 * scatter_fraction_2
 
-    # Scatter corrected data using AcquisitionData subtraction
-    acq_data_corr = acq_data_PP - acq_data_scatter
+def rebin_interfile_projections(hdr_path: str, output_hs: str, factor: int = 2, view_step: int = 1) -> str:
+    '''
+    Rebin Interfile projections to a coarser detector matrix by summing factor x factor blocks of
+    bins (axial and tangential), which keeps the data Poisson distributed, optionally keeping only
+    every view_step-th view (the orbit radii are decimated accordingly). The data are processed
+    one view at a time from a memory map.
+
+    Parameters:
+    hdr_path (str): Interfile header (.hs/.hdr) of the projections.
+    output_hs (str): Path of the output header. The data file gets the same name with a .s extension.
+    factor (int, optional): Rebinning factor; must divide both matrix sizes (default is 2).
+    view_step (int, optional): Keep views 0, view_step, 2 * view_step, ...; must divide the number of
+                               views so the angular spacing stays uniform (default is 1, all views).
 
-    # Set negative values to zero using numpy array operations
-    acq_data_corr_arr = acq_data_corr.as_array()
-    acq_data_corr_arr[acq_data_corr_arr < 0] = 0
-    acq_data_corr.fill(acq_data_corr_arr)
+    Returns (str): Path of the output header.
+    '''
+    header = read_interfile_header(hdr_path)
+    projections = memmap_interfile_projections(hdr_path)
+    n_views, n_axial, n_tangential = projections.shape
+    if n_axial % factor or n_tangential % factor:
+        raise ValueError(f'Matrix size {n_axial}x{n_tangential} is not divisible by {factor}')
+    if n_views % view_step:
+        raise ValueError(f'Number of views {n_views} is not divisible by view_step {view_step}')
+
+    views = range(0, n_views, view_step)
+    output_data = os.path.splitext(output_hs)[0] + '.s'
+    out_shape = (len(views), n_axial // factor, n_tangential // factor)
+    out_mm = np.memmap(output_data, dtype='<f4', mode='w+', shape=out_shape)
+    for i, view in enumerate(views):
+        out_mm[i] = projections[view].reshape(out_shape[1], factor, out_shape[2], factor).sum(axis=(1, 3))
+    out_mm.flush()
+    del out_mm
+
+    overrides = {
+        'matrix size [1]': out_shape[2],
+        'matrix size [2]': out_shape[1],
+    }
+    for key in ('scaling factor (mm/pixel) [1]', 'scaling factor (mm/pixel) [2]'):
+        pixel_size = header.get_float(key)
+        if pixel_size is not None:
+            overrides[key] = pixel_size * factor
+    if view_step > 1:
+        overrides['number of projections'] = len(views)
+        radii = header.get_list('radii')
+        if radii:
+            overrides['radii'] = '{' + ', '.join(f'{radius:g}' for radius in radii[::view_step]) + '}'
+    _write_float_interfile_header(hdr_path, output_hs, os.path.basename(output_data), overrides=overrides)
 
-    # return scatter corrected data
-    return acq_data_corr
+    return output_hs
 
 
+@traced('noise')
 def add_poisson_noise(acq_data: AcquisitionDataInterface,
                       rng: Optional[np.random.Generator] = None
                       ) -> AcquisitionDataInterface:
@@ -286,192 +723,1939 @@ def add_poisson_noise(acq_data: AcquisitionDataInterface,
     noisy_acq.fill(noisy_counts.astype(counts.dtype, copy=False))
     return noisy_acq
 
-def update_par_file(par_file_path: str, output_par_path: str, updates: dict) -> str:
+
+def _poisson_counts(acq_data) -> np.ndarray:
     '''
-    Update parameters in a STIR par file and save to a new location.
-    Only updates lines that exactly match the parameter name (before :=).
+    Return the non-negative expected counts of acquisition data (or of an ndarray).
+    '''
+    counts = np.asarray(acq_data) if isinstance(acq_data, np.ndarray) else acq_data.as_array()
+    return np.clip(counts, a_min=0, a_max=None)
 
-    Parameters:
-    par_file_path (str): Path to the original par file.
-    output_par_path (str): Path where the updated par file will be saved.
-    updates (dict): Dictionary of parameter names and their new values.
-                    Example: {'input file': 'data.hs', 'output filename prefix': 'recon_result'}
 
-    Returns (str): Path to the updated par file.
+def _ensemble_seed_sequences(seed, n_realizations: int) -> list:
     '''
-    # Read the original par file
-    with open(par_file_path, 'r') as f:
-        lines = f.readlines()
+    Spawn one independent seed sequence per realization.
+    '''
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return seed.spawn(n_realizations)
 
-    # Update parameters - be more precise with matching
-    updated_lines = []
-    for line in lines:
-        line_updated = False
 
-        # Only process lines with :=
-        if ':=' in line:
-            # Extract the parameter name (text before :=)
-            param_name_in_line = line.split(':=')[0].strip()
+# Bins drawn per Generator.poisson call: bounds its int64 temporary to a cache-sized chunk
+_POISSON_CHUNK_SIZE = 1 << 16
 
-            # Check if this parameter should be updated
-            for param_name, param_value in updates.items():
-                if param_name_in_line.lower() == param_name.lower():
-                    # Extract indentation
-                    indent = len(line) - len(line.lstrip())
-                    updated_lines.append(' ' * indent + f'{param_name} := {param_value}\n')
-                    line_updated = True
-                    break
 
-        if not line_updated:
-            updated_lines.append(line)
+def _draw_poisson_block(counts: np.ndarray, seed_seqs, out: np.ndarray = None) -> np.ndarray:
+    '''
+    Draw one Poisson realization of counts per seed sequence into out[i]. Every realization has its
+    own generator, so realizations are drawn one at a time (not in one vectorized call); each is
+    drawn in chunks of _POISSON_CHUNK_SIZE bins written straight into out[i], which gives the same
+    values as a single call without a full-size int64 temporary per realization.
+    '''
+    if out is None:
+        out = np.empty((len(seed_seqs),) + counts.shape, dtype=np.float32)
+    flat_counts = np.ascontiguousarray(counts).reshape(-1)
+    for i, seed_seq in enumerate(seed_seqs):
+        rng = np.random.default_rng(seed_seq)
+        if not out[i].flags.c_contiguous:
+            out[i] = rng.poisson(counts)
+            continue
+        flat_out = out[i].reshape(-1)
+        for start in range(0, flat_counts.size, _POISSON_CHUNK_SIZE):
+            stop = start + _POISSON_CHUNK_SIZE
+            flat_out[start:stop] = rng.poisson(flat_counts[start:stop])
+    return out
+
+
+@traced('noise')
+def poisson_noise_ensemble(acq_data, n_realizations: int, seed=None, out: np.ndarray = None,
+                           max_workers: int = 1) -> np.ndarray:
+    '''
+    Draw many Poisson noise realizations of acquisition data into one (N, ...) float32 array.
+    Realization i is drawn from the i-th child of np.random.SeedSequence(seed).spawn(N), so
+    results are reproducible and independent of max_workers.
 
-    # Write the updated par file
-    with open(output_par_path, 'w') as f:
-        f.writelines(updated_lines)
+    Parameters:
+    acq_data (AcquisitionDataInterface or ndarray): The noise-free acquisition data.
+    n_realizations (int): Number of realizations N.
+    seed (int or SeedSequence, optional): Seed of the ensemble (default is fresh OS entropy).
+    out (ndarray, optional): Preallocated buffer of shape (N,) + data shape to draw into.
+    max_workers (int, optional): Number of worker processes drawing blocks of realizations (default is 1).
 
-    return output_par_path
+    Returns (ndarray): The noisy counts with shape (N,) + data shape.
+    '''
+    counts = _poisson_counts(acq_data)
+    seed_seqs = _ensemble_seed_sequences(seed, n_realizations)
 
+    shape = (n_realizations,) + counts.shape
+    if out is None:
+        out = np.empty(shape, dtype=np.float32)
+    elif out.shape != shape:
+        raise ValueError(f'Output shape {out.shape} does not match ensemble shape {shape}')
 
-def reconstruct_with_osem(input_file: str, output_prefix: str, par_file_template: str,
-                          initial_image_template, attenuation_image, num_subsets: int = 4,
-                          num_subiterations: int = 24, temp_dir: str = './temp_recon'):
+    if max_workers <= 1 or n_realizations < 2:
+        return _draw_poisson_block(counts, seed_seqs, out=out)
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    blocks = np.array_split(np.arange(n_realizations), min(max_workers, n_realizations))
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=len(blocks), mp_context=context) as executor:
+        futures = [(block, executor.submit(_draw_poisson_block, counts, [seed_seqs[i] for i in block]))
+                   for block in blocks]
+        for block, future in futures:
+            out[block[0]:block[-1] + 1] = future.result()
+
+    return out
+
+
+def iter_poisson_realizations(acq_data: AcquisitionDataInterface, n_realizations: int, seed=None):
     '''
-    Perform OSEM reconstruction using STIR with a modified par file.
+    Lazily yield Poisson noise realizations as acquisition objects, one at a time.
+    Realization i equals poisson_noise_ensemble(acq_data, n_realizations, seed)[i].
 
     Parameters:
-    input_file (str): Path to the input acquisition data (.hs file).
-    output_prefix (str): Prefix for output files.
-    par_file_template (str): Path to the template par file.
-    initial_image_template: STIR image object to use as template for initial image.
-    attenuation_image: STIR image object containing attenuation map.
-    num_subsets (int): Number of subsets for OSEM (default: 4).
-    num_subiterations (int): Number of subiterations (default: 24).
-    temp_dir (str): Directory for temporary files (default: './temp_recon').
+    acq_data (AcquisitionDataInterface): The noise-free acquisition data.
+    n_realizations (int): Number of realizations to yield.
+    seed (int or SeedSequence, optional): Seed of the ensemble (default is fresh OS entropy).
 
-    Returns: The reconstructed image (stir.FloatVoxelsOnCartesianGrid).
+    Yields (AcquisitionDataInterface): Noisy acquisition data.
     '''
-    import stir
-    from pathlib import Path
+    counts = _poisson_counts(acq_data)
+    buffer = np.empty((1,) + counts.shape, dtype=np.float32)
 
-    # Create temp directory if it doesn't exist
-    Path(temp_dir).mkdir(parents=True, exist_ok=True)
+    for seed_seq in _ensemble_seed_sequences(seed, n_realizations):
+        _draw_poisson_block(counts, [seed_seq], out=buffer)
+        noisy_acq = acq_data.clone()
+        noisy_acq.fill(buffer[0])
+        yield noisy_acq
 
-    # Convert all paths to absolute paths
-    temp_dir_abs = os.path.abspath(temp_dir)
-    input_file_abs = os.path.abspath(input_file)
-    par_file_template_abs = os.path.abspath(par_file_template)
 
-    # Create and save required images
-    # 1. Initial estimate
-    target = initial_image_template.clone()
-    target.fill(1.0)
-    init_file = os.path.join(temp_dir_abs, f'{output_prefix}_init.hv')
-    target.write_to_file(init_file)
+# Disk budget of the SIMIND output cache used by run_simind_cached
+SIMIND_CACHE_MAX_BYTES = 10 * 1024**3
 
-    # 2. Attenuation map
-    atten_file = os.path.join(temp_dir_abs, f'{output_prefix}_atten.hv')
-    attenuation_image.write_to_file(atten_file)
 
-    # 3. Mask (create from attenuation map - non-zero values)
-    mask = attenuation_image.clone()
-    mask_arr = mask.as_array()
-    mask_arr[mask_arr > 0] = 1.0
-    mask.fill(mask_arr)
-    mask_file = os.path.join(temp_dir_abs, f'{output_prefix}_mask.hv')
-    mask.write_to_file(mask_file)
+class SimindOutputs:
+    '''
+    Per-window total and scatter projections of a SIMIND simulation, stored in one directory as
+    tot_w<n>.hs and sca_w<n>.hs. Provides the same get_total_output/get_scatter_output interface
+    as SimindSimulator, so cached and merged simulations can be used in its place.
+    '''
 
-    # Create modified par file with all necessary paths
-    temp_par_file = os.path.join(temp_dir_abs, f'{output_prefix}_recon.par')
-    updates = {
-        'input file': input_file_abs,
-        'output filename prefix': os.path.join(temp_dir_abs, output_prefix),
-        'initial estimate': init_file,
-        'attenuation map': atten_file,
-        'mask file': mask_file,
-        'number of subsets': num_subsets,
-        'number of subiterations': num_subiterations,
-    }
+    def __init__(self, output_dir: str):
+        self.output_dir = str(output_dir)
+
+    @property
+    def windows(self) -> list:
+        '''The window numbers (1-based) with stored outputs.'''
+        matches = (re.fullmatch(r'tot_w(\d+)\.hs', name) for name in os.listdir(self.output_dir))
+        return sorted(int(match.group(1)) for match in matches if match)
+
+    def total_file(self, window: int) -> str:
+        return os.path.join(self.output_dir, f'tot_w{window}.hs')
+
+    def scatter_file(self, window: int) -> str:
+        return os.path.join(self.output_dir, f'sca_w{window}.hs')
+
+    def get_total_output(self, window: int = 1):
+        from sirf_simind_connection.backends import create_acquisition_data
+        return create_acquisition_data(self.total_file(window))
+
+    def get_scatter_output(self, window: int = 1):
+        from sirf_simind_connection.backends import create_acquisition_data
+        return create_acquisition_data(self.scatter_file(window))
+
+    @classmethod
+    def save(cls, simulator, output_dir: str, n_windows: int) -> 'SimindOutputs':
+        '''
+        Write the total and scatter outputs of every window of a simulator (or SimindOutputs) to output_dir.
+        '''
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+        outputs = cls(output_dir)
+        for window in range(1, n_windows + 1):
+            simulator.get_total_output(window=window).write(outputs.total_file(window))
+            simulator.get_scatter_output(window=window).write(outputs.scatter_file(window))
+        return outputs
+
+
+def setup_simind_simulator(config_file: str, output_dir: str, output_prefix: str, source, mu_map,
+                           window_lower, window_upper, runtime_switches: dict = None,
+                           config_values: dict = None, photon_multiplier: float = 1,
+                           scatter_orders=None):
+    '''
+    Create and configure a SimindSimulator as in the notebook (SCATTWIN scoring).
 
-    update_par_file(par_file_template_abs, temp_par_file, updates)
+    Parameters:
+    config_file (str): The scanner YAML configuration (e.g. 'Discovery670_lu177.yaml').
+    output_dir (str): Working directory of the simulation.
+    output_prefix (str): Prefix of the SIMIND output files.
+    source: Activity image.
+    mu_map: Attenuation image.
+    window_lower, window_upper (list of float): Energy window bounds in keV.
+    runtime_switches (dict, optional): SIMIND runtime switches, e.g. {'FI': 'lu177', 'CC': 'GI-MEGP'}.
+    config_values (dict, optional): SIMIND configuration values by index, e.g. {1: 208, 29: 120}.
+    photon_multiplier (float, optional): Photon history multiplier (default is 1).
+    scatter_orders (list of int, optional): Scatter order of each window (default is 0 for all).
+
+    Returns (SimindSimulator): The configured simulator, ready to run.
+    '''
+    from sirf_simind_connection import SimindSimulator, SimulationConfig
+    from sirf_simind_connection.core.components import ScoringRoutine
+
+    simulator = SimindSimulator(
+        config_source=SimulationConfig(config_file),
+        output_dir=output_dir,
+        output_prefix=output_prefix,
+        photon_multiplier=photon_multiplier,
+        scoring_routine=ScoringRoutine.SCATTWIN,
+    )
+    simulator.set_source(source)
+    simulator.set_mu_map(mu_map)
+    for switch, value in (runtime_switches or {}).items():
+        simulator.add_runtime_switch(switch, value)
+    simulator.set_energy_windows(
+        lower_bounds=list(window_lower),
+        upper_bounds=list(window_upper),
+        scatter_orders=list(scatter_orders) if scatter_orders is not None else [0] * len(window_lower)
+    )
+    for index, value in (config_values or {}).items():
+        simulator.add_config_value(index, value)
+
+    return simulator
+
+
+def _simind_image_key(image) -> tuple:
+    '''
+    Return (geometry, voxel values) of a SIMIND input image for the cache key.
+    '''
+    native = getattr(image, 'native_object', image)
+    arr = np.asarray(open_volume(native))
+    geometry = _image_geometry(native, arr.shape) if hasattr(native, 'get_voxel_size') else arr.shape
+    return geometry, arr
 
-    # Initialize reconstruction object
-    recon = stir.OSMAPOSLReconstruction3DFloat(temp_par_file)
 
-    # Set up reconstruction
-    s = recon.set_up(target)
-    if not s.succeeded():
-        raise RuntimeError(f'Error setting up reconstruction for {output_prefix}')
+def _resolve_simind_config(config_file: str) -> Optional[str]:
+    '''
+    Return the path of a scanner YAML file given as a path or as the name of a file bundled in
+    sirf_simind_connection.configs, or None if it cannot be found.
+    '''
+    if os.path.isfile(config_file):
+        return config_file
+    try:
+        from sirf_simind_connection import configs
+    except ImportError:
+        return None
+    configs_dirs = getattr(configs, '__path__', None) or [os.path.dirname(configs.__file__)]
+    for configs_dir in configs_dirs:
+        candidate = os.path.join(configs_dir, os.path.basename(config_file))
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def simind_cache_key(config_file: str, source, mu_map, window_lower, window_upper,
+                     runtime_switches: dict = None, config_values: dict = None,
+                     photon_multiplier: float = 1) -> str:
+    '''
+    Hash everything that determines the output of a simulation: the activity and attenuation
+    images, the scanner YAML file contents, the energy windows, the runtime switches and the
+    configuration values.
 
-    # Run reconstruction
-    print(f'Running reconstruction for {output_prefix}...')
-    print(f'  Input file: {input_file}')
-    print(f'  Subsets: {num_subsets}, Subiterations: {num_subiterations}')
+    Returns (str): The cache key.
+    '''
+    h = hashlib.sha256()
+    config_path = _resolve_simind_config(config_file)
+    if config_path is not None:
+        with open(config_path, 'rb') as f:
+            h.update(f.read())
+    else:
+        h.update(str(config_file).encode())
+    settings = (
+        [float(bound) for bound in window_lower],
+        [float(bound) for bound in window_upper],
+        sorted((str(k).upper(), str(v)) for k, v in (runtime_switches or {}).items()),
+        sorted((int(k), float(v)) for k, v in (config_values or {}).items()),
+        float(photon_multiplier),
+    )
+    h.update(repr(settings).encode())
+    for kind, image in (('source', source), ('mu_map', mu_map)):
+        geometry, arr = _simind_image_key(image)
+        h.update(_cache_key(kind, geometry, arr).encode())
+    return h.hexdigest()[:24]
+
+
+def _evict_simind_cache(cache_dir: str, max_cache_bytes: int, keep: str):
+    '''
+    Delete least recently used cache entries (one directory per simulation) until the cache fits
+    in max_cache_bytes. The entry keep is never deleted.
+    '''
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if not entry.is_dir() or entry.name.startswith('tmp-'):
+            continue
+        size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+        entries.append((entry.stat().st_mtime, size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_cache_bytes:
+            break
+        if os.path.basename(path) == keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def _store_simind_outputs(simulator, cache_dir: str, key: str, n_windows: int) -> SimindOutputs:
+    '''
+    Save the outputs of a simulator as cache entry key. The entry is written to a private
+    directory and renamed into place, so concurrent writers never expose a partial entry.
+    '''
+    entry_dir = os.path.join(cache_dir, key)
+    tmp_dir = os.path.join(cache_dir, f'tmp-{uuid.uuid4().hex}')
+    try:
+        SimindOutputs.save(simulator, tmp_dir, n_windows)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # another process stored the same simulation first
+            pass
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return SimindOutputs(entry_dir)
+
+
+def run_simind_cached(config_file: str, output_dir: str, output_prefix: str, source, mu_map,
+                      window_lower, window_upper, runtime_switches: dict = None,
+                      config_values: dict = None, photon_multiplier: float = 1,
+                      cache_dir: str = './simind_cache',
+                      max_cache_bytes: int = SIMIND_CACHE_MAX_BYTES) -> SimindOutputs:
+    '''
+    Run a SIMIND simulation (see setup_simind_simulator), or restore its outputs from the cache if
+    a simulation with identical inputs was run before. Least recently used entries are evicted
+    when the cache grows beyond max_cache_bytes.
 
-    recon.set_start_subiteration_num(1)
-    recon.set_num_subiterations(num_subiterations)
-    s = recon.reconstruct(target)
+    Parameters:
+    config_file ... photon_multiplier: As for setup_simind_simulator.
+    cache_dir (str, optional): The cache directory (default: './simind_cache').
+    max_cache_bytes (int, optional): Disk budget of the cache (default is SIMIND_CACHE_MAX_BYTES).
 
-    if not s.succeeded():
-        raise RuntimeError(f'Reconstruction failed for {output_prefix}')
+    Returns (SimindOutputs): The per-window total and scatter outputs.
+    '''
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    cache_dir = os.path.abspath(cache_dir)
 
-    # Save the reconstructed image
-    output_filename = os.path.join(temp_dir, f'{output_prefix}.hv')
-    target.write_to_file(output_filename)
-    print(f'Reconstruction complete. Saved to: {output_filename}')
+    key = simind_cache_key(config_file, source, mu_map, window_lower, window_upper,
+                           runtime_switches, config_values, photon_multiplier)
+    entry_dir = os.path.join(cache_dir, key)
 
-    return target
+    if os.path.isdir(entry_dir):
+        os.utime(entry_dir)
+        log(f'SIMIND outputs restored from cache: {entry_dir}')
+        return SimindOutputs(entry_dir)
 
+    simulator = setup_simind_simulator(config_file, output_dir, output_prefix, source, mu_map,
+                                       window_lower, window_upper, runtime_switches, config_values,
+                                       photon_multiplier)
+    with stage('SIMIND simulation', prefix=output_prefix):
+        simulator.run_simulation()
 
-def compare_reconstructions(recon_dict: dict, slice_idx: int = None, cmap: str = 'hot',
-                           vmin: float = None, vmax: float = None):
+    with stage('file write', prefix=output_prefix):
+        outputs = _store_simind_outputs(simulator, cache_dir, key, len(window_lower))
+    _evict_simind_cache(cache_dir, max_cache_bytes, keep=key)
+
+    return outputs
+
+
+def merge_simind_outputs(parts, output_dir: str) -> SimindOutputs:
     '''
-    Compare multiple reconstructed images side by side.
+    Merge independent simulations of the same set-up by averaging their per-window total and
+    scatter projections. SIMIND scales counts to the source activity, so each part is an estimate
+    of the same mean and the average has the statistics of all photon histories combined.
 
     Parameters:
-    recon_dict (dict): Dictionary of {name: stir.FloatVoxelsOnCartesianGrid} pairs.
-    slice_idx (int, optional): Slice index to display. If None, uses middle slice.
-    cmap (str): Colormap for display (default: 'hot').
-    vmin (float, optional): Minimum value for color scale.
-    vmax (float, optional): Maximum value for color scale.
+    parts (list of SimindOutputs): The simulations to merge (same windows and geometry).
+    output_dir (str): Directory of the merged outputs.
+
+    Returns (SimindOutputs): The merged outputs.
+    '''
+    parts = list(parts)
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    merged = SimindOutputs(output_dir)
+
+    for window in parts[0].windows:
+        for part_file, merged_file in ((SimindOutputs.total_file, merged.total_file),
+                                       (SimindOutputs.scatter_file, merged.scatter_file)):
+            acc = None
+            for part in parts:
+                projections = memmap_interfile_projections(part_file(part, window))
+                if acc is None:
+                    acc = np.zeros(projections.shape, dtype=np.float64)
+                elif projections.shape != acc.shape:
+                    raise ValueError(f'Cannot merge {part_file(part, window)}: shape {projections.shape} '
+                                     f'does not match {acc.shape}')
+                acc += projections
+            acc /= len(parts)
+
+            output_hs = merged_file(window)
+            output_data = os.path.splitext(output_hs)[0] + '.s'
+            acc.astype('<f4').tofile(output_data)
+            _write_float_interfile_header(part_file(parts[0], window), output_hs, os.path.basename(output_data))
+
+    return merged
+
+
+def _simind_part_seeds(seed, n_parts: int) -> list:
+    '''
+    Derive independent SIMIND random seeds (positive 31-bit integers) for the parts of a simulation.
+    '''
+    state = np.random.SeedSequence(seed).generate_state(n_parts, dtype=np.uint32)
+    return [int(s) % (2**31 - 2) + 1 for s in state]
+
+
+def _run_simind_part(part: dict) -> SimindOutputs:
+    '''
+    Run one part of a parallel simulation in its own working directory and return its outputs.
+    '''
+    import subprocess
+
+    part_dir = part['output_dir']
+    Path(part_dir).mkdir(parents=True, exist_ok=True)
+    n_windows = len(part['window_lower'])
+
+    with stage('SIMIND simulation part', prefix=os.path.basename(part_dir)):
+        if part['executable'] is not None:
+            executable = part['executable']
+            command = [str(executable)] if isinstance(executable, (str, os.PathLike)) else list(executable)
+            command += ['--output-dir', part_dir, '--seed', str(part['seed']),
+                        '--photon-multiplier', str(part['photon_multiplier']), '--n-windows', str(n_windows)]
+            subprocess.run(command, check=True, cwd=part_dir)
+            return SimindOutputs(part_dir)
+
+        switches = dict(part['runtime_switches'] or {}, RR=part['seed'])
+        simulator = setup_simind_simulator(part['config_file'], part_dir, part['output_prefix'],
+                                           part['source'], part['mu_map'], part['window_lower'],
+                                           part['window_upper'], switches, part['config_values'],
+                                           part['photon_multiplier'])
+        simulator.run_simulation()
+        return SimindOutputs.save(simulator, os.path.join(part_dir, 'outputs'), n_windows)
+
+
+@traced('SIMIND simulation')
+def run_simind_parallel(config_file: str, output_dir: str, output_prefix: str, source, mu_map,
+                        window_lower, window_upper, runtime_switches: dict = None,
+                        config_values: dict = None, photon_multiplier: float = 1, n_parts: int = 4,
+                        seed=None, max_workers: int = None, executable=None) -> SimindOutputs:
+    '''
+    Split a SIMIND simulation into n_parts independent runs, each with its own random seed (RR
+    switch), photon_multiplier / n_parts of the photon histories and working directory
+    <output_dir>/part_<i>, run them concurrently and merge them (see merge_simind_outputs).
+    The Monte Carlo runs as separate SIMIND processes, so the parts are launched from threads.
 
-    Returns: matplotlib figure and axes objects.
+    Parameters:
+    config_file ... photon_multiplier: As for setup_simind_simulator; photon_multiplier is the total.
+    n_parts (int, optional): Number of runs (default is 4).
+    seed (int, optional): Seed the per-part SIMIND seeds are derived from (default is fresh OS entropy).
+    max_workers (int, optional): Number of concurrent runs (default is n_parts).
+    executable (str or list, optional): Command run instead of SIMIND for each part, e.g. a stand-in
+                                        for offline testing (see benchmarks/simind_standin.py). It is
+                                        called with --output-dir, --seed, --photon-multiplier and
+                                        --n-windows and must write tot_w<n>.hs and sca_w<n>.hs
+                                        into the output directory.
+
+    Returns (SimindOutputs): The merged outputs, in <output_dir>/merged.
+    '''
+    parts = [{
+        'config_file': config_file,
+        'output_dir': os.path.abspath(os.path.join(output_dir, f'part_{i:02d}')),
+        'output_prefix': output_prefix,
+        'source': source,
+        'mu_map': mu_map,
+        'window_lower': list(window_lower),
+        'window_upper': list(window_upper),
+        'runtime_switches': runtime_switches,
+        'config_values': config_values,
+        'photon_multiplier': photon_multiplier / n_parts,
+        'seed': part_seed,
+        'executable': executable,
+    } for i, part_seed in enumerate(_simind_part_seeds(seed, n_parts))]
+
+    log(f'Running {n_parts} SIMIND parts in {output_dir}...')
+    with ThreadPoolExecutor(max_workers=max_workers or n_parts) as executor:
+        part_outputs = list(executor.map(_run_simind_part, parts))
+
+    with stage('file write', prefix=output_prefix):
+        merged = merge_simind_outputs(part_outputs, os.path.join(output_dir, 'merged'))
+    log(f'Merged {n_parts} SIMIND parts into {merged.output_dir}')
+
+    return merged
+
+
+def _normalize_par_key(key: str) -> str:
     '''
-    n_images = len(recon_dict)
-    fig, axes = plt.subplots(1, n_images, figsize=(6*n_images, 5))
+    Normalize a par file key or section name: lower-case with collapsed whitespace.
+    '''
+    return ' '.join(key.strip().lower().split())
 
-    if n_images == 1:
-        axes = [axes]
 
-    # Get all arrays for consistent scaling
-    arrays = []
-    for name, img in recon_dict.items():
-        if hasattr(img, 'as_array'):
-            arr = img.as_array()
-        else:
-            arr = img
-        arrays.append(arr)
-
-    # Determine slice index if not provided
-    if slice_idx is None:
-        slice_idx = arrays[0].shape[0] // 2
-
-    # Determine color scale if not provided
-    if vmin is None or vmax is None:
-        all_data = np.concatenate([arr[slice_idx, :, :].flatten() for arr in arrays])
-        if vmin is None:
-            vmin = np.min(all_data)
-        if vmax is None:
-            vmax = np.max(all_data)
-
-    # Plot each image
-    for idx, (name, img) in enumerate(recon_dict.items()):
-        arr = arrays[idx]
-        im = axes[idx].imshow(arr[slice_idx, :, :], cmap=cmap, vmin=vmin, vmax=vmax)
-        axes[idx].set_title(name, fontsize=14, fontweight='bold')
-        axes[idx].axis('off')
-        plt.colorbar(im, ax=axes[idx], fraction=0.046, pad=0.04)
-
-    fig.suptitle(f'Reconstruction Comparison (Slice {slice_idx})', fontsize=16, fontweight='bold')
-    plt.tight_layout()
-
-    return fig, axes
+class ParFile:
+    '''
+    STIR par file parsed once into its lines and an index of keys by section. Sections are the
+    nested 'X Parameters :=' ... 'End X Parameters :=' blocks, so a key can be updated only
+    inside a given section, e.g. ('Projection Matrix By Bin SPECT UB Parameters', 'attenuation map').
+    Rendering a variant only touches the indexed lines, so many variants cost one parse.
+
+    Parameters:
+    lines (list of str): The lines of the par file.
+    '''
+
+    def __init__(self, lines):
+        self.lines = list(lines)
+        # [(line index, normalized key, tuple of enclosing normalized section names)]
+        self.entries = []
+        self._index = {}
+
+        sections = []
+        for i, line in enumerate(self.lines):
+            stripped = line.strip()
+            if stripped.startswith(';') or ':=' not in stripped:
+                continue
+            key, value = stripped.split(':=', 1)
+            key = _normalize_par_key(key)
+
+            if key == 'end' or key.startswith('end '):
+                if sections:
+                    sections.pop()
+                continue
+            if not value.strip() and key.endswith('parameters'):
+                sections.append(key)
+                continue
+
+            self.entries.append((i, key, tuple(sections)))
+            self._index.setdefault(key, []).append(len(self.entries) - 1)
+
+    @classmethod
+    def from_file(cls, par_file_path: str) -> 'ParFile':
+        with open(par_file_path, 'r') as f:
+            return cls(f.readlines())
+
+    def section_tree(self) -> dict:
+        '''
+        Return the nested {section: {..., key: value}} tree of the par file.
+        '''
+        tree = {}
+        for i, key, sections in self.entries:
+            node = tree
+            for section in sections:
+                node = node.setdefault(section, {})
+            node[key] = self.lines[i].split(':=', 1)[1].strip()
+        return tree
+
+    def _find(self, param) -> list:
+        '''
+        Return the line indices of a plain key (every occurrence) or of a (section, key) pair.
+        '''
+        if isinstance(param, tuple):
+            section, key = _normalize_par_key(param[0]), _normalize_par_key(param[1])
+            lines = [self.entries[e][0] for e in self._index.get(key, []) if section in self.entries[e][2]]
+            if not lines:
+                raise KeyError(f'{param[1]} not found in section {param[0]}')
+            return lines
+        return [self.entries[e][0] for e in self._index.get(_normalize_par_key(param), [])]
+
+    def get(self, param, default=None):
+        '''
+        Get the value of a plain key (first occurrence) or of a (section, key) pair.
+        '''
+        try:
+            lines = self._find(param)
+        except KeyError:
+            return default
+        return self.lines[lines[0]].split(':=', 1)[1].strip() if lines else default
+
+    def render(self, updates: dict) -> list:
+        '''
+        Return the lines of the par file with updates applied.
+
+        Parameters:
+        updates (dict): {key: value} pairs. A plain key updates every occurrence of the key (keys
+                        that do not exist are ignored); a (section, key) tuple only updates the key
+                        inside that section (at any depth) and raises KeyError if it is not there.
+
+        Returns (list of str): The updated lines.
+        '''
+        lines = list(self.lines)
+        for param, value in updates.items():
+            param_name = param[1] if isinstance(param, tuple) else param
+            for i in self._find(param):
+                line = self.lines[i]
+                indent = len(line) - len(line.lstrip())
+                lines[i] = ' ' * indent + f'{param_name} := {value}\n'
+        return lines
+
+    def write(self, output_par_path: str, updates: dict = None) -> str:
+        '''
+        Write the par file with updates applied (see render) and return its path.
+        '''
+        with open(output_par_path, 'w') as f:
+            f.writelines(self.render(updates or {}))
+        return output_par_path
+
+    def write_variants(self, variants) -> list:
+        '''
+        Write many variants of the par file from this single parse.
+
+        Parameters:
+        variants (iterable of (str, dict)): (output path, updates) pairs.
+
+        Returns (list of str): The written paths.
+        '''
+        return [self.write(output_par_path, updates) for output_par_path, updates in variants]
+
+
+# Parsed par files by absolute path, with the (mtime, size) they were parsed at
+_PAR_FILE_CACHE = {}
+
+
+def read_par_file(par_file_path: str) -> ParFile:
+    '''
+    Read and parse a STIR par file, memoized by path and modification time.
+
+    Parameters:
+    par_file_path (str): Path of the par file.
+
+    Returns (ParFile): The parsed par file.
+    '''
+    par_file_path = os.path.abspath(par_file_path)
+    stat = os.stat(par_file_path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+
+    cached = _PAR_FILE_CACHE.get(par_file_path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    par_file = ParFile.from_file(par_file_path)
+    _PAR_FILE_CACHE[par_file_path] = (stamp, par_file)
+    return par_file
+
+
+@traced('file write')
+def update_par_file(par_file_path: str, output_par_path: str, updates: dict) -> str:
+    '''
+    Update parameters in a STIR par file and save to a new location.
+    Only updates lines that exactly match the parameter name (before :=).
+    The template is parsed once and cached (see read_par_file).
+
+    Parameters:
+    par_file_path (str): Path to the original par file.
+    output_par_path (str): Path where the updated par file will be saved.
+    updates (dict): Dictionary of parameter names and their new values. A key can also be a
+                    (section, parameter name) tuple to update the parameter only inside that section.
+                    Example: {'input file': 'data.hs', 'output filename prefix': 'recon_result',
+                              ('Projection Matrix By Bin SPECT UB Parameters', 'psf type'): '3D'}
+
+    Returns (str): Path to the updated par file.
+    '''
+    return read_par_file(par_file_path).write(output_par_path, updates)
+
+
+def _load_stir_image(image):
+    '''
+    Return image unchanged, or read it with STIR if it is a path to an .hv file.
+    '''
+    if isinstance(image, (str, os.PathLike)):
+        import stir
+        return stir.FloatVoxelsOnCartesianGrid.read_from_file(str(image))
+    return image
+
+
+# Disk budget of the auxiliary image cache used by reconstruct_with_osem
+AUX_CACHE_MAX_BYTES = 2 * 1024**3
+
+
+def _image_geometry(image, shape: tuple = None) -> tuple:
+    '''
+    Return (shape, voxel size, origin) of a STIR image, used to key cached files.
+    '''
+    if shape is None:
+        shape = image.as_array().shape
+    voxel_size = image.get_voxel_size()
+    origin = image.get_origin()
+    return (tuple(shape),
+            tuple(round(float(voxel_size[i]), 6) for i in (1, 2, 3)),
+            tuple(round(float(origin[i]), 6) for i in (1, 2, 3)))
+
+
+def _cache_key(kind: str, geometry: tuple, data: np.ndarray = None) -> str:
+    '''
+    Hash the kind of file, the image geometry and (optionally) the voxel values.
+    '''
+    h = hashlib.sha256(f'{kind}:{geometry!r}'.encode())
+    if data is not None:
+        h.update(str(data.dtype).encode())
+        h.update(np.ascontiguousarray(data).data)
+    return h.hexdigest()[:24]
+
+
+def _evict_aux_cache(cache_dir: str, max_cache_bytes: int, keep):
+    '''
+    Delete least recently used cache entries until the cache fits in max_cache_bytes.
+    An entry is a header plus its data file; entries in keep are never deleted.
+    '''
+    entries = {}
+    for entry in os.scandir(cache_dir):
+        if not entry.is_file():
+            continue
+        stem = os.path.splitext(entry.name)[0]
+        stat = entry.stat()
+        size, mtime = entries.get(stem, (0, 0))
+        entries[stem] = (size + stat.st_size, max(mtime, stat.st_mtime))
+
+    total = sum(size for size, _ in entries.values())
+    for stem, (size, _) in sorted(entries.items(), key=lambda item: item[1][1]):
+        if total <= max_cache_bytes:
+            break
+        if stem in keep:
+            continue
+        for ext in ('.hv', '.v'):
+            try:
+                os.remove(os.path.join(cache_dir, stem + ext))
+            except FileNotFoundError:
+                pass
+        total -= size
+
+
+def _write_cached_image(image, cache_dir: str, stem: str) -> str:
+    '''
+    Write image to <cache_dir>/<stem>.hv unless it is already cached. Files are written to a
+    private directory first and moved into place, so concurrent writers never expose partial files.
+    '''
+    hv_file = os.path.join(cache_dir, f'{stem}.hv')
+    if os.path.exists(hv_file):
+        os.utime(hv_file)
+        return hv_file
+
+    tmp_dir = os.path.join(cache_dir, f'tmp-{uuid.uuid4().hex}')
+    os.makedirs(tmp_dir)
+    try:
+        image.write_to_file(os.path.join(tmp_dir, f'{stem}.hv'))
+        # data file(s) first, so the header only appears once its data is complete
+        names = sorted(os.listdir(tmp_dir), key=lambda name: name.endswith('.hv'))
+        for name in names:
+            os.replace(os.path.join(tmp_dir, name), os.path.join(cache_dir, name))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return hv_file
+
+
+@traced('auxiliary images')
+def get_cached_aux_images(initial_image_template, attenuation_image,
+                          cache_dir: str = './temp_recon/aux_cache',
+                          max_cache_bytes: int = AUX_CACHE_MAX_BYTES) -> tuple:
+    '''
+    Get the initial estimate (filled with 1), attenuation map and mask files for a reconstruction.
+    Files are keyed by a hash of their geometry and content, written once to cache_dir and reused
+    by every reconstruction with the same inputs. Least recently used entries are evicted when the
+    cache grows beyond max_cache_bytes.
+
+    Parameters:
+    initial_image_template: STIR image defining the geometry of the initial estimate.
+    attenuation_image: STIR image containing the attenuation map.
+    cache_dir (str, optional): The cache directory (default: './temp_recon/aux_cache').
+    max_cache_bytes (int, optional): Disk budget of the cache (default is AUX_CACHE_MAX_BYTES).
+
+    Returns (tuple of str): Paths of the initial estimate, attenuation map and mask headers.
+    '''
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    cache_dir = os.path.abspath(cache_dir)
+
+    # The initial estimate is constant, so its geometry is enough to identify it
+    init_stem = 'init_' + _cache_key('init', _image_geometry(initial_image_template))
+    init_file = os.path.join(cache_dir, f'{init_stem}.hv')
+    if not os.path.exists(init_file):
+        init_image = initial_image_template.clone()
+        init_image.fill(1.0)
+        _write_cached_image(init_image, cache_dir, init_stem)
+    else:
+        os.utime(init_file)
+
+    atten_arr = attenuation_image.as_array()
+    atten_key = _cache_key('atten', _image_geometry(attenuation_image, atten_arr.shape), atten_arr)
+
+    atten_stem = f'atten_{atten_key}'
+    atten_file = _write_cached_image(attenuation_image, cache_dir, atten_stem)
+
+    # The mask is derived from the attenuation map, so it shares its key
+    mask_stem = f'mask_{atten_key}'
+    mask_file = os.path.join(cache_dir, f'{mask_stem}.hv')
+    if not os.path.exists(mask_file):
+        mask = attenuation_image.clone()
+        mask.fill((atten_arr > 0).astype(atten_arr.dtype))
+        _write_cached_image(mask, cache_dir, mask_stem)
+    else:
+        os.utime(mask_file)
+
+    _evict_aux_cache(cache_dir, max_cache_bytes, keep={init_stem, atten_stem, mask_stem})
+
+    return init_file, atten_file, mask_file
+
+
+# Section of the par file holding the SPECT UB projection matrix settings
+_SPECT_UB_SECTION = 'Projection Matrix By Bin SPECT UB Parameters'
+
+
+def _write_recon_par_file(input_file: str, output_prefix: str, par_file_template: str, aux_files: tuple,
+                          num_subsets: int, num_subiterations: int, temp_dir: str,
+                          par_updates: dict = None) -> str:
+    '''
+    Write <temp_dir>/<output_prefix>_recon.par from the template, pointing it at the input
+    data and at the (initial estimate, attenuation map, mask) files in aux_files.
+    par_updates are applied on top (see update_par_file).
+    '''
+    init_file, atten_file, mask_file = aux_files
+    temp_par_file = os.path.join(temp_dir, f'{output_prefix}_recon.par')
+    updates = {
+        'input file': input_file,
+        'output filename prefix': os.path.join(temp_dir, output_prefix),
+        'initial estimate': init_file,
+        (_SPECT_UB_SECTION, 'attenuation map'): atten_file,
+        (_SPECT_UB_SECTION, 'mask file'): mask_file,
+        'number of subsets': num_subsets,
+        'number of subiterations': num_subiterations,
+    }
+    if par_updates:
+        updates.update(par_updates)
+
+    return update_par_file(par_file_template, temp_par_file, updates)
+
+
+def _set_up_osem(input_file: str, output_prefix: str, par_file_template: str, initial_image_template,
+                 attenuation_image, num_subsets: int, num_subiterations: int, temp_dir: str,
+                 cache_dir: str, par_updates: dict = None) -> tuple:
+    '''
+    Write the par file for a reconstruction, create the STIR OSMAPOSL object and set it up.
+
+    Returns (tuple): The reconstruction object and the initial estimate (filled with 1).
+    '''
+    import stir
+    from pathlib import Path
+
+    initial_image_template = _load_stir_image(initial_image_template)
+    attenuation_image = _load_stir_image(attenuation_image)
+
+    # Create temp directory if it doesn't exist
+    Path(temp_dir).mkdir(parents=True, exist_ok=True)
+
+    # Convert all paths to absolute paths
+    temp_dir_abs = os.path.abspath(temp_dir)
+    input_file_abs = os.path.abspath(input_file)
+    par_file_template_abs = os.path.abspath(par_file_template)
+
+    # Initial estimate
+    target = initial_image_template.clone()
+    target.fill(1.0)
+
+    # Initial estimate, attenuation map and mask files are shared through the content-addressed cache
+    init_file, atten_file, mask_file = get_cached_aux_images(initial_image_template, attenuation_image,
+                                                             cache_dir=cache_dir)
+
+    # Create modified par file with all necessary paths
+    temp_par_file = _write_recon_par_file(input_file_abs, output_prefix, par_file_template_abs,
+                                          (init_file, atten_file, mask_file), num_subsets,
+                                          num_subiterations, temp_dir_abs, par_updates)
+
+    # Initialize reconstruction object and set it up (computes the projection matrix)
+    with stage('reconstruction set-up', prefix=output_prefix):
+        recon = stir.OSMAPOSLReconstruction3DFloat(temp_par_file)
+        s = recon.set_up(target)
+    if not s.succeeded():
+        raise RuntimeError(f'Error setting up reconstruction for {output_prefix}')
+
+    return recon, target
+
+
+@traced('reconstruction')
+def reconstruct_with_osem(input_file: str, output_prefix: str, par_file_template: str,
+                          initial_image_template, attenuation_image, num_subsets: int = 4,
+                          num_subiterations: int = 24, temp_dir: str = './temp_recon',
+                          cache_dir: str = './temp_recon/aux_cache', initial_estimate=None,
+                          crop_to_support: bool = False, crop_margin_mm: float = 10.0,
+                          write_output: bool = True):
+    '''
+    Perform OSEM reconstruction using STIR with a modified par file.
+
+    Parameters:
+    input_file (str): Path to the input acquisition data (.hs file).
+    output_prefix (str): Prefix for output files.
+    par_file_template (str): Path to the template par file.
+    initial_image_template: STIR image object (or path to its .hv file) to use as template for initial image.
+    attenuation_image: STIR image object (or path to its .hv file) containing attenuation map.
+    num_subsets (int): Number of subsets for OSEM (default: 4).
+    num_subiterations (int): Number of subiterations (default: 24).
+    temp_dir (str): Directory for temporary files (default: './temp_recon').
+    cache_dir (str): Directory of the initial estimate/attenuation/mask cache shared between
+                     reconstructions (default: './temp_recon/aux_cache').
+    initial_estimate (optional): Image, ndarray or .hv path to start from instead of a uniform image of 1.
+    crop_to_support (bool): Reconstruct on the transaxial bounding box of the attenuation mask only,
+                            then re-embed the result (zero outside) in the full grid (default: False).
+    crop_margin_mm (float): Margin kept around the mask when cropping (default: 10 mm).
+    write_output (bool): Write the result to <temp_dir>/<output_prefix>.hv (default: True).
+
+    Returns: The reconstructed image (stir.FloatVoxelsOnCartesianGrid).
+    '''
+    full_template, crop = None, None
+    if crop_to_support:
+        full_template = _load_stir_image(initial_image_template)
+        attenuation_image = _load_stir_image(attenuation_image)
+        crop = support_crop(attenuation_image, crop_margin_mm)
+        initial_image_template = crop_image(full_template, crop)
+        attenuation_image = crop_image(attenuation_image, crop)
+        if initial_estimate is not None:
+            initial_estimate = np.asarray(open_volume(initial_estimate))[(slice(None),) + crop]
+        log(f'  Cropped to support: {full_template.as_array().size} -> '
+            f'{initial_image_template.as_array().size} voxels', level=2)
+
+    recon, target = _set_up_osem(input_file, output_prefix, par_file_template, initial_image_template,
+                                 attenuation_image, num_subsets, num_subiterations, temp_dir, cache_dir)
+    if initial_estimate is not None:
+        target.fill(np.asarray(open_volume(initial_estimate), dtype=np.float32))
+
+    # Run reconstruction
+    log(f'Running reconstruction for {output_prefix}...')
+    log(f'  Input file: {input_file}')
+    log(f'  Subsets: {num_subsets}, Subiterations: {num_subiterations}')
+
+    recon.set_start_subiteration_num(1)
+    recon.set_num_subiterations(num_subiterations)
+    with stage('reconstruction iterations', prefix=output_prefix):
+        s = recon.reconstruct(target)
+
+    if not s.succeeded():
+        raise RuntimeError(f'Reconstruction failed for {output_prefix}')
+
+    if crop is not None:
+        target = embed_image(target, full_template, crop)
+
+    if not write_output:
+        log(f'Reconstruction complete for {output_prefix}')
+        return target
+
+    # Save the reconstructed image
+    output_filename = os.path.join(temp_dir, f'{output_prefix}.hv')
+    with stage('file write', prefix=output_prefix):
+        target.write_to_file(output_filename)
+    log(f'Reconstruction complete. Saved to: {output_filename}')
+
+    return target
+
+
+def _image_voxel_size(image) -> tuple:
+    '''
+    Return the (z, y, x) voxel size of a STIR image in mm.
+    '''
+    voxel_size = image.get_voxel_size()
+    return tuple(float(voxel_size[i]) for i in (1, 2, 3))
+
+
+def _new_stir_image(arr: np.ndarray, voxel_size: tuple):
+    '''
+    Create a STIR image holding arr with the given (z, y, x) voxel size, as the notebook does.
+    '''
+    from sirf_simind_connection.utils.stir_utils import create_stir_image
+
+    image = create_stir_image(arr.shape, voxel_size)
+    image = getattr(image, 'native_object', image)
+    image.fill(np.ascontiguousarray(arr, dtype=np.float32))
+    return image
+
+
+def downsample_image(image, factor: int = 2):
+    '''
+    Downsample a STIR image by averaging factor^3 blocks of voxels (e.g. for attenuation maps).
+
+    Parameters:
+    image: STIR image object (or path to its .hv file). Its shape must be divisible by factor.
+    factor (int, optional): Downsampling factor (default is 2).
+
+    Returns: The downsampled STIR image, with factor times larger voxels.
+    '''
+    image = _load_stir_image(image)
+    arr = image.as_array()
+    if any(n % factor for n in arr.shape):
+        raise ValueError(f'Image shape {arr.shape} is not divisible by {factor}')
+
+    nz, ny, nx = (n // factor for n in arr.shape)
+    coarse = arr.reshape(nz, factor, ny, factor, nx, factor).mean(axis=(1, 3, 5))
+    return _new_stir_image(coarse, tuple(size * factor for size in _image_voxel_size(image)))
+
+
+def upsample_array(arr: np.ndarray, factor: int = 2, conserve: str = 'mean') -> np.ndarray:
+    '''
+    Upsample a (z, y, x) array by repeating every voxel factor^3 times.
+
+    Parameters:
+    arr (ndarray): The coarse image.
+    factor (int, optional): Upsampling factor (default is 2).
+    conserve (str, optional): 'mean' keeps the voxel values, as for activity concentrations such as
+                              OSEM estimates (default); 'sum' divides by factor^3 so the image total
+                              is unchanged, as for counts per voxel.
+
+    Returns (ndarray): The upsampled image.
+    '''
+    if conserve not in ('mean', 'sum'):
+        raise ValueError(f"Unknown conserve: {conserve}. Choose 'mean' or 'sum'")
+    fine = arr.repeat(factor, axis=0).repeat(factor, axis=1).repeat(factor, axis=2)
+    if conserve == 'sum':
+        fine /= factor ** 3
+    return fine
+
+
+def support_crop(attenuation_image, margin_mm: float = 10.0) -> tuple:
+    '''
+    Compute the transaxial crop of the image grid covering the attenuation mask (> 0) plus a margin.
+    The crop is symmetric about the image centre, so the cropped grid stays centred on the axis of
+    rotation, and all slices are kept, so it still matches the axial sampling of the projections.
+
+    Parameters:
+    attenuation_image: STIR image (or path to its .hv file, or ndarray) containing the attenuation map.
+    margin_mm (float, optional): Margin kept around the mask (default is 10 mm).
+
+    Returns (tuple of slice): The (y, x) slices of the crop.
+    '''
+    if isinstance(attenuation_image, np.ndarray):
+        arr, voxel_size = attenuation_image, (1.0, 1.0, 1.0)
+    else:
+        attenuation_image = _load_stir_image(attenuation_image)
+        arr, voxel_size = attenuation_image.as_array(), _image_voxel_size(attenuation_image)
+
+    support = arr > 0
+    crop = []
+    for axis, (n, size) in zip((1, 2), zip(arr.shape[1:], voxel_size[1:])):
+        profile = support.any(axis=tuple(a for a in range(3) if a != axis))
+        indices = np.flatnonzero(profile)
+        if len(indices) == 0:
+            crop.append(slice(0, n))
+            continue
+        # half-width (in voxels) from the centre that covers the support and the margin
+        centre = (n - 1) / 2
+        half = max(centre - indices[0], indices[-1] - centre) + margin_mm / size
+        # keep the parity of n so the cropped grid has the same centre
+        width = min(n, int(np.ceil(2 * half + 1)))
+        width += (n - width) % 2
+        start = (n - width) // 2
+        crop.append(slice(start, start + width))
+
+    return tuple(crop)
+
+
+def crop_image(image, crop: tuple):
+    '''
+    Crop a STIR image transaxially to the (y, x) slices from support_crop.
+
+    Returns: A new STIR image with the same voxel size.
+    '''
+    image = _load_stir_image(image)
+    return _new_stir_image(image.as_array()[(slice(None),) + tuple(crop)], _image_voxel_size(image))
+
+
+def embed_image(cropped_image, full_template, crop: tuple):
+    '''
+    Place a cropped STIR image back into the full grid of full_template (zero outside the crop).
+
+    Returns: A new STIR image with the geometry of full_template.
+    '''
+    full_arr = np.zeros(full_template.as_array().shape, dtype=np.float32)
+    full_arr[(slice(None),) + tuple(crop)] = cropped_image.as_array()
+    image = full_template.clone()
+    image.fill(full_arr)
+    return image
+
+
+@traced('multi-resolution reconstruction')
+def reconstruct_with_osem_multires(input_file: str, output_prefix: str, par_file_template: str,
+                                   initial_image_template, attenuation_image, factor: int = 2,
+                                   num_subsets: int = 4, coarse_subiterations: int = 16,
+                                   fine_subiterations: int = 4, temp_dir: str = './temp_recon',
+                                   cache_dir: str = './temp_recon/aux_cache',
+                                   reference_subiterations: int = None, vois: dict = None):
+    '''
+    Coarse-to-fine OSEM: reconstruct rebinned projections on a grid with factor times larger voxels
+    (with a downsampled attenuation map and mask), then use the upsampled result as the initial
+    estimate of a few full-resolution subiterations.
+
+    Parameters:
+    input_file (str): Path to the input acquisition data (.hs file).
+    output_prefix (str): Prefix for output files.
+    par_file_template (str): Path to the template par file.
+    initial_image_template: STIR image object (or path to its .hv file) defining the full-resolution grid.
+    attenuation_image: STIR image object (or path to its .hv file) containing attenuation map.
+    factor (int): Rebinning/downsampling factor (default: 2).
+    num_subsets (int): Number of subsets for OSEM (default: 4).
+    coarse_subiterations (int): Subiterations on the coarse grid (default: 16).
+    fine_subiterations (int): Subiterations on the full-resolution grid (default: 4).
+    temp_dir (str): Directory for temporary files (default: './temp_recon').
+    cache_dir (str): Directory of the shared initial estimate/attenuation/mask cache.
+    reference_subiterations (int, optional): If given, also run the single-resolution path with this
+                                             many subiterations and report the differences.
+    vois (dict, optional): build_earl_vois output for the full-resolution grid; with a reference run,
+                           the sphere mean recovery of both results is compared.
+
+    Returns (tuple): The reconstructed image (stir.FloatVoxelsOnCartesianGrid) and a report dictionary
+                     with the timings ('coarse_s', 'fine_s', 'total_s' and, with a reference run,
+                     'reference_s') and, with vois, the sphere means and their relative differences.
+    '''
+    import time
+
+    initial_image_template = _load_stir_image(initial_image_template)
+    attenuation_image = _load_stir_image(attenuation_image)
+    Path(temp_dir).mkdir(parents=True, exist_ok=True)
+
+    report = {'factor': factor, 'coarse_subiterations': coarse_subiterations,
+              'fine_subiterations': fine_subiterations}
+
+    start = time.perf_counter()
+    with stage('multi-resolution coarse', prefix=output_prefix):
+        coarse_input = rebin_interfile_projections(
+            input_file, os.path.join(temp_dir, f'{output_prefix}_coarse_input.hs'), factor)
+        coarse_attenuation = downsample_image(attenuation_image, factor)
+        coarse = reconstruct_with_osem(coarse_input, f'{output_prefix}_coarse', par_file_template,
+                                       coarse_attenuation, coarse_attenuation, num_subsets=num_subsets,
+                                       num_subiterations=coarse_subiterations, temp_dir=temp_dir,
+                                       cache_dir=cache_dir)
+    report['coarse_s'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with stage('multi-resolution fine', prefix=output_prefix):
+        target = reconstruct_with_osem(input_file, output_prefix, par_file_template, initial_image_template,
+                                       attenuation_image, num_subsets=num_subsets,
+                                       num_subiterations=fine_subiterations, temp_dir=temp_dir,
+                                       cache_dir=cache_dir,
+                                       initial_estimate=upsample_array(coarse.as_array(), factor, conserve='mean'))
+    report['fine_s'] = time.perf_counter() - start
+    report['total_s'] = report['coarse_s'] + report['fine_s']
+
+    if reference_subiterations is not None:
+        start = time.perf_counter()
+        reference = reconstruct_with_osem(input_file, f'{output_prefix}_reference', par_file_template,
+                                          initial_image_template, attenuation_image, num_subsets=num_subsets,
+                                          num_subiterations=reference_subiterations, temp_dir=temp_dir,
+                                          cache_dir=cache_dir)
+        report['reference_s'] = time.perf_counter() - start
+        report['speedup'] = report['reference_s'] / report['total_s']
+
+        if vois is not None:
+            from stir_simind_analysis import voi_statistics
+
+            means = voi_statistics([target, reference], vois)['mean']
+            report['sphere_mean_multires'] = means[0]
+            report['sphere_mean_reference'] = means[1]
+            report['sphere_mean_relative_difference'] = (means[0] - means[1]) / means[1]
+
+    log(f"Multi-resolution reconstruction: {report['total_s']:.1f} s "
+        f"(coarse {report['coarse_s']:.1f} s, fine {report['fine_s']:.1f} s)")
+    if 'reference_s' in report:
+        log(f"  Single-resolution reference: {report['reference_s']:.1f} s (speed-up x{report['speedup']:.2f})")
+
+    return target, report
+
+
+def _largest_divisor(n: int, limit: int) -> int:
+    '''
+    Return the largest divisor of n that is at most limit (at least 1).
+    '''
+    return max(d for d in range(1, max(1, min(n, limit)) + 1) if n % d == 0)
+
+
+@traced('preview')
+def preview_reconstruction(input_file: str, par_file_template: str, initial_image_template,
+                           attenuation_image, view_step: int = 4, factor: int = 2, num_subsets: int = 4,
+                           num_subiterations: int = 4, output_prefix: str = 'preview',
+                           temp_dir: str = './temp_recon/preview',
+                           cache_dir: str = './temp_recon/aux_cache'):
+    '''
+    Quick-look OSEM reconstruction: keep every view_step-th view, rebin the detector matrix by
+    factor, reconstruct a few subiterations on a grid with factor times larger voxels and return the
+    result upsampled to the original grid. Meant to catch bad scatter correction or misaligned
+    phantom offsets in seconds, before the full reconstruction.
+
+    Parameters:
+    input_file (str): Path to the input acquisition data (.hs file, e.g. from stream_scatter_correction).
+    par_file_template (str): Path to the template par file.
+    initial_image_template: STIR image object (or path to its .hv file) defining the output grid.
+    attenuation_image: STIR image object (or path to its .hv file) containing attenuation map.
+    view_step (int): Keep every view_step-th view; must divide the number of views (default: 4).
+    factor (int): Detector rebinning and image downsampling factor (default: 2, 1 to keep the grid).
+    num_subsets (int): Maximum number of subsets; the largest divisor of the remaining number of
+                       views not above it is used (default: 4).
+    num_subiterations (int): Number of subiterations (default: 4).
+    output_prefix (str): Prefix for output files (default: 'preview').
+    temp_dir (str): Directory for temporary files and the preview image (default: './temp_recon/preview').
+    cache_dir (str): Directory of the shared initial estimate/attenuation/mask cache.
+
+    Returns (tuple): The preview image on the grid of initial_image_template (also written to
+                     <temp_dir>/<output_prefix>.hv) and a report dictionary with 'time_s', 'n_views',
+                     'num_subsets', 'num_subiterations' and 'matrix_size' of the preview.
+    '''
+    import time
+
+    start = time.perf_counter()
+    initial_image_template = _load_stir_image(initial_image_template)
+    attenuation_image = _load_stir_image(attenuation_image)
+    Path(temp_dir).mkdir(parents=True, exist_ok=True)
+
+    preview_input = rebin_interfile_projections(input_file, os.path.join(temp_dir, f'{output_prefix}_input.hs'),
+                                                factor=factor, view_step=view_step)
+    n_views = read_interfile_header(preview_input).get_int('number of projections')
+    preview_subsets = _largest_divisor(n_views, num_subsets)
+
+    preview_attenuation = downsample_image(attenuation_image, factor) if factor > 1 else attenuation_image
+    target = reconstruct_with_osem(preview_input, output_prefix, par_file_template, preview_attenuation,
+                                   preview_attenuation, num_subsets=preview_subsets,
+                                   num_subiterations=num_subiterations, temp_dir=temp_dir,
+                                   cache_dir=cache_dir, write_output=False)
+
+    preview = initial_image_template.clone()
+    preview.fill(upsample_array(target.as_array(), factor) if factor > 1 else target.as_array())
+    output_filename = os.path.join(temp_dir, f'{output_prefix}.hv')
+    with stage('file write', prefix=output_prefix):
+        preview.write_to_file(output_filename)
+
+    report = {
+        'time_s': time.perf_counter() - start,
+        'n_views': n_views,
+        'num_subsets': preview_subsets,
+        'num_subiterations': num_subiterations,
+        'matrix_size': tuple(target.as_array().shape),
+    }
+    log(f"Preview reconstruction: {report['time_s']:.1f} s ({n_views} views, {preview_subsets} subsets, "
+        f"{num_subiterations} subiterations, matrix {report['matrix_size']})")
+
+    return preview, report
+
+
+def relative_image_change(image_arr: np.ndarray, previous_arr: np.ndarray) -> float:
+    '''
+    Relative change ||image - previous|| / ||previous|| between two successive estimates.
+    '''
+    norm = np.linalg.norm(previous_arr)
+    if norm == 0:
+        return np.inf
+    return float(np.linalg.norm(image_arr - previous_arr) / norm)
+
+
+@traced('reconstruction')
+def reconstruct_with_osem_monitored(input_file: str, output_prefix: str, par_file_template: str,
+                                    initial_image_template, attenuation_image, num_subsets: int = 4,
+                                    max_subiterations: int = 24, chunk_subiterations: int = 4,
+                                    metrics: dict = None, stop_metric: str = 'relative_change',
+                                    tol: float = 1e-3, temp_dir: str = './temp_recon',
+                                    cache_dir: str = './temp_recon/aux_cache'):
+    '''
+    Perform OSEM reconstruction in chunks of subiterations on the same image, evaluating
+    convergence metrics in memory after every chunk and stopping early once converged.
+    Intermediate estimates are not written to disk.
+
+    Parameters:
+    input_file (str): Path to the input acquisition data (.hs file).
+    output_prefix (str): Prefix for output files.
+    par_file_template (str): Path to the template par file.
+    initial_image_template: STIR image object (or path to its .hv file) to use as template for initial image.
+    attenuation_image: STIR image object (or path to its .hv file) containing attenuation map.
+    num_subsets (int): Number of subsets for OSEM (default: 4).
+    max_subiterations (int): Maximum number of subiterations (default: 24).
+    chunk_subiterations (int): Number of subiterations between metric evaluations (default: 4).
+    metrics (dict, optional): {name: function(image_arr, previous_arr) -> float} evaluated after each
+                              chunk. 'relative_change' (relative_image_change) is always included.
+    stop_metric (str, optional): Name of the metric compared against tol, or None to never stop early
+                                 (default: 'relative_change').
+    tol (float, optional): Stop when stop_metric is at or below this value (default: 1e-3).
+    temp_dir (str): Directory for temporary files (default: './temp_recon').
+    cache_dir (str): Directory of the shared initial estimate/attenuation/mask cache
+                     (default: './temp_recon/aux_cache').
+
+    Returns (tuple): The reconstructed image (stir.FloatVoxelsOnCartesianGrid) and the trace,
+                     a list of {'subiteration': n, <metric name>: value, ...} dictionaries.
+    '''
+    all_metrics = {'relative_change': relative_image_change}
+    if metrics:
+        all_metrics.update(metrics)
+    if stop_metric is not None and stop_metric not in all_metrics:
+        raise ValueError(f'Unknown stop metric: {stop_metric}')
+
+    recon, target = _set_up_osem(input_file, output_prefix, par_file_template, initial_image_template,
+                                 attenuation_image, num_subsets, max_subiterations, temp_dir, cache_dir)
+    if hasattr(recon, 'set_disable_output'):
+        recon.set_disable_output(True)
+
+    log(f'Running monitored reconstruction for {output_prefix}...')
+    log(f'  Input file: {input_file}')
+    log(f'  Subsets: {num_subsets}, Max subiterations: {max_subiterations}')
+
+    trace = []
+    previous_arr = target.as_array()
+    for start in range(1, max_subiterations + 1, chunk_subiterations):
+        stop = min(start + chunk_subiterations - 1, max_subiterations)
+
+        # Continue from the current estimate; subset order follows the subiteration number
+        recon.set_start_subiteration_num(start)
+        recon.set_num_subiterations(stop)
+        with stage('reconstruction iterations', prefix=output_prefix):
+            s = recon.reconstruct(target)
+        if not s.succeeded():
+            raise RuntimeError(f'Reconstruction failed for {output_prefix} at subiteration {stop}')
+
+        with stage('convergence metrics', prefix=output_prefix):
+            image_arr = target.as_array()
+            entry = {'subiteration': stop}
+            for name, metric in all_metrics.items():
+                entry[name] = metric(image_arr, previous_arr)
+        trace.append(entry)
+        previous_arr = image_arr
+
+        if stop_metric is not None and entry[stop_metric] <= tol:
+            log(f'  Converged at subiteration {stop} ({stop_metric} = {entry[stop_metric]:.3g})')
+            break
+
+    output_filename = os.path.join(temp_dir, f'{output_prefix}.hv')
+    with stage('file write', prefix=output_prefix):
+        target.write_to_file(output_filename)
+    log(f'Reconstruction complete. Saved to: {output_filename}')
+
+    return target, trace
+
+
+# Interfile keys that define the projection geometry seen by the SPECT UB projection matrix
+_PROJECTION_GEOMETRY_KEYS = (
+    'matrix size [1]', 'matrix size [2]',
+    'scaling factor (mm/pixel) [1]', 'scaling factor (mm/pixel) [2]',
+    'number of projections', 'extent of rotation', 'start angle',
+    'direction of rotation', 'orbit', 'radius', 'radii',
+)
+
+
+def _projection_geometry(hdr_path: str) -> tuple:
+    '''
+    Return the projection geometry of an Interfile acquisition as a comparable tuple.
+    '''
+    header = read_interfile_header(hdr_path)
+    return tuple(' '.join(header.get(key, '').lower().split()) for key in _PROJECTION_GEOMETRY_KEYS)
+
+
+def _projection_shape(hdr_path: str) -> tuple:
+    '''
+    Return the shape of the projections of an Interfile acquisition in the as_array() axis order
+    (1, axial, views, tangential).
+    '''
+    header = read_interfile_header(hdr_path)
+    return (1, header.get_int('matrix size [2]'), header.get_int('number of projections'),
+            header.get_int('matrix size [1]'))
+
+
+class OSEMSession:
+    '''
+    OSEM reconstruction session that sets up STIR once per geometry, attenuation map and PSF
+    configuration and then reconstructs any number of acquisitions with that geometry.
+    The SPECT UB projection matrix (kept in cache with 'keep all views in cache:=1') is computed
+    on the first set-up and reused for every following dataset, as only the input data change.
+    Datasets are .hs paths or in-memory acquisitions (acquisition data objects or ndarrays, e.g.
+    noise realizations), which are written to temp_dir with the header of input_template.
+
+    Parameters:
+    par_file_template (str): Path to the template par file.
+    initial_image_template: STIR image object (or path to its .hv file) to use as template for initial image.
+    attenuation_image: STIR image object (or path to its .hv file) containing attenuation map.
+    num_subsets (int): Number of subsets for OSEM (default: 4).
+    num_subiterations (int): Number of subiterations (default: 24).
+    temp_dir (str): Directory for temporary and output files (default: './temp_recon').
+    cache_dir (str): Directory of the shared initial estimate/attenuation/mask cache
+                     (default: './temp_recon/aux_cache').
+    input_template (str, optional): Interfile header (.hs) with the projection geometry of in-memory
+                                    datasets (default is the first dataset given as a path).
+    '''
+
+    def __init__(self, par_file_template: str, initial_image_template, attenuation_image,
+                 num_subsets: int = 4, num_subiterations: int = 24, temp_dir: str = './temp_recon',
+                 cache_dir: str = './temp_recon/aux_cache', input_template: str = None):
+        self.par_file_template = os.path.abspath(par_file_template)
+        self.initial_image_template = _load_stir_image(initial_image_template)
+        self.attenuation_image = _load_stir_image(attenuation_image)
+        self.num_subsets = num_subsets
+        self.num_subiterations = num_subiterations
+        self.temp_dir = os.path.abspath(temp_dir)
+        self.cache_dir = cache_dir
+        self.input_template = None if input_template is None else os.path.abspath(input_template)
+
+        self._recon = None
+        self._geometry = None
+
+    def _new_target(self):
+        target = self.initial_image_template.clone()
+        target.fill(1.0)
+        return target
+
+    def _set_up(self, input_file: str, output_prefix: str):
+        '''
+        Create and set up the STIR reconstruction object for the first dataset.
+        '''
+        import stir
+
+        Path(self.temp_dir).mkdir(parents=True, exist_ok=True)
+        aux_files = get_cached_aux_images(self.initial_image_template, self.attenuation_image,
+                                          cache_dir=self.cache_dir)
+        temp_par_file = _write_recon_par_file(input_file, output_prefix, self.par_file_template, aux_files,
+                                              self.num_subsets, self.num_subiterations, self.temp_dir)
+
+        with stage('reconstruction set-up', prefix=output_prefix):
+            recon = stir.OSMAPOSLReconstruction3DFloat(temp_par_file)
+            s = recon.set_up(self._new_target())
+        if not s.succeeded():
+            raise RuntimeError(f'Error setting up reconstruction for {output_prefix}')
+
+        self._recon = recon
+        self._geometry = _projection_geometry(input_file)
+
+    def _input_file(self, dataset, output_prefix: str) -> str:
+        '''
+        Return the .hs path of a dataset, writing in-memory acquisitions to temp_dir after checking
+        their shape against the geometry of the input template.
+        '''
+        if isinstance(dataset, (str, os.PathLike)):
+            input_file = os.path.abspath(dataset)
+            if self.input_template is None:
+                self.input_template = input_file
+            return input_file
+
+        if self.input_template is None:
+            raise ValueError(f'{output_prefix}: in-memory datasets need an input_template header '
+                             'with their projection geometry')
+        arr = open_volume(dataset)
+        expected = _projection_shape(self.input_template)
+        if tuple(arr.shape) != expected:
+            raise ValueError(f'{output_prefix}: projections of shape {tuple(arr.shape)} do not match the '
+                             f'geometry of this session {expected}')
+
+        Path(self.temp_dir).mkdir(parents=True, exist_ok=True)
+        return write_projections_array(arr, self.input_template,
+                                       os.path.join(self.temp_dir, f'{output_prefix}_input.hs'))
+
+    @traced('reconstruction')
+    def reconstruct(self, dataset, output_prefix: str):
+        '''
+        Reconstruct one acquisition, reusing the projection matrix of previous datasets.
+
+        Parameters:
+        dataset (str or AcquisitionData or ndarray): Path to the input acquisition data (.hs file), or
+                                                      the projections in memory (as_array() axis order).
+        output_prefix (str): Prefix for output files.
+
+        Returns: The reconstructed image (stir.FloatVoxelsOnCartesianGrid).
+        '''
+        import stir
+
+        input_file = self._input_file(dataset, output_prefix)
+        target = self._new_target()
+
+        if self._recon is None:
+            self._set_up(input_file, output_prefix)
+        else:
+            if _projection_geometry(input_file) != self._geometry:
+                raise ValueError(f'{input_file} does not match the projection geometry of this session')
+
+            # Only the data change: the projector keeps its cached matrix for the same geometry
+            with stage('reconstruction set-up', prefix=output_prefix, reused=True):
+                self._recon.set_input_data(stir.ProjData.read_from_file(input_file))
+                self._recon.set_output_filename_prefix(os.path.join(self.temp_dir, output_prefix))
+                s = self._recon.set_up(target)
+            if not s.succeeded():
+                raise RuntimeError(f'Error setting up reconstruction for {output_prefix}')
+
+        log(f'Running reconstruction for {output_prefix}...')
+        log(f'  Input file: {input_file}')
+        log(f'  Subsets: {self.num_subsets}, Subiterations: {self.num_subiterations}')
+
+        self._recon.set_start_subiteration_num(1)
+        self._recon.set_num_subiterations(self.num_subiterations)
+        with stage('reconstruction iterations', prefix=output_prefix):
+            s = self._recon.reconstruct(target)
+        if not s.succeeded():
+            raise RuntimeError(f'Reconstruction failed for {output_prefix}')
+
+        output_filename = os.path.join(self.temp_dir, f'{output_prefix}.hv')
+        with stage('file write', prefix=output_prefix):
+            target.write_to_file(output_filename)
+        log(f'Reconstruction complete. Saved to: {output_filename}')
+
+        return target
+
+    def reconstruct_all(self, datasets, output_prefixes=None) -> list:
+        '''
+        Reconstruct a sequence of acquisitions with the same geometry.
+
+        Parameters:
+        datasets (list): Paths to the input acquisition data (.hs files) or in-memory acquisitions.
+        output_prefixes (list of str, optional): Prefix for each output (default is the input file name,
+                                                 or 'dataset_<i>' for in-memory acquisitions).
+
+        Returns (list): The reconstructed images, in input order.
+        '''
+        datasets = list(datasets)
+        if output_prefixes is None:
+            output_prefixes = [Path(dataset).stem if isinstance(dataset, (str, os.PathLike)) else f'dataset_{i}'
+                               for i, dataset in enumerate(datasets)]
+
+        return [self.reconstruct(dataset, output_prefix)
+                for dataset, output_prefix in zip(datasets, output_prefixes)]
+
+
+# Environment variables honoured by the OpenMP/BLAS runtimes used by STIR and numpy
+_THREAD_LIMIT_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+
+
+@contextmanager
+def worker_thread_limits(threads_per_worker: int):
+    '''
+    Set the OpenMP/BLAS thread limits in this process's environment while worker processes are
+    started, and restore the previous values afterwards. Spawned workers inherit the environment
+    at start-up: BLAS reads it when numpy is imported, which happens while the worker unpickles
+    its initializer, so the limits cannot be set from the initializer alone. Wrap the whole
+    lifetime of the pool, as workers may be started on demand.
+
+    Parameters:
+    threads_per_worker (int): Thread limit of each worker.
+    '''
+    saved = {var: os.environ.get(var) for var in _THREAD_LIMIT_VARS}
+    os.environ.update({var: str(threads_per_worker) for var in _THREAD_LIMIT_VARS})
+    try:
+        yield
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def _init_recon_worker(threads_per_worker: int, verbosity: int = 1):
+    '''
+    Apply the parent's verbosity in a reconstruction worker and repeat its thread limits (set at
+    start-up by worker_thread_limits) for libraries loaded later. Runs before STIR is imported.
+    '''
+    for var in _THREAD_LIMIT_VARS:
+        os.environ[var] = str(threads_per_worker)
+    stir_simind_trace.set_verbosity(verbosity)
+
+
+def _run_recon_job(job: dict) -> tuple:
+    '''
+    Run reconstruct_with_osem in a worker process.
+
+    Returns (str, dict): The path of the output image and the stages recorded for the job
+                         (export_trace), to be merged into the parent's trace.
+    '''
+    # a worker runs several jobs: send back the stages of this one only
+    stir_simind_trace.reset_trace()
+    reconstruct_with_osem(**job)
+    temp_dir = job.get('temp_dir', './temp_recon')
+    return (os.path.abspath(os.path.join(temp_dir, f"{job['output_prefix']}.hv")),
+            stir_simind_trace.export_trace())
+
+
+def _share_job_images(jobs, shared_dir: str) -> list:
+    '''
+    STIR objects cannot be pickled: write each distinct image of the jobs once to shared_dir
+    and return copies of the jobs that refer to the images by path.
+    '''
+    written = {}
+    worker_jobs = []
+    for job in jobs:
+        job = dict(job)
+        for key in ('initial_image_template', 'attenuation_image'):
+            image = job[key]
+            if isinstance(image, (str, os.PathLike)):
+                continue
+            if id(image) not in written:
+                Path(shared_dir).mkdir(parents=True, exist_ok=True)
+                image_file = os.path.abspath(os.path.join(shared_dir, f'{key}_{len(written)}.hv'))
+                image.write_to_file(image_file)
+                written[id(image)] = image_file
+            job[key] = written[id(image)]
+        worker_jobs.append(job)
+    return worker_jobs
+
+
+def run_reconstruction_jobs(jobs, max_workers: int = None, threads_per_worker: int = 1,
+                            shared_dir: str = './temp_recon/shared'):
+    '''
+    Run independent reconstruct_with_osem jobs in a pool of worker processes.
+
+    Parameters:
+    jobs (list of dict): Keyword arguments of reconstruct_with_osem for each job. Image arguments
+                         that are STIR objects are written once to shared_dir and passed as paths.
+    max_workers (int, optional): Number of worker processes (default is as many as the CPUs allow
+                                 given threads_per_worker, capped at the number of jobs).
+    threads_per_worker (int, optional): OpenMP/BLAS thread limit of each worker (default is 1).
+    shared_dir (str, optional): Directory for image files shared between jobs (default: './temp_recon/shared').
+
+    Returns (list, dict): The reconstructed images in job order (None for jobs that failed),
+                          and a {job index: exception} dictionary of the failures.
+
+    A native crash in a worker breaks the whole pool; the jobs it left unfinished are rerun in a new
+    pool, one worker at a time when a pool breaks before finishing any job, so only the job that
+    crashed is reported as failed.
+    '''
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+
+    import stir
+
+    if not jobs:
+        return [], {}
+
+    if max_workers is None:
+        max_workers = max(1, (os.cpu_count() or 1) // threads_per_worker)
+    max_workers = min(max_workers, len(jobs))
+
+    worker_jobs = _share_job_images(jobs, shared_dir)
+
+    images = [None] * len(jobs)
+    failures = {}
+
+    # Stages inside the workers are recorded there and merged into this trace as the jobs complete
+    context = multiprocessing.get_context('spawn')
+    pending = list(range(len(jobs)))
+    workers = max_workers
+    with stage('reconstruction batch', jobs=len(jobs), workers=max_workers), \
+            worker_thread_limits(threads_per_worker):
+        while pending:
+            unfinished = []
+            with ProcessPoolExecutor(max_workers=min(workers, len(pending)), mp_context=context,
+                                     initializer=_init_recon_worker,
+                                     initargs=(threads_per_worker, stir_simind_trace.VERBOSITY)) as executor:
+                futures = {i: executor.submit(_run_recon_job, worker_jobs[i]) for i in pending}
+                for i, future in futures.items():
+                    try:
+                        output_file, worker_trace = future.result()
+                        stir_simind_trace.merge_trace(worker_trace)
+                        images[i] = stir.FloatVoxelsOnCartesianGrid.read_from_file(output_file)
+                    except BrokenProcessPool:
+                        unfinished.append(i)
+                    except Exception as e:
+                        log(f"Reconstruction job {i} ({worker_jobs[i]['output_prefix']}) failed: {e}")
+                        failures[i] = e
+
+            if unfinished and workers == 1:
+                # a single worker runs the jobs in order, so the first unfinished one crashed it
+                crashed = unfinished.pop(0)
+                log(f"Reconstruction job {crashed} ({worker_jobs[crashed]['output_prefix']}) "
+                    f"failed: the worker process terminated abruptly")
+                failures[crashed] = BrokenProcessPool('the worker process terminated abruptly')
+                workers = max_workers
+            elif unfinished:
+                log(f"Worker pool broke; rerunning {len(unfinished)} unfinished reconstruction job(s)")
+                if len(unfinished) == len(pending):
+                    workers = 1
+            pending = unfinished
+
+    return images, failures
+
+
+def write_projections_array(arr: np.ndarray, template_hs: str, output_hs: str) -> str:
+    '''
+    Write projections given as an array with the as_array() axis order (1, axial, views, tangential)
+    to an Interfile file, using the header of template_hs (same geometry) for everything but the
+    data file and number format. Only numpy I/O is involved, so it can overlap with STIR computations
+    when run from a background thread.
+
+    Returns (str): The output header path.
+    '''
+    output_data = os.path.splitext(output_hs)[0] + '.s'
+    with stage('file write', prefix=os.path.basename(output_hs)):
+        # the file stores views first
+        np.ascontiguousarray(np.asarray(arr)[0].transpose(1, 0, 2), dtype='<f4').tofile(output_data)
+        _write_float_interfile_header(template_hs, output_hs, os.path.basename(output_data))
+    return output_hs
+
+
+def write_image_array(arr: np.ndarray, template_hv: str, output_hv: str) -> str:
+    '''
+    Write a (z, y, x) image array to an Interfile file, using the header of template_hv (same
+    geometry) for everything but the data file and number format. Only numpy I/O is involved,
+    so it can overlap with STIR computations when run from a background thread.
+
+    Returns (str): The output header path.
+    '''
+    output_data = os.path.splitext(output_hv)[0] + '.v'
+    with stage('file write', prefix=os.path.basename(output_hv)):
+        np.ascontiguousarray(arr, dtype='<f4').tofile(output_data)
+        _write_float_interfile_header(template_hv, output_hv, os.path.basename(output_data))
+    return output_hv
+
+
+def _prepare_pipeline_job(job: dict) -> tuple:
+    '''
+    Main-thread part of a pipelined job: convert its input projections (if given as 'dataset') to an
+    array and make sure its initial estimate, attenuation map and mask are in the aux image cache.
+    All STIR/SIRF calls happen here, so the background threads only do numpy I/O.
+
+    Returns (tuple): The reconstruct_with_osem keyword arguments, the cached initial estimate header
+                     (the template of the output header), and the projections array and header
+                     template to write in the background (None, None if there is nothing to write).
+    '''
+    kwargs = dict(job)
+    dataset = kwargs.pop('dataset', None)
+    input_template = kwargs.pop('input_template', None)
+    kwargs.setdefault('temp_dir', './temp_recon')
+    kwargs.setdefault('cache_dir', './temp_recon/aux_cache')
+    Path(kwargs['temp_dir']).mkdir(parents=True, exist_ok=True)
+
+    kwargs['initial_image_template'] = _load_stir_image(kwargs['initial_image_template'])
+    kwargs['attenuation_image'] = _load_stir_image(kwargs['attenuation_image'])
+    init_file, _, _ = get_cached_aux_images(kwargs['initial_image_template'], kwargs['attenuation_image'],
+                                            cache_dir=kwargs['cache_dir'])
+
+    arr = None
+    if dataset is not None:
+        if isinstance(dataset, np.ndarray):
+            if input_template is None:
+                raise ValueError(f"Job {kwargs['output_prefix']}: an array dataset needs an input_template header")
+            arr = dataset
+        elif input_template is None:
+            # no header of this geometry to write the array with: use the object's own writer, here
+            with stage('file write', prefix=kwargs['output_prefix']):
+                dataset.write(str(kwargs['input_file']))
+        else:
+            arr = dataset.as_array()
+
+    return kwargs, init_file, arr, input_template
+
+
+def _timed(func, *args):
+    '''
+    Run func(*args) and return its result with its duration in seconds (for background I/O).
+    '''
+    import time
+
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+@traced('reconstruction pipeline')
+def run_reconstruction_pipeline(jobs, io_workers: int = 2, max_pending: int = 2) -> list:
+    '''
+    Run reconstruct_with_osem jobs one after the other while background I/O threads write the
+    inputs of the next jobs and the outputs of the previous ones, so disk latency is hidden behind
+    the reconstructions. At most max_pending jobs are prepared ahead and at most max_pending
+    outputs wait to be written, which caps the memory held by the pipeline.
+    The threads only write numpy arrays; whether this overlaps with the reconstructions depends on
+    STIR releasing the GIL, so the background I/O time and the time the reconstructions waited for
+    it are measured and logged (the waits are also recorded as 'pipeline I/O wait' stages).
+
+    Parameters:
+    jobs (iterable of dict): Keyword arguments of reconstruct_with_osem for each job, consumed lazily
+                             (e.g. a generator over noise realizations). A job may also contain
+                             'dataset', projections written to its input_file before it runs: an
+                             acquisition object or an array of shape (1, axial, views, tangential),
+                             with 'input_template', a header of the same geometry. Acquisition objects
+                             without input_template are written synchronously with their write method.
+    io_workers (int, optional): Number of background I/O threads (default is 2).
+    max_pending (int, optional): Jobs prepared ahead and outputs queued for writing (default is 2).
+
+    Returns (list of str): The output headers (<temp_dir>/<output_prefix>.hv) in job order.
+    '''
+    import time
+    from collections import deque
+
+    jobs = iter(jobs)
+    prepared = deque()
+    writes = deque()
+    outputs = []
+    io_s, wait_s = 0.0, 0.0
+
+    def wait_for(future):
+        nonlocal io_s, wait_s
+        start = time.perf_counter()
+        with stage('pipeline I/O wait'):
+            _, duration = future.result()
+        wait_s += time.perf_counter() - start
+        io_s += duration
+
+    with ThreadPoolExecutor(max_workers=io_workers) as io_executor:
+        def prepare_next():
+            job = next(jobs, None)
+            if job is not None:
+                kwargs, init_file, arr, input_template = _prepare_pipeline_job(job)
+                write = None
+                if arr is not None:
+                    write = io_executor.submit(_timed, write_projections_array, arr, input_template,
+                                               kwargs['input_file'])
+                prepared.append((kwargs, init_file, write))
+
+        for _ in range(max_pending):
+            prepare_next()
+
+        while prepared:
+            kwargs, init_file, write = prepared.popleft()
+            if write is not None:
+                wait_for(write)
+            prepare_next()
+
+            target = reconstruct_with_osem(**kwargs, write_output=False)
+            output_hv = os.path.join(kwargs['temp_dir'], f"{kwargs['output_prefix']}.hv")
+            writes.append(io_executor.submit(_timed, write_image_array, target.as_array(), init_file, output_hv))
+            outputs.append(output_hv)
+            del target
+
+            while len(writes) > max_pending:
+                wait_for(writes.popleft())
+
+        for write in writes:
+            wait_for(write)
+
+    if io_s > 0:
+        hidden = max(0.0, io_s - wait_s)
+        log(f'Pipeline I/O: {io_s:.3f} s in background threads, {wait_s:.3f} s waited for '
+            f'({hidden / io_s:.0%} overlapped with the reconstructions)')
+
+    return outputs
+
+
+def _run_sweep_group(group: dict) -> list:
+    '''
+    Run one sweep group up to its longest subiteration count in a single reconstruction,
+    capturing the estimate at every requested subiteration count.
+
+    Returns (list of tuple, dict): (subiterations, output .hv path or ndarray) per checkpoint, and
+                                   the stages recorded for the group (export_trace).
+    '''
+    stir_simind_trace.reset_trace()
+    checkpoints = sorted(set(group['checkpoints']))
+    output_prefix = group['output_prefix']
+    temp_dir = group['temp_dir']
+
+    recon, target = _set_up_osem(group['input_file'], output_prefix, group['par_file_template'],
+                                 group['initial_image_template'], group['attenuation_image'],
+                                 group['num_subsets'], checkpoints[-1], temp_dir, group['cache_dir'],
+                                 par_updates=group['par_updates'])
+    if hasattr(recon, 'set_disable_output'):
+        recon.set_disable_output(True)
+
+    snapshots = []
+    start = 1
+    for checkpoint in checkpoints:
+        # Continue from the previous checkpoint: every shorter run is a prefix of the longest one
+        recon.set_start_subiteration_num(start)
+        recon.set_num_subiterations(checkpoint)
+        with stage('reconstruction iterations', prefix=output_prefix):
+            s = recon.reconstruct(target)
+        if not s.succeeded():
+            raise RuntimeError(f'Reconstruction failed for {output_prefix} at subiteration {checkpoint}')
+
+        if group['in_memory']:
+            snapshots.append((checkpoint, target.as_array()))
+        else:
+            snapshot_file = os.path.abspath(os.path.join(temp_dir, f'{output_prefix}_sub{checkpoint}.hv'))
+            with stage('file write', prefix=output_prefix):
+                target.write_to_file(snapshot_file)
+            snapshots.append((checkpoint, snapshot_file))
+        start = checkpoint + 1
+
+    return snapshots, stir_simind_trace.export_trace()
+
+
+def run_osem_sweep(param_grid: dict, input_file: str, par_file_template: str, initial_image_template,
+                   attenuation_image, temp_dir: str = './temp_recon/sweep',
+                   cache_dir: str = './temp_recon/aux_cache', in_memory: bool = False,
+                   max_workers: int = None, threads_per_worker: int = 1) -> list:
+    '''
+    Run an OSEM parameter sweep. Grid points that only differ in num_subiterations share their
+    set-up and are reconstructed once, up to the longest count, with the estimates at the shorter
+    counts captured on the way. Independent groups run in parallel worker processes.
+
+    Parameters:
+    param_grid (dict): {parameter: list of values}. 'num_subsets' and 'num_subiterations' are the
+                       reconstruct_with_osem arguments; any other key is a par file parameter, plain
+                       or (section, key), e.g.
+                       {('Projection Matrix By Bin SPECT UB Parameters', 'psf type'): ['2D', '3D']}.
+    input_file (str): Path to the input acquisition data (.hs file).
+    par_file_template (str): Path to the template par file.
+    initial_image_template: STIR image object (or path to its .hv file) to use as template for initial image.
+    attenuation_image: STIR image object (or path to its .hv file) containing attenuation map.
+    temp_dir (str, optional): Directory for the par files and snapshots (default: './temp_recon/sweep').
+    cache_dir (str, optional): Directory of the shared initial estimate/attenuation/mask cache.
+    in_memory (bool, optional): Return the estimates as arrays instead of writing .hv snapshots (default is False).
+    max_workers (int, optional): Number of worker processes (default as in run_reconstruction_jobs).
+    threads_per_worker (int, optional): OpenMP/BLAS thread limit of each worker (default is 1).
+
+    Returns (list of dict): One row per grid point with the parameter values ((section, key) parameters
+                            named 'section/key'), 'group', and either 'image_file'/'image' or 'error'
+                            if the group failed.
+    '''
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    param_grid = dict(param_grid)
+    subiteration_values = [int(n) for n in param_grid.pop('num_subiterations', [24])]
+    subset_values = [int(n) for n in param_grid.pop('num_subsets', [4])]
+    par_keys = list(param_grid)
+
+    # fail before any set-up work rather than in the workers
+    n_views = read_interfile_header(input_file).get_int('number of projections')
+    invalid = [n for n in subset_values if n < 1 or n_views % n]
+    if invalid:
+        raise ValueError(f'num_subsets {invalid} must divide the number of views ({n_views}) of {input_file}')
+
+    # one group per combination of set-up parameters
+    groups = []
+    for num_subsets in subset_values:
+        for values in itertools.product(*[param_grid[key] for key in par_keys]):
+            group_id = len(groups)
+            groups.append({
+                'input_file': os.path.abspath(input_file),
+                'output_prefix': f'sweep_g{group_id}',
+                'par_file_template': os.path.abspath(par_file_template),
+                'initial_image_template': initial_image_template,
+                'attenuation_image': attenuation_image,
+                'num_subsets': num_subsets,
+                'par_updates': dict(zip(par_keys, values)),
+                'checkpoints': subiteration_values,
+                'temp_dir': os.path.abspath(os.path.join(temp_dir, f'g{group_id}')),
+                'cache_dir': os.path.abspath(cache_dir),
+                'in_memory': in_memory,
+            })
+
+    log(f'Sweep: {len(groups) * len(set(subiteration_values))} points in {len(groups)} groups, '
+        f'{max(subiteration_values)} subiterations per group')
+
+    worker_groups = _share_job_images(groups, os.path.join(temp_dir, 'shared'))
+    if max_workers is None:
+        max_workers = max(1, (os.cpu_count() or 1) // threads_per_worker)
+    max_workers = min(max_workers, len(worker_groups))
+
+    rows = []
+    context = multiprocessing.get_context('spawn')
+    with stage('reconstruction sweep', groups=len(groups), workers=max_workers), \
+            worker_thread_limits(threads_per_worker), \
+            ProcessPoolExecutor(max_workers=max_workers, mp_context=context,
+                                initializer=_init_recon_worker,
+                                initargs=(threads_per_worker, stir_simind_trace.VERBOSITY)) as executor:
+        futures = [executor.submit(_run_sweep_group, group) for group in worker_groups]
+        for group_id, (group, future) in enumerate(zip(groups, futures)):
+            params = {'group': group_id, 'num_subsets': group['num_subsets']}
+            params.update({('/'.join(key) if isinstance(key, tuple) else key): value
+                           for key, value in group['par_updates'].items()})
+            try:
+                snapshots, worker_trace = future.result()
+                snapshots = dict(snapshots)
+                stir_simind_trace.merge_trace(worker_trace)
+            except Exception as e:
+                log(f"Sweep group {group_id} failed: {e}")
+                rows.extend(dict(params, num_subiterations=n, error=e) for n in sorted(set(subiteration_values)))
+                continue
+            for n in sorted(snapshots):
+                rows.append(dict(params, num_subiterations=n, **{'image' if in_memory else 'image_file': snapshots[n]}))
+
+    return rows